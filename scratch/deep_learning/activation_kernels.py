@@ -0,0 +1,115 @@
+from typing import Callable, List
+from array import array
+import math
+
+from scratch.linear_algebra.backends import get_backend, use_backend, np
+from scratch.deep_learning.the_tensor import Tensor, as_tensor, zeros
+
+
+# Our activation layers apply a scalar function (sigmoid, tanh, relu) to every
+# element through tensor_apply, which means a Python-level call (or two) per
+# hidden unit per example, and they backpropagate through tensor_combine and a
+# lambda. Since they run on every hidden unit, they're a big part of the time
+# a forward pass takes.
+
+# So here are "kernels" that run over a whole tensor's buffer at once: with the
+# python backend a single list comprehension (over math.tanh, which is
+# implemented in C), and with the numpy backend ndarray operations that write
+# straight into the output.
+
+def _kernel(python_kernel: Callable, ndarray_kernel: Callable,
+            *tensors: Tensor, out: Tensor=None) -> Tensor:
+    """
+    Runs the kernel for the current backend on the tensors' values (which have
+    to be the same size) and puts the results in out (or a new Tensor with the
+    first tensor's dtype).
+    """
+
+    tensors = tuple(as_tensor(tensor) for tensor in tensors)
+    shape, dtype = tensors[0].shape, tensors[0].dtype
+    if any(tensor.size != tensors[0].size for tensor in tensors):
+        raise ValueError(f"shapes {[list(t.shape) for t in tensors]} don't match")
+
+    if get_backend() == "numpy":
+        if out is None:
+            out = zeros(*shape, dtype=dtype)
+        ndarray_kernel(*[np.asarray(tensor.values()) for tensor in tensors],
+                       out=np.asarray(out.values()))
+        return out
+
+    results = python_kernel(*[tensor.values() for tensor in tensors])
+    if out is None:
+        return Tensor(results, shape, dtype=dtype)
+    out.values()[:] = array(out.typecode, results)
+    return out
+
+# The sigmoid is just a rescaled tanh, sigmoid(x) = (1 + tanh(x / 2)) / 2, and
+# math.tanh is a lot quicker than 1 / (1 + math.exp(-x)) (it also never
+# overflows). The two agree to within about 1e-16:
+
+def _sigmoid(xs) -> List[float]:
+    tanh = math.tanh
+    return [0.5 + 0.5 * tanh(0.5 * x) for x in xs]
+
+def _ndarray_sigmoid(xs, out) -> None:
+    np.multiply(xs, 0.5, out=out)
+    np.tanh(out, out=out)
+    out *= 0.5
+    out += 0.5
+
+def sigmoid_kernel(x: Tensor, out: Tensor=None) -> Tensor:
+    return _kernel(_sigmoid, _ndarray_sigmoid, x, out=out)
+
+def sigmoid_gradient_kernel(sigmoids: Tensor, gradient: Tensor, out: Tensor=None) -> Tensor:
+    return _kernel(lambda ss, gs: [s * (1 - s) * g for s, g in zip(ss, gs)],
+                   lambda ss, gs, out: np.multiply(ss * (1 - ss), gs, out=out),
+                   sigmoids, gradient, out=out)
+
+def tanh_kernel(x: Tensor, out: Tensor=None) -> Tensor:
+    return _kernel(lambda xs: list(map(math.tanh, xs)),
+                   lambda xs, out: np.tanh(xs, out=out),
+                   x, out=out)
+
+def tanh_gradient_kernel(tanhs: Tensor, gradient: Tensor, out: Tensor=None) -> Tensor:
+    return _kernel(lambda ts, gs: [(1 - t * t) * g for t, g in zip(ts, gs)],
+                   lambda ts, gs, out: np.multiply(1 - ts * ts, gs, out=out),
+                   tanhs, gradient, out=out)
+
+def relu_kernel(x: Tensor, out: Tensor=None) -> Tensor:
+    return _kernel(lambda xs: [x if x > 0 else 0.0 for x in xs],
+                   lambda xs, out: np.maximum(xs, 0.0, out=out),
+                   x, out=out)
+
+def relu_gradient_kernel(inputs: Tensor, gradient: Tensor, out: Tensor=None) -> Tensor:
+    return _kernel(lambda xs, gs: [g if x > 0 else 0.0 for x, g in zip(xs, gs)],
+                   lambda xs, gs, out: np.multiply(gs, xs > 0, out=out),
+                   inputs, gradient, out=out)
+
+# At inference time you might hope to trade a little accuracy for speed by
+# replacing sigmoid and tanh with a table of their values on an evenly spaced
+# grid, interpolating linearly between grid points. (Linear interpolation
+# between points step apart is off by at most step ** 2 / 8 times the largest
+# |f''|, so you can pick the step to guarantee any error you like.) We tried
+# it, and it doesn't pay here: on 100,000 values a table good to 1e-3 took
+# about 2-3 times as long as the exact kernels with the python backend, and
+# 4-6 times as long with the numpy backend (even with its arrays built once,
+# ahead of time), because math.tanh and np.tanh are already about as cheap as
+# the lookup itself. So predict just uses the exact kernels.
+
+# The kernels agree with the scalar functions, on both backends:
+
+def exact_sigmoid(x: float) -> float:
+    return 1 / (1 + math.exp(-x)) if x >= 0 else math.exp(x) / (1 + math.exp(x))
+
+xs = Tensor([i / 100 for i in range(-1500, 1501)] + [-1000, 1000])
+
+for backend in ("python", "numpy") if np is not None else ("python",):
+    with use_backend(backend):
+        assert all(abs(t - math.tanh(x)) < 1e-15
+                   for t, x in zip(tanh_kernel(xs).values(), xs.values()))
+        assert all(abs(s - exact_sigmoid(x)) < 1e-15
+                   for s, x in zip(sigmoid_kernel(xs).values(), xs.values()))
+        assert relu_kernel([[-1, 2], [3, -4]]) == [[0, 2], [3, 0]]
+        assert relu_gradient_kernel([-1, 2], [5, 6]) == [0, 6]
+        assert sigmoid_kernel([-1000, 1000]) == [0, 1]
+
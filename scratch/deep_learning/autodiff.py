@@ -0,0 +1,543 @@
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
+from operator import add, mul
+import random
+import weakref
+
+from scratch.linear_algebra.backends import get_backend, use_backend, np
+from scratch.deep_learning.the_tensor import Tensor, as_tensor, tensor_apply, tensor_combine, zeros
+from scratch.deep_learning.the_layer_abstraction import Layer
+from scratch.deep_learning.loss_and_optimization import Loss, SSE
+from scratch.deep_learning.activation_kernels import sigmoid_kernel, sigmoid_gradient_kernel, \
+    tanh_kernel, tanh_gradient_kernel, relu_kernel, relu_gradient_kernel
+from scratch.deep_learning.the_linear_layer import Linear
+from scratch.deep_learning.other_activation_functions import Tanh
+from scratch.deep_learning.neural_networks_as_a_sequence_of_layers import Sequential
+from scratch.deep_learning.convolutional_layers import Conv2D, Flatten
+from scratch.deep_learning.gradient_checking import check_gradients, max_relative_error
+
+
+# Every Layer and Loss we've written works out its own gradient by hand. That's
+# how you make them fast, but it also means every new layer is another chance
+# to get some calculus wrong. The alternative is automatic differentiation:
+# build the computation out of a few simple operations that each know their own
+# derivative, and let the chain rule do the rest.
+
+# We'll do "reverse mode" autodiff with a tape. While a tape is recording, every
+# operation appends an entry to it (the operation, its inputs, and its output).
+# To get gradients we walk the tape backward, handing each operation the
+# gradient of its output and getting back the gradients of its inputs, which
+# get added to whatever the inputs already had.
+
+# The values flowing through the computation are Variables: a Tensor, plus
+# (for the ones we want gradients for, like parameters) a gradient.
+
+class Variable:
+    def __init__(self, value, requires_grad: bool=False) -> None:
+        self.value = as_tensor(value)
+        self.requires_grad = requires_grad
+        self.is_leaf = True           # (that is, not the output of an operation)
+        self.grad: Optional[Tensor] = None
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.value.shape
+
+    def __add__(self, other) -> "Variable":
+        return combine(add, lambda x, y: 1.0, lambda x, y: 1.0, self, other)
+
+    def __sub__(self, other) -> "Variable":
+        return combine(lambda x, y: x - y, lambda x, y: 1.0, lambda x, y: -1.0,
+                       self, other)
+
+    def __mul__(self, other) -> "Variable":
+        return combine(mul, lambda x, y: y, lambda x, y: x, self, other)
+
+    def __matmul__(self, other) -> "Variable":
+        return matmul(self, other)
+
+    def __repr__(self) -> str:
+        return f"Variable({self.value.tolist()})"
+
+def as_variable(value) -> Variable:
+    return value if isinstance(value, Variable) else Variable(value)
+
+# Each operation is a Function, which (a lot like a Layer) computes its output
+# in forward, saving whatever it needs, and turns the output's gradient into
+# its inputs' gradients in backward. A Function object is used for a single
+# call, so that it can hold on to that call's saved values.
+
+_tape: Optional["Tape"] = None
+
+class Function:
+    def forward(self, *inputs: Tensor) -> Tensor:
+        raise NotImplementedError
+
+    def backward(self, gradient: Tensor) -> Sequence[Optional[Tensor]]:
+        """
+        One gradient per input (or None for inputs that don't need one).
+        """
+
+        raise NotImplementedError
+
+    def has_params(self) -> bool:
+        """
+        Whether the operation has parameters of its own (that need gradients
+        whatever its inputs are).
+        """
+
+        return False
+
+    def __call__(self, *inputs) -> Variable:
+        variables = [as_variable(input) for input in inputs]
+        output = Variable(self.forward(*[v.value for v in variables]))
+        output.is_leaf = False
+
+        # We only record anything if there's a tape running and something
+        # needs a gradient (an input, or the operation's own parameters), so
+        # when we're just predicting, the operations cost no more than the
+        # tensor functions they're built on.
+        if _tape is not None and (self.has_params() or
+                                  any(v.requires_grad for v in variables)):
+            output.requires_grad = True
+            _tape.entries.append((self, variables, output))
+        return output
+
+# The tape is a context manager, like use_backend:
+
+class Tape:
+    def __init__(self) -> None:
+        self.entries: List[Tuple[Function, List[Variable], Variable]] = []
+
+    def __enter__(self) -> "Tape":
+        global _tape
+        self.previous = _tape
+        _tape = self
+        return self
+
+    def __exit__(self, *args) -> None:
+        global _tape
+        _tape = self.previous
+
+# Walking backward, we pop each entry off the tape as soon as we've used it, and
+# drop each intermediate gradient as soon as it's been passed along. So as the
+# backward pass goes on, the saved values of the operations it's finished with
+# (and their outputs, unless you're holding on to them) get freed, instead of
+# all of them staying alive until the end. Only the leaves keep their
+# gradients.
+
+    def backward(self, output: Variable, gradient: Tensor=None) -> None:
+        """
+        Accumulates the gradient of output (given the gradient of whatever
+        depends on it, which defaults to 1 for a single number) into the .grad
+        of every leaf Variable that requires one. Uses up the tape.
+        """
+
+        if not output.requires_grad:
+            raise ValueError("output doesn't depend on anything that needs a gradient")
+        if gradient is None:
+            if output.value.size != 1:
+                raise ValueError("a gradient is needed for a non-scalar output")
+            gradient = Tensor([1.0], output.shape)
+
+        grads = {id(output): as_tensor(gradient)}
+        entries, self.entries = self.entries, []
+
+        while entries:
+            function, inputs, result = entries.pop()
+            gradient = grads.pop(id(result), None)
+            if gradient is None:                # (it doesn't affect output)
+                continue
+            input_grads = function.backward(gradient)
+            del function, result, gradient
+
+            for variable, grad in zip(inputs, input_grads):
+                if grad is None or not variable.requires_grad:
+                    continue
+                if variable.is_leaf:
+                    variable.grad = _accumulate(variable.grad, grad)
+                else:
+                    grads[id(variable)] = _accumulate(grads.get(id(variable)), grad)
+
+def _accumulate(total: Optional[Tensor], grad: Tensor) -> Tensor:
+    return as_tensor(grad) if total is None else tensor_combine(add, total, grad)
+
+def backward(output: Variable, gradient: Tensor=None) -> None:
+    """
+    Backpropagates through the tape that's recording.
+    """
+
+    if _tape is None:
+        raise RuntimeError("nothing was recorded; use `with Tape():`")
+    _tape.backward(output, gradient)
+
+# Now the operations. The most general are elementwise ones, the equivalents of
+# tensor_apply and tensor_combine, which just need the derivative(s) too:
+
+class Apply(Function):
+    def __init__(self, f: Callable[[float], float],
+                 df: Callable[[float, float], float]) -> None:
+        """
+        df(x, y) is the derivative of f at x (where y = f(x)).
+        """
+
+        self.f, self.df = f, df
+
+    def forward(self, x: Tensor) -> Tensor:
+        self.x = x
+        self.y = tensor_apply(self.f, x)
+        return self.y
+
+    def backward(self, gradient: Tensor) -> Sequence[Tensor]:
+        slopes = tensor_combine(self.df, self.x, self.y)
+        return [tensor_combine(mul, gradient, slopes)]
+
+class Combine(Function):
+    def __init__(self, f: Callable[[float, float], float],
+                 df_dx: Callable[[float, float], float],
+                 df_dy: Callable[[float, float], float]) -> None:
+        self.f, self.df_dx, self.df_dy = f, df_dx, df_dy
+
+    def forward(self, x: Tensor, y: Tensor) -> Tensor:
+        self.x, self.y = x, y
+        return tensor_combine(self.f, x, y)
+
+    def backward(self, gradient: Tensor) -> Sequence[Tensor]:
+        return [tensor_combine(mul, gradient, tensor_combine(self.df_dx, self.x, self.y)),
+                tensor_combine(mul, gradient, tensor_combine(self.df_dy, self.x, self.y))]
+
+def apply(f: Callable[[float], float], df: Callable[[float, float], float],
+          x) -> Variable:
+    return Apply(f, df)(x)
+
+def combine(f: Callable[[float, float], float],
+            df_dx: Callable[[float, float], float],
+            df_dy: Callable[[float, float], float],
+            x, y) -> Variable:
+    return Combine(f, df_dx, df_dy)(x, y)
+
+# For the activations we already have fast kernels (and their gradients):
+
+class _Activation(Function):
+    kernel: Callable
+    gradient_kernel: Callable
+
+    def forward(self, x: Tensor) -> Tensor:
+        self.y = type(self).kernel(x)
+        return self.y
+
+    def backward(self, gradient: Tensor) -> Sequence[Tensor]:
+        return [type(self).gradient_kernel(self.y, gradient)]
+
+class _Tanh(_Activation):
+    kernel, gradient_kernel = tanh_kernel, tanh_gradient_kernel
+
+class _Sigmoid(_Activation):
+    kernel, gradient_kernel = sigmoid_kernel, sigmoid_gradient_kernel
+
+class _Relu(Function):
+    # (Relu's gradient needs its input rather than its output.)
+    def forward(self, x: Tensor) -> Tensor:
+        self.x = x
+        return relu_kernel(x)
+
+    def backward(self, gradient: Tensor) -> Sequence[Tensor]:
+        return [relu_gradient_kernel(self.x, gradient)]
+
+def tanh(x) -> Variable:
+    return _Tanh()(x)
+
+def sigmoid(x) -> Variable:
+    return _Sigmoid()(x)
+
+def relu(x) -> Variable:
+    return _Relu()(x)
+
+# Matrix multiplication is where most of the work happens. For x @ y, the
+# gradient with respect to x is gradient @ y.T, and with respect to y it's
+# x.T @ gradient, so one helper that can multiply by either matrix or its
+# transpose (without actually transposing anything) covers all three:
+
+def _matmul(x: Tensor, y: Tensor,
+            transpose_x: bool=False, transpose_y: bool=False) -> Tensor:
+    n, k = reversed(x.shape) if transpose_x else x.shape
+    k2, m = reversed(y.shape) if transpose_y else y.shape
+    if k != k2:
+        raise ValueError(f"can't multiply shapes {list(x.shape)} and {list(y.shape)}")
+
+    if get_backend() == "numpy":
+        out = zeros(n, m)
+        a = np.asarray(x.values()).reshape(x.shape)
+        b = np.asarray(y.values()).reshape(y.shape)
+        np.matmul(a.T if transpose_x else a, b.T if transpose_y else b,
+                  out=np.asarray(out.values()).reshape(n, m))
+        return out
+
+    xv, yv = x.values(), y.values()
+    rows = [xv[i::n] for i in range(n)] if transpose_x else \
+           [xv[i * k:(i + 1) * k] for i in range(n)]
+    columns = [yv[j * k:(j + 1) * k] for j in range(m)] if transpose_y else \
+              [yv[j::m] for j in range(m)]
+    return Tensor([sum(map(mul, row, column)) for row in rows for column in columns],
+                  (n, m))
+
+class MatMul(Function):
+    def forward(self, x: Tensor, y: Tensor) -> Tensor:
+        self.x, self.y = x, y
+        return _matmul(x, y)
+
+    def backward(self, gradient: Tensor) -> Sequence[Tensor]:
+        return [_matmul(gradient, self.y, transpose_y=True),
+                _matmul(self.x, gradient, transpose_x=True)]
+
+class Transpose(Function):
+    def forward(self, x: Tensor) -> Tensor:
+        rows, columns = x.shape
+        values = x.values()
+        return Tensor([v for j in range(columns) for v in values[j::columns]],
+                      (columns, rows))
+
+    def backward(self, gradient: Tensor) -> Sequence[Tensor]:
+        return [Transpose().forward(gradient)]
+
+def matmul(x, y) -> Variable:
+    return MatMul()(x, y)
+
+def transpose(x) -> Variable:
+    return Transpose()(x)
+
+# Adding a bias to every row, and reductions:
+
+class AddRow(Function):
+    def forward(self, x: Tensor, row: Tensor) -> Tensor:
+        m = row.size
+        if x.shape[-1] != m:
+            raise ValueError(f"can't add shape {list(row.shape)} to {list(x.shape)}")
+        r = row.values()
+        return Tensor([v + r[i % m] for i, v in enumerate(x.values())], x.shape)
+
+    def backward(self, gradient: Tensor) -> Sequence[Tensor]:
+        m = gradient.shape[-1]
+        g = gradient.values()
+        return [gradient, Tensor([sum(g[j::m]) for j in range(m)], (m,))]
+
+class Sum(Function):
+    def forward(self, x: Tensor) -> Tensor:
+        self.shape = x.shape
+        return Tensor([sum(x.values())], ())
+
+    def backward(self, gradient: Tensor) -> Sequence[Tensor]:
+        size = 1
+        for dim in self.shape:
+            size *= dim
+        return [Tensor([gradient.values()[0]] * size, self.shape)]
+
+def add_row(x, row) -> Variable:
+    return AddRow()(x, row)
+
+def tensor_sum(x) -> Variable:
+    return Sum()(x)
+
+def linear(x, w, b) -> Variable:
+    """
+    What a Linear layer computes: x @ w.T + b, for w of shape (outputs, inputs).
+    """
+
+    return add_row(matmul(x, transpose(w)), b)
+
+# Finally, the layers and losses we've already written by hand are exactly
+# Functions already (they have a forward and a backward), so any of them can be
+# used as an operation too. A layer's own parameters get their gradients the
+# usual way (in layer.grads()), and a loss's "actual" values are just a
+# constant.
+
+class LayerFunction(Function):
+    def __init__(self, layer: Layer) -> None:
+        self.layer = layer
+
+    def forward(self, x: Tensor) -> Tensor:
+        return as_tensor(self.layer.forward(x))
+
+    def backward(self, gradient: Tensor) -> Sequence[Tensor]:
+        return [as_tensor(self.layer.backward(gradient))]
+
+    def has_params(self) -> bool:
+        return any(True for _ in self.layer.params())
+
+class LossFunction(Function):
+    def __init__(self, loss: Loss, actual) -> None:
+        self.loss = loss
+        self.actual = actual
+
+    def forward(self, predicted: Tensor) -> Tensor:
+        value, self.gradient = self.loss.loss_and_gradient(predicted, self.actual)
+        return Tensor([value], ())
+
+    def backward(self, gradient: Tensor) -> Sequence[Tensor]:
+        scale = gradient.values()[0]
+        return [tensor_apply(lambda g: scale * g, as_tensor(self.gradient))]
+
+# A hand-written layer only remembers its most recent forward (its input, and
+# whatever else its backward needs), and backward sets its grads rather than
+# adding to them. So a layer can be called at most once on any one tape: the
+# second call would overwrite what the first one's backward needs, and give
+# the wrong parameter gradients without any complaint. (To use the same
+# weights twice, make them Variables and use the operations above.)
+
+def call_layer(layer: Layer, x) -> Variable:
+    if _tape is not None and any(isinstance(function, LayerFunction) and function.layer is layer
+                                 for function, _, _ in _tape.entries):
+        raise ValueError(f"{type(layer).__name__} layer is already on this tape; "
+                         "a layer can only be called once per tape")
+    return LayerFunction(layer)(x)
+
+def call_loss(loss: Loss, predicted, actual) -> Variable:
+    return LossFunction(loss, actual)(predicted)
+
+# To train something built this way with our optimizers (and our training
+# loop), we wrap it up as a Layer: forward records a tape, and backward plays
+# it back. Its params are the Variables you give it, plus the params of any
+# layers it calls. (Since a Python function can't be described in JSON, you can
+# save such a layer's weights but not its architecture.)
+
+class AutodiffLayer(Layer):
+
+    def __init__(self,
+                 function: Callable[[Variable], Variable],
+                 params: Iterable[Variable]=(),
+                 layers: Iterable[Layer]=()) -> None:
+        self.function = function
+        self.variables = list(params)
+        self.layers = list(layers)
+        for variable in self.variables:
+            variable.requires_grad = True
+
+    def forward(self, input: Tensor) -> Tensor:
+        self.tape = Tape()
+        self.input = Variable(input, requires_grad=True)
+        with self.tape:
+            self.output = self.function(self.input)
+        return self.output.value
+
+    def backward(self, gradient: Tensor) -> Tensor:
+        for variable in self.variables:
+            variable.grad = None
+        self.tape.backward(self.output, gradient)
+        input_grad = self.input.grad
+        self.tape = self.input = self.output = None
+        return input_grad
+
+    def predict(self, input: Tensor) -> Tensor:
+        # No tape, so nothing gets recorded.
+        return self.function(Variable(input)).value
+
+    def params(self) -> Iterable[Tensor]:
+        return ([variable.value for variable in self.variables]
+                + [param for layer in self.layers for param in layer.params()])
+
+    def grads(self) -> Iterable[Tensor]:
+        # (A parameter that didn't affect the output gets a zero gradient.)
+        return ([variable.grad if variable.grad is not None else zeros(*variable.shape)
+                 for variable in self.variables]
+                + [grad for layer in self.layers for grad in layer.grads()])
+
+    def config(self):
+        raise NotImplementedError("an AutodiffLayer's function can't be saved")
+
+# The gradients we get this way agree with our hand-written layers. Here's a
+# Linear-Tanh-Linear network both ways, with the same weights:
+
+random.seed(0)
+network = Sequential([Linear(4, 3), Tanh(), Linear(3, 2)])
+w1, b1, w2, b2 = [Variable(Tensor(param)) for param in network.params()]
+autodiff_network = AutodiffLayer(lambda x: linear(tanh(linear(x, w1, b1)), w2, b2),
+                                 params=[w1, b1, w2, b2])
+
+xs = Tensor([[random.random() for _ in range(4)] for _ in range(5)])
+output_gradient = Tensor([[random.random() for _ in range(2)] for _ in range(5)])
+
+for backend in ("python", "numpy") if np is not None else ("python",):
+    with use_backend(backend):
+        assert max_relative_error(network.forward(xs), autodiff_network.forward(xs)) < 1e-12
+        input_grad = network.backward(output_gradient)
+        assert max_relative_error(input_grad, autodiff_network.backward(output_gradient)) < 1e-12
+        for grad, autodiff_grad in zip(network.grads(), autodiff_network.grads()):
+            assert max_relative_error(grad, autodiff_grad) < 1e-12
+        assert max_relative_error(network.predict(xs), autodiff_network.predict(xs)) < 1e-12
+
+# and a hand-written layer used as an operation (here a convolution, feeding a
+# ReLU and a sum of products) passes the gradient check:
+
+conv = Conv2D(1, 2, kernel_size=2)
+w = Variable(Tensor([[random.random() for _ in range(18)] for _ in range(3)]))
+custom = AutodiffLayer(lambda x: matmul(relu(call_layer(Flatten(), call_layer(conv, x))),
+                                        transpose(w)),
+                       params=[w], layers=[conv])
+assert all(error < 1e-6 for error in check_gradients(custom, (2, 1, 4, 4)).values())
+
+# Calling that same layer twice isn't allowed:
+
+lin = Linear(3, 3)
+twice = AutodiffLayer(lambda x: call_layer(lin, call_layer(lin, x)), layers=[lin])
+try:
+    twice.forward(Tensor([[1.0, 2.0, 3.0]]))
+    assert False, "a layer was called twice on one tape"
+except ValueError:
+    pass
+
+# Losses work too, and the whole thing can be differentiated down to the
+# parameters (here with the usual Variable arithmetic):
+
+x = Variable(Tensor([[1.0, 2.0], [3.0, 4.0]]), requires_grad=True)
+y = Variable(Tensor([[0.5, -1.0], [2.0, 1.0]]), requires_grad=True)
+with Tape():
+    z = tensor_sum(x * y - x)
+    backward(z)
+assert z.value.tolist() == 0.5 - 2.0 + 6.0 + 4.0 - 10
+assert x.grad == [[-0.5, -2.0], [1.0, 0.0]] and y.grad == [[1, 2], [3, 4]]
+
+t = Variable(Tensor([0.0, 1.0, 2.0]), requires_grad=True)
+with Tape():
+    backward(tensor_sum(apply(lambda x: x ** 3, lambda x, y: 3 * x ** 2, t)))
+assert t.grad == [0, 3, 12]
+
+predicted = Variable(Tensor([[1.0, 2.0, 3.0]]), requires_grad=True)
+with Tape():
+    backward(call_loss(SSE(), predicted, [[0.0, 0.0, 1.0]]))
+assert max_relative_error(predicted.grad,
+                          SSE().gradient(predicted.value, [[0.0, 0.0, 1.0]])) < 1e-12
+
+# And once the backward pass has used an intermediate value, nothing holds on
+# to it any more:
+
+with Tape() as tape:
+    hidden = tanh(matmul(x, y))
+    saved = weakref.ref(hidden.value)
+    loss = call_loss(SSE(), hidden, [[0, 0], [0, 0]])
+    del hidden
+    assert saved() is not None
+    backward(loss)
+assert saved() is None and not tape.entries
+
+# A layer's parameters get their gradients even when its input is plain data
+# (that doesn't need one), just as if we'd called forward and backward
+# ourselves:
+
+plain = Linear(3, 2)
+plain_xs = Tensor([[1.0, 2.0, 3.0], [0.0, -1.0, 1.0]])
+plain_ys = [[0.0, 1.0], [1.0, 0.0]]
+with Tape():
+    backward(call_loss(SSE(), call_layer(plain, Variable(plain_xs)), plain_ys))
+autodiff_w_grad = Tensor(as_tensor(plain.w_grad))
+plain.backward(SSE().gradient(plain.forward(plain_xs), plain_ys))
+assert max_relative_error(autodiff_w_grad, plain.w_grad) < 1e-12
+
+# But an output that nothing needing a gradient went into can't be
+# backpropagated through, and rather than quietly doing nothing, backward
+# says so:
+
+with Tape():
+    try:
+        backward(tensor_sum(Variable(plain_xs)))
+        assert False, "backward through an unrecorded output did nothing"
+    except ValueError:
+        pass
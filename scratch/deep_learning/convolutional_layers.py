@@ -0,0 +1,480 @@
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+from operator import itemgetter, mul
+import random
+
+from scratch.linear_algebra.backends import get_backend, use_backend, np
+from scratch.deep_learning.the_tensor import Tensor, as_tensor, zeros
+from scratch.deep_learning.the_layer_abstraction import Layer
+from scratch.deep_learning.the_linear_layer import random_tensor
+
+
+# Our MNIST network flattens each 28 x 28 image into 784 numbers, which throws
+# away the fact that neighboring pixels are related. A convolutional layer
+# instead slides a small filter (say 3 x 3) over the image, computing at each
+# position the dot product of the filter's weights with the pixels under it.
+# Every position uses the same weights, so a layer with 8 filters of size
+# 3 x 3 has only 8 * 9 weights (plus 8 biases), no matter how big the image is.
+
+# Images come in as tensors of shape (batch_size, channels, height, width). A
+# grayscale image has a single channel; the output of a convolutional layer has
+# one channel per filter (so each filter spans all of its input's channels).
+
+# Written directly, a convolution is six nested loops (over examples, filters,
+# output rows, output columns, channels, and the filter's rows and columns).
+# The standard trick ("im2col") is to first copy every patch the filter visits
+# into a row of a matrix. Then the whole convolution is a single product of that
+# matrix with the (flattened) filters, which is what both our Linear layer and
+# numpy are good at.
+
+def output_size(size: int, kernel_size: int, stride: int, padding: int) -> int:
+    return (size + 2 * padding - kernel_size) // stride + 1
+
+# For each output position, in order, patch_indices gives the positions in a
+# (flattened) channels x height x width example of the values under the filter,
+# in the same (channel, row, column) order as the filter's weights:
+
+def patch_indices(channels: int,
+                  height: int,
+                  width: int,
+                  kernel_size: int,
+                  stride: int) -> List[int]:
+    out_height = output_size(height, kernel_size, stride, 0)
+    out_width = output_size(width, kernel_size, stride, 0)
+    return [(c * height + r * stride + i) * width + s * stride + j
+            for r in range(out_height)
+            for s in range(out_width)
+            for c in range(channels)
+            for i in range(kernel_size)
+            for j in range(kernel_size)]
+
+assert patch_indices(1, 3, 3, 2, 1) == [0, 1, 3, 4,  1, 2, 4, 5,
+                                        3, 4, 6, 7,  4, 5, 7, 8]
+
+# With the python backend, an itemgetter made from those indices copies out all
+# of an example's patches in one call:
+
+def _gatherer(indices: List[int]) -> Callable[[Sequence[float]], Tuple[float, ...]]:
+    getter = itemgetter(*indices)
+    return getter if len(indices) > 1 else lambda values: (getter(values),)
+
+# Padding surrounds each channel with zeros, so that the filter can be centered
+# on the pixels at the edges too:
+
+def _pad(values: Sequence[float], channels: int, height: int, width: int,
+         padding: int) -> Sequence[float]:
+    if padding == 0:
+        return values
+    padded_width = width + 2 * padding
+    padded_height = height + 2 * padding
+    padded = [0.0] * (channels * padded_height * padded_width)
+    for c in range(channels):
+        for r in range(height):
+            start = (c * padded_height + r + padding) * padded_width + padding
+            padded[start:start + width] = values[(c * height + r) * width:
+                                                 (c * height + r + 1) * width]
+    return padded
+
+def _unpad(padded: List[float], channels: int, height: int, width: int,
+           padding: int) -> List[float]:
+    if padding == 0:
+        return padded
+    padded_width = width + 2 * padding
+    padded_height = height + 2 * padding
+    values: List[float] = []
+    for c in range(channels):
+        for r in range(height):
+            start = (c * padded_height + r + padding) * padded_width + padding
+            values.extend(padded[start:start + width])
+    return values
+
+# With numpy, we copy the patches with one strided slice per filter position,
+# into an array of shape (batch, channels, kernel_size, kernel_size, out_height,
+# out_width). Going backward, each slice's gradients get added back to where
+# they came from:
+
+def _ndarray_im2col(x, kernel_size: int, stride: int):
+    batch_size, channels, height, width = x.shape
+    out_height = output_size(height, kernel_size, stride, 0)
+    out_width = output_size(width, kernel_size, stride, 0)
+    cols = np.empty((batch_size, channels, kernel_size, kernel_size, out_height, out_width))
+    for i in range(kernel_size):
+        for j in range(kernel_size):
+            cols[:, :, i, j] = x[:, :, i:i + stride * out_height:stride,
+                                       j:j + stride * out_width:stride]
+    return cols
+
+def _ndarray_col2im(cols, shape: Tuple[int, ...], stride: int):
+    x = np.zeros(shape)
+    _, _, kernel_size, _, out_height, out_width = cols.shape
+    for i in range(kernel_size):
+        for j in range(kernel_size):
+            x[:, :, i:i + stride * out_height:stride,
+                    j:j + stride * out_width:stride] += cols[:, :, i, j]
+    return x
+
+def _from_ndarray(values, shape: Sequence[int]) -> Tensor:
+    tensor = zeros(*shape)
+    np.asarray(tensor.values())[:] = values.ravel()
+    return tensor
+
+def _image_shape(input: Tensor, channels: int) -> Tuple[int, int, int, int]:
+    if len(input.shape) != 4 or input.shape[1] != channels:
+        raise ValueError(f"expected shape [batch_size, {channels}, height, width], "
+                         f"not {list(input.shape)}")
+    return input.shape
+
+# Now the layer itself. Its weights have shape (out_channels, in_channels,
+# kernel_size, kernel_size), so that weights[o] is the o-th filter, and (just
+# like a Linear layer's) each filter has a bias.
+
+class Conv2D(Layer):
+
+    def __init__(self,
+                 in_channels: int,
+                 out_channels: int,
+                 kernel_size: int,
+                 stride: int=1,
+                 padding: int=0,
+                 init: str="xavier") -> None:
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.kernel_size = kernel_size
+        self.stride = stride
+        self.padding = padding
+        self.init = init
+
+        self.w = random_tensor(out_channels, in_channels, kernel_size, kernel_size,
+                               init=init)
+        self.b = random_tensor(out_channels, init=init)
+
+    def forward(self, input: Tensor) -> Tensor:
+        input = as_tensor(input)
+        batch_size, channels, height, width = _image_shape(input, self.in_channels)
+        k, p = self.kernel_size, self.padding
+        out_height = output_size(height, k, self.stride, p)
+        out_width = output_size(width, k, self.stride, p)
+        out_shape = (batch_size, self.out_channels, out_height, out_width)
+
+        # Save what backward needs (which depends on the backend).
+        self.input_shape = input.shape
+        self.backend = get_backend()
+
+        if self.backend == "numpy":
+            x = np.asarray(input.values()).reshape(input.shape)
+            if p:
+                x = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)))
+            self.cols = _ndarray_im2col(x, k, self.stride).reshape(
+                batch_size, channels * k * k, out_height * out_width)
+            w = np.asarray(self.w.values()).reshape(self.out_channels, -1)
+
+            output = zeros(*out_shape)
+            y = np.asarray(output.values()).reshape(batch_size, self.out_channels, -1)
+            np.matmul(w, self.cols, out=y)
+            y += np.asarray(self.b.values())[:, None]
+            return output
+
+        # With the python backend, gather each example's patches, and then each
+        # output is the dot product of one filter with one patch.
+        self.indices = patch_indices(channels, height + 2 * p, width + 2 * p,
+                                     k, self.stride)
+        gather = _gatherer(self.indices)
+        K = channels * k * k
+        L = out_height * out_width
+        w = self.w.values()
+        b = self.b.values()
+        filters = [w[o * K:(o + 1) * K] for o in range(self.out_channels)]
+        x = input.values()
+        size = channels * height * width
+
+        self.cols = []
+        outputs: List[float] = []
+        for e in range(batch_size):
+            cols = gather(_pad(x[e * size:(e + 1) * size], channels, height, width, p))
+            self.cols.append(cols)
+            patches = [cols[q * K:(q + 1) * K] for q in range(L)]
+            outputs.extend(sum(map(mul, patch, filters[o])) + b[o]
+                           for o in range(self.out_channels)
+                           for patch in patches)
+
+        return Tensor(outputs, out_shape)
+
+# Backward is a Linear layer's backward, once per example: the weight gradients
+# are products of the output gradients with the patches, and the gradients for
+# the patches are products of the output gradients with the weights. Each
+# patch gradient then gets added back to the pixels the patch came from
+# ("col2im"), since a pixel that appears in several patches affects several
+# outputs.
+
+    def backward(self, gradient: Tensor) -> Tensor:
+        gradient = as_tensor(gradient)
+        batch_size, channels, height, width = self.input_shape
+        k, p, m = self.kernel_size, self.padding, self.out_channels
+        K = channels * k * k
+        padded_shape = (batch_size, channels, height + 2 * p, width + 2 * p)
+
+        if self.backend == "numpy":
+            g = np.asarray(gradient.values()).reshape(batch_size, m, -1)
+            w = np.asarray(self.w.values()).reshape(m, K)
+            self.b_grad = _from_ndarray(g.sum(axis=(0, 2)), self.b.shape)
+            self.w_grad = _from_ndarray(np.tensordot(g, self.cols, axes=([0, 2], [0, 2])),
+                                        self.w.shape)
+
+            out_height, out_width = gradient.shape[2:]
+            patch_grads = np.matmul(w.T, g).reshape(batch_size, channels, k, k,
+                                                    out_height, out_width)
+            padded = _ndarray_col2im(patch_grads, padded_shape, self.stride)
+            return _from_ndarray(padded[:, :, p:p + height, p:p + width],
+                                 self.input_shape)
+
+        g = gradient.values()
+        w = self.w.values()
+        L = gradient.size // (batch_size * m)
+        w_columns = [w[j::K] for j in range(K)]
+        b_grad = [0.0] * m
+        w_grad = [0.0] * (m * K)
+        input_grad: List[float] = []
+
+        for e, cols in enumerate(self.cols):
+            g_e = g[e * m * L:(e + 1) * m * L]
+            col_columns = [cols[j::K] for j in range(K)]
+            for o in range(m):
+                g_o = g_e[o * L:(o + 1) * L]
+                b_grad[o] += sum(g_o)
+                for j in range(K):
+                    w_grad[o * K + j] += sum(map(mul, g_o, col_columns[j]))
+
+            # The gradient for entry j of patch q, scattered back to its pixel.
+            by_position = [g_e[q::L] for q in range(L)]
+            padded = [0.0] * (channels * padded_shape[2] * padded_shape[3])
+            patch_grads = (sum(map(mul, g_q, w_j))
+                           for g_q in by_position for w_j in w_columns)
+            for i, patch_grad in zip(self.indices, patch_grads):
+                padded[i] += patch_grad
+            input_grad.extend(_unpad(padded, channels, height, width, p))
+
+        self.b_grad = Tensor(b_grad, self.b.shape)
+        self.w_grad = Tensor(w_grad, self.w.shape)
+        return Tensor(input_grad, self.input_shape)
+
+    def params(self) -> List[Tensor]:
+        return [self.w, self.b]
+
+    def grads(self) -> List[Tensor]:
+        return [self.w_grad, self.b_grad]
+
+    def config(self) -> Dict[str, Any]:
+        return {"in_channels": self.in_channels,
+                "out_channels": self.out_channels,
+                "kernel_size": self.kernel_size,
+                "stride": self.stride,
+                "padding": self.padding,
+                "init": self.init}
+
+# After a convolution it's common to shrink the image with "max pooling":
+# replace each (say) 2 x 2 block of each channel with its largest value. The
+# patches are the same as a convolution's (with one channel at a time), and
+# going backward, each output's gradient goes to whichever input was largest.
+
+class MaxPool2D(Layer):
+
+    def __init__(self, size: int=2, stride: int=None) -> None:
+        self.size = size
+        self.stride = size if stride is None else stride
+
+    def forward(self, input: Tensor) -> Tensor:
+        input = as_tensor(input)
+        if len(input.shape) != 4:
+            raise ValueError(f"expected shape [batch_size, channels, height, width], "
+                             f"not {list(input.shape)}")
+        batch_size, channels, height, width = input.shape
+        k = self.size
+        out_height = output_size(height, k, self.stride, 0)
+        out_width = output_size(width, k, self.stride, 0)
+        out_shape = (batch_size, channels, out_height, out_width)
+
+        self.input_shape = input.shape
+        self.backend = get_backend()
+
+        if self.backend == "numpy":
+            x = np.asarray(input.values()).reshape(input.shape)
+            windows = _ndarray_im2col(x, k, self.stride).reshape(
+                batch_size, channels, k * k, out_height, out_width)
+            self.argmax = windows.argmax(axis=2)[:, :, None]
+            return _from_ndarray(np.take_along_axis(windows, self.argmax, axis=2),
+                                 out_shape)
+
+        # For each output, remember where (in the whole input) its max was.
+        indices = patch_indices(1, height, width, k, self.stride)
+        gather = _gatherer(indices)
+        x = input.values()
+        plane = height * width
+        kk = k * k
+
+        outputs: List[float] = []
+        self.argmax = []
+        for start in range(0, input.size, plane):
+            values = gather(x[start:start + plane])
+            for q in range(0, len(values), kk):
+                window = values[q:q + kk]
+                largest = max(window)
+                outputs.append(largest)
+                self.argmax.append(start + indices[q + window.index(largest)])
+
+        return Tensor(outputs, out_shape)
+
+    def backward(self, gradient: Tensor) -> Tensor:
+        gradient = as_tensor(gradient)
+
+        if self.backend == "numpy":
+            batch_size, channels, out_height, out_width = gradient.shape
+            k = self.size
+            g = np.asarray(gradient.values()).reshape(batch_size, channels, 1,
+                                                      out_height, out_width)
+            window_grads = np.zeros((batch_size, channels, k * k, out_height, out_width))
+            np.put_along_axis(window_grads, self.argmax, g, axis=2)
+            window_grads = window_grads.reshape(batch_size, channels, k, k,
+                                                out_height, out_width)
+            return _from_ndarray(_ndarray_col2im(window_grads, self.input_shape,
+                                                 self.stride),
+                                 self.input_shape)
+
+        input_grad = zeros(*self.input_shape)
+        grad = input_grad.data
+        for i, g in zip(self.argmax, gradient.values()):
+            grad[i] += g
+        return input_grad
+
+    def config(self) -> Dict[str, Any]:
+        return {"size": self.size, "stride": self.stride}
+
+# Finally, to get from convolutional layers to Linear ones (and from our
+# flattened MNIST images to convolutional layers) we need to change shapes.
+# Since a Tensor is a flat buffer plus a shape, that doesn't copy anything.
+# Both layers keep the first (batch) dimension as is:
+
+class Flatten(Layer):
+    """
+    Turns each example into a vector.
+    """
+
+    def forward(self, input: Tensor) -> Tensor:
+        input = as_tensor(input)
+        self.input_shape = input.shape
+        batch_size = input.shape[0]
+        return Tensor.from_buffer(input.data, (batch_size, input.size // batch_size),
+                                  input.offset)
+
+    def backward(self, gradient: Tensor) -> Tensor:
+        gradient = as_tensor(gradient)
+        return Tensor.from_buffer(gradient.data, self.input_shape, gradient.offset)
+
+class Reshape(Layer):
+    """
+    Gives each example the given shape.
+    """
+
+    def __init__(self, *shape: int) -> None:
+        self.shape = shape
+
+    def forward(self, input: Tensor) -> Tensor:
+        input = as_tensor(input)
+        self.input_shape = input.shape
+        return Tensor.from_buffer(input.data, input.shape[:1] + self.shape, input.offset)
+
+    def backward(self, gradient: Tensor) -> Tensor:
+        gradient = as_tensor(gradient)
+        return Tensor.from_buffer(gradient.data, self.input_shape, gradient.offset)
+
+    def config(self) -> Dict[str, Any]:
+        return {"shape": list(self.shape)}
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "Reshape":
+        return cls(*config["shape"])
+
+# Let's check the layers against the six-nested-loops version of a convolution,
+# and their gradients against finite differences, on both backends:
+
+def naive_conv2d(conv: Conv2D, images: List) -> List:
+    k, s, p = conv.kernel_size, conv.stride, conv.padding
+    w, b = conv.w.tolist(), conv.b.tolist()
+
+    def pixel(image, c, r, col):
+        r, col = r - p, col - p
+        inside = 0 <= r < len(image[c]) and 0 <= col < len(image[c][0])
+        return image[c][r][col] if inside else 0.0
+
+    outputs = []
+    for image in images:
+        out_height = output_size(len(image[0]), k, s, p)
+        out_width = output_size(len(image[0][0]), k, s, p)
+        outputs.append([[[b[o] + sum(w[o][c][i][j] * pixel(image, c, r * s + i, col * s + j)
+                                     for c in range(conv.in_channels)
+                                     for i in range(k)
+                                     for j in range(k))
+                          for col in range(out_width)]
+                         for r in range(out_height)]
+                        for o in range(conv.out_channels)])
+    return outputs
+
+def _close(t1: Tensor, t2, tolerance: float=1e-9) -> bool:
+    t1, t2 = as_tensor(t1), as_tensor(t2)
+    return t1.shape == t2.shape and all(abs(a - b) < tolerance
+                                        for a, b in zip(t1.values(), t2.values()))
+
+def _numerical_gradient(layer: Layer, images: Tensor, output_gradient: Tensor,
+                        values: Tensor, h: float=1e-6) -> List[float]:
+    """
+    The gradient, with respect to each entry of values, of the dot product of
+    the layer's output with output_gradient.
+    """
+
+    def objective() -> float:
+        return sum(map(mul, layer.forward(images).values(), output_gradient.values()))
+
+    grads = []
+    for i in range(values.size):
+        original = values.data[values.offset + i]
+        values.data[values.offset + i] = original + h
+        plus = objective()
+        values.data[values.offset + i] = original - h
+        minus = objective()
+        values.data[values.offset + i] = original
+        grads.append((plus - minus) / (2 * h))
+    return grads
+
+random.seed(0)
+images = Tensor([[[[random.random() for _ in range(6)] for _ in range(5)]
+                  for _ in range(2)] for _ in range(3)])
+pool_images = Tensor([[[[random.random() for _ in range(5)] for _ in range(4)]]])
+
+for backend in ("python", "numpy") if np is not None else ("python",):
+    with use_backend(backend):
+        for stride, padding in [(1, 0), (2, 1)]:
+            conv = Conv2D(2, 3, kernel_size=3, stride=stride, padding=padding)
+            output = conv.forward(images)
+            assert _close(output, naive_conv2d(conv, images.tolist()))
+
+            output_gradient = Tensor([random.random() for _ in range(output.size)],
+                                     output.shape)
+            input_grad = conv.backward(output_gradient)
+            for values, grad in [(images, input_grad), (conv.w, conv.w_grad),
+                                 (conv.b, conv.b_grad)]:
+                numerical = _numerical_gradient(conv, images, output_gradient, values)
+                assert _close(grad, Tensor(numerical, grad.shape), 1e-6)
+
+        pool = MaxPool2D(2)
+        pooled = pool.forward(pool_images)
+        assert pooled.shape == (1, 1, 2, 2)
+        assert pooled.tolist() == [[[[max(pool_images[0][0][r + i][c + j]
+                                          for i in range(2) for j in range(2))
+                                      for c in (0, 2)] for r in (0, 2)]]]
+        pool_gradient = Tensor([1.0, 2.0, 3.0, 4.0], pooled.shape)
+        numerical = _numerical_gradient(pool, pool_images, pool_gradient, pool_images)
+        assert _close(pool.backward(pool_gradient), Tensor(numerical, pool_images.shape),
+                      1e-6)
+
+flatten = Flatten()
+assert flatten.forward(images).shape == (3, 60)
+assert flatten.backward(flatten.forward(images)) == images
+assert Reshape(2, 5, 6).forward(Flatten().forward(images)) == images
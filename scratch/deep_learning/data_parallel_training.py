@@ -0,0 +1,298 @@
+from typing import Any, Dict, Iterable, List, Tuple
+from array import array
+from multiprocessing import Pool, util
+from multiprocessing.shared_memory import SharedMemory
+import math
+import os
+import random
+
+import tqdm
+
+from scratch.linear_algebra.backends import get_backend, np
+from scratch.deep_learning.the_tensor import Tensor, as_tensor
+from scratch.deep_learning.the_layer_abstraction import Layer
+from scratch.deep_learning.loss_and_optimization import Loss, Optimizer
+
+
+# Even with minibatches, our training loop only ever uses one CPU core. The
+# simplest way to use more is data parallelism: split each minibatch into
+# shards, let a pool of worker processes (each with its own copy of the model)
+# compute the gradients for one shard apiece, add those gradients up, and have
+# the optimizer take a single step with the total.
+
+# The workers need to see the parameters after every step. Pickling the whole
+# model over to each of them on every step would cost about as much as the
+# work itself, so instead we put all of the parameters into one block of
+# shared memory and point every parameter tensor (in the main process and in
+# each worker) at its slice of that block. When the optimizer updates a
+# parameter in place, every worker sees the new value. The workers hand their
+# gradients back the same way, each into its own slot of a second block.
+
+# Both blocks hold the same kind of numbers as the model's parameters (float64
+# or float32), so a float32 model shares half as many bytes. Gradients that
+# some layer computed in a different dtype get converted on the way in.
+
+def total_size(tensors: Iterable[Tensor]) -> int:
+    return sum(as_tensor(tensor).size for tensor in tensors)
+
+def params_typecode(tensors: Iterable[Tensor]) -> str:
+    for tensor in tensors:
+        return as_tensor(tensor).typecode
+    return "d"
+
+def copy_values(buffer, offset: int, tensor: Tensor) -> None:
+    values = tensor.values()
+    if values.format != buffer.format:
+        values = array(buffer.format, values)
+    buffer[offset:offset + tensor.size] = values
+
+def attach(tensors: Iterable[Tensor], buffer, copy: bool) -> None:
+    """
+    Makes consecutive slices of the (flat) buffer the storage for the tensors,
+    first copying their current values into it if copy is True.
+    """
+
+    offset = 0
+    for tensor in tensors:
+        if copy:
+            copy_values(buffer, offset, tensor)
+        tensor.rebind(buffer, offset)
+        offset += tensor.size
+
+# Each worker process keeps its replica of the model (and its view of the
+# data) in this module-level dictionary, which the pool sets up once per
+# worker:
+
+_worker: Dict[str, Any] = {}
+
+def _start_worker(model: Layer,
+                  loss: Loss,
+                  images: List[Tensor],
+                  labels: List[Tensor],
+                  params: SharedMemory,
+                  grads: SharedMemory,
+                  seed: int) -> None:
+    code = params_typecode(model.params())
+    shared_params = params.buf.cast(code)
+    attach(model.params(), shared_params, copy=False)
+
+    # Otherwise every (forked) worker would draw the same dropout masks.
+    random.seed(seed + os.getpid())
+
+    _worker.update(model=model, loss=loss, images=images, labels=labels,
+                   params=params, grads=grads, shared_params=shared_params,
+                   typecode=code, size=total_size(model.params()))
+
+    # Shared memory can't be closed while anything still points into it, so
+    # let go of it before the worker exits.
+    util.Finalize(None, _stop_worker, exitpriority=10)
+
+def _stop_worker() -> None:
+    for param in _worker["model"].params():
+        param.rebind(array(param.typecode, param.values()))
+    _worker["shared_params"].release()
+    _worker.clear()
+
+def _shard_gradients(task: Tuple[int, int, int]) -> Tuple[float, int]:
+    """
+    Runs forward and backward on images[start:end] and writes the (summed)
+    parameter gradients into the given slot. Returns the shard's total loss
+    and the number of correct predictions.
+    """
+
+    slot, start, end = task
+    model, loss = _worker["model"], _worker["loss"]
+    images = as_tensor(_worker["images"][start:end])
+    labels = _worker["labels"][start:end]
+
+    predicted = model.forward(images)
+    correct = sum(1 for p, label in zip(predicted, labels)
+                  if p.index(max(p)) == (label if isinstance(label, int)
+                                         else label.index(max(label))))
+    shard_loss, gradient = loss.loss_and_gradient(predicted, labels)
+    model.backward(gradient)
+
+    grads = _worker["grads"].buf.cast(_worker["typecode"])
+    offset = slot * _worker["size"]
+    for grad in model.grads():
+        grad = as_tensor(grad)
+        copy_values(grads, offset, grad)
+        offset += grad.size
+    grads.release()
+
+    return shard_loss, correct
+
+# The main process doesn't run the model at all. After each step it adds up
+# the workers' gradient slots (the "all-reduce"), divides by the batch size
+# (like our single-process loop does), and hands those averaged gradients to
+# the optimizer through a tiny Layer whose params are the shared parameters:
+
+class _ReducedGradients(Layer):
+
+    def __init__(self, params: List[Tensor], grads: List[Tensor]) -> None:
+        self._params = params
+        self._grads = grads
+
+    def params(self) -> Iterable[Tensor]:
+        return self._params
+
+    def grads(self) -> Iterable[Tensor]:
+        return self._grads
+
+class DataParallelTrainer:
+    """
+    Trains model on (images, labels) with num_workers processes. Use it as a
+    context manager, so that the pool and the shared memory get cleaned up
+    (at which point the model gets private copies of its parameters back).
+    """
+
+    def __init__(self,
+                 model: Layer,
+                 loss: Loss,
+                 optimizer: Optimizer,
+                 images: List[Tensor],
+                 labels: List[Tensor],
+                 num_workers: int=None,
+                 seed: int=0) -> None:
+        self.model = model
+        self.optimizer = optimizer
+        self.images = images
+        self.labels = labels
+        self.num_workers = num_workers or os.cpu_count()
+
+        self.params = [as_tensor(param) for param in model.params()]
+        self.size = total_size(self.params)
+        self.typecode = params_typecode(self.params)
+        nbytes = array(self.typecode).itemsize * max(self.size, 1)
+
+        self.params_memory = SharedMemory(create=True, size=nbytes)
+        self.grads_memory = SharedMemory(create=True, size=nbytes * self.num_workers)
+        self.shared_params = self.params_memory.buf.cast(self.typecode)
+        attach(self.params, self.shared_params, copy=True)
+
+        # Summed gradients, with one view per parameter.
+        self.reduced = Tensor.from_buffer(array("d", [0.0]) * self.size, (self.size,))
+        grads, offset = [], 0
+        for param in self.params:
+            grads.append(Tensor.from_buffer(self.reduced.data, param.shape, offset))
+            offset += param.size
+        self.layer = _ReducedGradients(self.params, grads)
+
+        self.pool = Pool(self.num_workers,
+                         initializer=_start_worker,
+                         initargs=(model, loss, images, labels,
+                                   self.params_memory, self.grads_memory, seed))
+
+    def __enter__(self) -> "DataParallelTrainer":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.pool.close()
+        self.pool.join()
+
+        # Give the parameters their own storage again before freeing the block.
+        for param in self.params:
+            param.rebind(array(param.typecode, param.values()))
+        self.shared_params.release()
+
+        self.params_memory.close()
+        self.params_memory.unlink()
+        self.grads_memory.close()
+        self.grads_memory.unlink()
+
+    def _all_reduce(self, num_shards: int, batch_size: int) -> None:
+        grads = self.grads_memory.buf.cast(self.typecode)
+        P = self.size
+
+        if get_backend() == "numpy":
+            slots = np.asarray(grads[:num_shards * P]).reshape(num_shards, P)
+            reduced = np.asarray(self.reduced.values())
+            np.sum(slots, axis=0, out=reduced, dtype=np.float64)
+            reduced /= batch_size
+            del slots, reduced
+        else:
+            slots = [grads[slot * P:(slot + 1) * P] for slot in range(num_shards)]
+            self.reduced.assign(Tensor([sum(column) / batch_size
+                                        for column in zip(*slots)],
+                                       (P,)))
+            for slot in slots:
+                slot.release()
+
+        grads.release()
+
+    def step(self, start: int, end: int) -> Tuple[float, int]:
+        """
+        Trains on images[start:end]. Returns the total loss and the number of
+        correct predictions.
+        """
+
+        shard_size = math.ceil((end - start) / self.num_workers)
+        tasks = [(slot, shard_start, min(shard_start + shard_size, end))
+                 for slot, shard_start in enumerate(range(start, end, shard_size))]
+
+        results = self.pool.map(_shard_gradients, tasks)
+
+        self._all_reduce(len(tasks), end - start)
+        self.optimizer.step(self.layer)
+
+        return (sum(shard_loss for shard_loss, _ in results),
+                sum(correct for _, correct in results))
+
+    def epoch(self, batch_size: int=32) -> Tuple[float, float]:
+        """
+        One pass through the data. Returns the average loss and the accuracy.
+        """
+
+        correct = 0
+        total_loss = 0.0
+
+        with tqdm.trange(0, len(self.images), batch_size) as t:
+            for start in t:
+                end = min(start + batch_size, len(self.images))
+                batch_loss, batch_correct = self.step(start, end)
+                total_loss += batch_loss
+                correct += batch_correct
+                t.set_description(f"loss: {total_loss / end:.3f} "
+                                  f"acc: {correct / end:.3f}")
+
+        return total_loss / len(self.images), correct / len(self.images)
+
+# Because every multiprocessing start method other than "fork" re-imports this
+# module in each worker, the demo has to be guarded. It checks that training
+# on 4 workers takes the same steps as training in a single process:
+
+if __name__ == "__main__":
+    from scratch.deep_learning.neural_networks_as_a_sequence_of_layers import Sequential
+    from scratch.deep_learning.the_linear_layer import Linear
+    from scratch.deep_learning.other_activation_functions import Tanh
+    from scratch.deep_learning.loss_and_optimization import Momentum, SSE
+    from scratch.deep_learning.the_tensor import tensor_apply
+
+    random.seed(0)
+    xs = [[random.random() for _ in range(20)] for _ in range(256)]
+    ys = [[1.0, 0.0] if sum(x) > 10 else [0.0, 1.0] for x in xs]
+
+    def make_model() -> Layer:
+        random.seed(1)
+        return Sequential([Linear(20, 8), Tanh(), Linear(8, 2)])
+
+    serial = make_model()
+    serial_optimizer = Momentum(0.1, 0.9)
+    for start in range(0, len(xs), 64):
+        batch_x, batch_y = Tensor(xs[start:start + 64]), Tensor(ys[start:start + 64])
+        predicted = serial.forward(batch_x)
+        gradient = SSE().gradient(predicted, batch_y)
+        serial.backward(tensor_apply(lambda g: g / len(batch_x), gradient))
+        serial_optimizer.step(serial)
+
+    parallel = make_model()
+    with DataParallelTrainer(parallel, SSE(), Momentum(0.1, 0.9), xs, ys,
+                             num_workers=4) as trainer:
+        trainer.epoch(batch_size=64)
+
+    for p1, p2 in zip(serial.params(), parallel.params()):
+        assert all(abs(a - b) < 1e-9 for a, b in zip(p1.values(), p2.values()))
+    print("data parallel training matches serial training")
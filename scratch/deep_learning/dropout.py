@@ -1,8 +1,11 @@
 import random
 from operator import mul
+from typing import Any, Dict, List
 
-from scratch.deep_learning.the_layer_abstraction import Layer
-from scratch.deep_learning.the_tensor import Tensor, tensor_apply, tensor_combine
+from scratch.deep_learning.the_layer_abstraction import Layer, Sigmoid
+from scratch.deep_learning.the_tensor import Tensor, as_tensor, tensor_apply, tensor_combine
+from scratch.deep_learning.the_linear_layer import Linear
+from scratch.deep_learning.neural_networks_as_a_sequence_of_layers import Sequential
 
 
 # Like most machine learning models, neural networks are prone to overfitting to
@@ -47,4 +50,93 @@ class Dropout(Layer):
         else:
             raise RuntimeError("don't call backward when not in train mode")
 
+    def predict(self, input: Tensor) -> Tensor:
+        """
+        Predictions are what we make at evaluation time, so never drop out.
+        """
+
+        input = as_tensor(input)
+        return tensor_apply(lambda x: x * (1 - self.p), input,
+                            out=self.output_buffer(input.shape))
+
+    def config(self) -> Dict[str, Any]:
+        return {"p": self.p}
+
+# Scaling every output by the same (1 - p) is still a pass over the whole
+# tensor, though, and a Linear layer right next to the Dropout can do it for
+# free: scaling the inputs of a Linear layer is the same as scaling its weights,
+# and scaling its outputs is the same as scaling its weights and its bias. So
+# for inference we can fold each Dropout into a neighboring Linear layer (a
+# copy of it, so that the model we're training doesn't change) and drop the
+# Dropout layer altogether:
+
+def fold_dropout(model: Sequential) -> Sequential:
+    """
+    An equivalent model for inference, with each Dropout that directly follows
+    or precedes a Linear layer folded into (a copy of) that layer.
+    """
+
+    layers = list(model.layers)
+    folded: List[Layer] = []
+
+    for i, layer in enumerate(layers):
+        if not isinstance(layer, Dropout):
+            folded.append(layer)
+        elif folded and isinstance(folded[-1], Linear):
+            # Scale the outputs of the preceding layer.
+            folded[-1] = _scaled(folded[-1], 1 - layer.p, bias=True)
+        elif i + 1 < len(layers) and isinstance(layers[i + 1], Linear):
+            # Scale the inputs of the following layer.
+            layers[i + 1] = _scaled(layers[i + 1], 1 - layer.p, bias=False)
+        else:
+            folded.append(layer)
+
+    return Sequential(folded)
+
+def _scaled(linear: Linear, scale: float, bias: bool) -> Linear:
+    # A brand new layer (rather than a copy.copy) so that it shares nothing
+    # with the original, not even the buffer predict writes its output into.
+    # (Its random initial weights are thrown away, so we draw them from a
+    # throwaway rng instead of disturbing the global one.)
+    scaled = Linear(**linear.config(), rng=random.Random(0))
+    scaled.w = _times(linear.w, scale)
+    scaled.b = _times(linear.b, scale if bias else 1.0)
+    return scaled
+
+def _times(tensor: Tensor, scale: float) -> Tensor:
+    # (in a new Tensor with the same dtype)
+    return Tensor([x * scale for x in tensor.values()], tensor.shape, tensor.dtype)
+
 # We’ll use this to help prevent our deep learning models from overfitting.
+
+random.seed(0)
+dropout_net = Sequential([Linear(4, 3), Dropout(0.1), Linear(3, 3), Dropout(0.2),
+                          Sigmoid(), Dropout(0.5), Linear(3, 2), Dropout(0.3),
+                          Sigmoid(), Dropout(0.4), Sigmoid()])
+inference_net = fold_dropout(dropout_net)
+
+# Only the Dropout between the two Sigmoids has no Linear layer to fold into:
+assert [type(layer) for layer in inference_net.layers] == [
+    Linear, Linear, Sigmoid, Linear, Sigmoid, Dropout, Sigmoid]
+
+x = [[1, 2, 3, 4], [0, -1, 0, 1]]
+for layer in dropout_net.layers:
+    if isinstance(layer, Dropout):
+        layer.train = False
+assert all(abs(a - b) < 1e-12
+           for a, b in zip(inference_net.predict(x).values(),
+                           as_tensor(dropout_net.forward(x)).values()))
+
+
+# The folded copies share nothing with the original layers, so predicting with
+# one model doesn't overwrite an output we already got from the other:
+
+for model in [Sequential([Linear(4, 3), Dropout(0.5)]),
+              Sequential([Dropout(0.5), Linear(4, 3)])]:
+    model.predict(x)
+    folded = fold_dropout(model)
+    folded_output = folded.predict(x)
+    expected = folded_output.tolist()
+    model.predict([[0, 0, 0, 0], [1, 1, 1, 1]])
+    assert folded_output.tolist() == expected
+    assert not set(map(id, folded.params())) & set(map(id, model.params()))
@@ -2,10 +2,10 @@ from typing import List
 import random
 
 import tqdm
-import mnist
 import matplotlib.pyplot as plt
 
-from scratch.deep_learning.the_tensor import shape, tensor_sum, Tensor
+from scratch.deep_learning.the_tensor import shape, tensor_sum, tensor_apply, Tensor, as_tensor
+from scratch.deep_learning.loading_mnist import MnistImages, MnistLabels, mnist_file
 from scratch.deep_learning.the_layer_abstraction import Layer
 from scratch.deep_learning.neural_networks_as_a_sequence_of_layers import Sequential
 from scratch.deep_learning.loss_and_optimization import Loss, Optimizer, Momentum
@@ -13,28 +13,28 @@ from scratch.deep_learning.the_linear_layer import Linear
 from scratch.deep_learning.softmaxes_and_cross_entropy import SoftmaxCrossEntropy
 from scratch.deep_learning.other_activation_functions import Tanh
 from scratch.deep_learning.dropout import Dropout
+from scratch.deep_learning.profiling_layers import Profiler
+from scratch.deep_learning.training import Trainer, EarlyStopping, Checkpoint, warmup, cosine
+from scratch.deep_learning.convolutional_layers import Conv2D, MaxPool2D, Flatten, Reshape
+from scratch.linear_algebra.backends import use_backend
 from scratch.neural_networks.example_fizz_buzz import argmax
 
 # MNIST is a dataset of handwritten digits that everyone uses to learn deep learning.
-# It is available in a somewhat tricky binary format, so we’ll install the mnist 
-# library to work with it.
+# It is available in a somewhat tricky binary format, which we read with the
+# loaders in loading_mnist.py (from the mnist/ directory at the top of the repo):
 
-# And then we can load the data:
+train_images = MnistImages(mnist_file("train", "images"))
+train_labels = MnistLabels(mnist_file("train", "labels"))
 
-mnist.temporary_dir = lambda: "/workspaces/data-science-from-scratch/data-science-from-scratch/mnist"
-
-train_images = mnist.train_images().tolist()
-train_labels = mnist.train_labels().tolist()
-
-assert shape(train_images) == [60000, 28, 28]
-assert shape(train_labels) == [60000]
+assert len(train_images) == 60000 and train_images.image_shape == (28, 28)
+assert len(train_labels) == 60000
 
 # Let’s plot the first 100 training images to see what they look like
 fig, ax = plt.subplots(10, 10)
 
 for i in range(10):
     for j in range(10):
-        ax[i][j].imshow(train_images[10 * i + j], cmap="Greys")
+        ax[i][j].imshow(train_images.image(10 * i + j), cmap="Greys")
         ax[i][j].xaxis.set_visible(False)
         ax[i][j].yaxis.set_visible(False)
 plt.show()
@@ -42,25 +42,23 @@ plt.show()
 # Each image is 28 × 28 pixels, but our linear layers can only deal with
 # one-dimensional inputs, so we’ll just flatten them (and also divide by 256 to 
 # get them between 0 and 1). In addition, our neural net will train better if our 
-# inputs are 0 on average, so we’ll subtract out the average value:
-
-# Compute the average pixel value
-avg = tensor_sum(train_images) / 60000 / 28 / 28
+# inputs are 0 on average, so we’ll subtract out the average value.
 
-test_images = mnist.test_images().tolist()
-test_labels = mnist.test_labels().tolist()
+# MnistImages does all of that for us whenever we ask it for some images, using
+# the average pixel value of the training images (which is why we pass it along
+# to the test images):
 
-# Recenter, rescale, and flatten
-train_images = [[(pixel - avg) / 256 for row in image for pixel in row]
-                for image in train_images]
-test_images = [[(pixel - avg) / 256 for row in image for pixel in row]
-                for image in test_images]
+test_images = MnistImages(mnist_file("t10k", "images"), mean=train_images.mean)
+test_labels = MnistLabels(mnist_file("t10k", "labels"))
 
-assert shape(train_images) == [60000, 784], "images should be flattened"
-assert shape(test_images) == [10000, 784], "images should be flattened"
+assert shape(train_images[:10]) == [10, 784], "images should be flattened"
+assert shape(test_images[:10]) == [10, 784], "images should be flattened"
 
-# After centering, average pixel should be very close to 0
-assert -0.0001 < tensor_sum(train_images) < 0.0001
+# After centering, average pixel should be very close to 0 (we add it up a
+# thousand images at a time, so that we never hold all of them as floats)
+total = sum(tensor_sum(train_images[start:start + 1000])
+            for start in range(0, len(train_images), 1000))
+assert -0.0001 < total / 60000 / 784 < 0.0001
 
 # We also want to one-hot-encode the targets, since we have 10 outputs. First 
 # let’s write a one_hot_encode function:
@@ -71,43 +69,77 @@ def one_hot_encode(i: int, num_labels: int=10) -> List[float]:
 assert one_hot_encode(3) == [0, 0, 0, 1, 0, 0, 0, 0, 0, 0]
 assert one_hot_encode(2, num_labels=5) == [0, 0, 1, 0, 0]
 
-# and then apply it to our data:
-train_labels = [one_hot_encode(label) for label in train_labels]
-test_labels = [one_hot_encode(label) for label in test_labels]
+# MnistLabels encodes the labels the same way whenever we ask for some:
+
+assert test_labels[0] == one_hot_encode(7)
+assert shape(train_labels[:10]) == [10, 10]
+
+# But SoftmaxCrossEntropy is happy to take the labels themselves, which is
+# cheaper still, so that's what we'll train with:
 
-assert shape(train_labels) == [60000, 10]
-assert shape(test_labels) == [10000, 10]
+train_labels = MnistLabels(mnist_file("train", "labels"), one_hot=False)
+test_labels = MnistLabels(mnist_file("t10k", "labels"), one_hot=False)
+
+assert test_labels[0] == 7 and len(train_labels[:10]) == 10
 
 # One of the strengths of our abstractions is that we can use the same 
 # training/evaluation loop with a variety of models. So let’s write that first. 
 # We’ll pass it our model, the data, a loss function, and (if we’re training) 
 # an optimizer. It will make a pass through our data, track performance, and
-# (if we passed in an optimizer) update our parameters:
+# (if we passed in an optimizer) update our parameters.
+
+# Rather than one example at a time, we’ll feed the model minibatches of 
+# batch_size examples stacked into a single tensor. Our layers sum their 
+# parameter gradients over the batch, so we divide the loss gradient by the 
+# batch size to make each step the average of the per-example steps (which 
+# means batch_size=1 behaves exactly like training one example at a time):
+
+# The labels can be one-hot vectors or (for SoftmaxCrossEntropy) the class
+# labels themselves:
+
+def class_of(label) -> int:
+    return label if isinstance(label, int) else argmax(label)
 
 def loop(model: Layer,
          images: List[Tensor],
-         labels: List[Tensor],
+         labels: List,
          loss: Loss,
-         optimizer: Optimizer=None) -> None:
+         optimizer: Optimizer=None,
+         batch_size: int=1) -> None:
     correct = 0
     total_loss = 0.0
 
-    with tqdm.trange(len(images)) as t:
-        for i in t:
-            predicted = model.forward(images[i])             # Predict.
-            if argmax(predicted) == argmax(labels[i]):       # Check for
-                correct += 1                                 # correctness.
-            total_loss += loss.loss(predicted, labels[i])    # Compute loss.
+    with tqdm.trange(0, len(images), batch_size) as t:
+        for start in t:
+            batch_images = as_tensor(images[start:start + batch_size])
+            batch_labels = labels[start:start + batch_size]
+            seen = start + len(batch_images)
 
-            # If we're training, backpropagate gradient and update weights.
+            # Predict. (If we're only evaluating, nothing needs to be saved
+            # for backward, so we can use the cheaper predict.)
             if optimizer is not None:
-                gradient = loss.gradient(predicted, labels[i])
-                model.backward(gradient)
+                predicted = model.forward(batch_images)
+            else:
+                predicted = model.predict(batch_images)
+
+            for p, label in zip(predicted, batch_labels):      # Check for
+                if argmax(p) == class_of(label):               # correctness.
+                    correct += 1
+
+            # If we're training, compute the loss and its gradient together,
+            # backpropagate the gradient and update weights.
+            if optimizer is not None:
+                batch_loss, gradient = loss.loss_and_gradient(predicted, batch_labels)
+                total_loss += batch_loss
+                n = len(batch_images)
+                model.backward(tensor_apply(lambda g: g / n, gradient))
                 optimizer.step(model)
+            else:
+                total_loss += loss.loss(predicted, batch_labels)
 
             # And update our metrics in the progress bar.
-            avg_loss = total_loss / (i + 1)
-            acc = correct / (i + 1)
+            avg_loss = total_loss / seen
+            acc = correct / seen
             t.set_description(f"mnist loss: {avg_loss:.3f} acc: {acc:.3f}")
 
 random.seed(0)
@@ -144,13 +176,57 @@ model = Sequential([
 optimizer = Momentum(learning_rate=0.01, momentum=0.99)
 loss = SoftmaxCrossEntropy()
 
-# Enable dropout and train (takes > 20 minutes on my laptop!)
+# Enable dropout and train (takes > 20 minutes on my laptop one example at a 
+# time; minibatches of 32 go a lot faster)
 dropout1.train = dropout2.train = True
-# loop(model, train_images, train_labels, loss, optimizer)
+# loop(model, train_images, train_labels, loss, optimizer, batch_size=32)
+
+# If training seems slow, profiling_layers.py can tell us which layers (and
+# which of forward, backward, and the optimizer step) the time goes to:
+
+# profiler = Profiler()
+# with profiler.profile(model, optimizer, loss):
+#     loop(model, train_images[:3200], train_labels[:3200], loss, optimizer, batch_size=32)
+# profiler.print_report()
+# profiler.save_report("mnist_profile.json")
 
 # Disable dropout and evaluate
 dropout1.train = dropout2.train = False
-# loop(model, test_images, test_labels, loss)
+# loop(model, test_images, test_labels, loss, batch_size=32)
 
 # Our deep model gets better than 92% accuracy on the test set, which is a nice 
-# improvement from the simple logistic model.
\ No newline at end of file
+# improvement from the simple logistic model.
+
+# Rather than guessing how many epochs to train for, we can hand the same model
+# to a Trainer (see training.py), which holds out some of the training data,
+# decays the learning rate, stops once the loss on the held-out data stops
+# improving, and puts back the best parameters it saw (it also switches the
+# dropout layers between training and evaluation by itself):
+
+# trainer = Trainer(model, loss, Momentum(0.01, 0.9),
+#                   schedule=warmup(cosine(0.01, 20 * 1700), 100),
+#                   callbacks=[EarlyStopping(patience=2),
+#                              Checkpoint("mnist.ckpt", monitor="val_loss")])
+# trainer.fit(list(train_images), list(train_labels), epochs=20, validation_pct=0.1)
+# trainer.evaluate(test_images[:], test_labels[:])
+
+# We can do better still, with fewer parameters, by not flattening the images
+# at all. A small convolutional network (see convolutional_layers.py) with
+# about 9,000 parameters, a third as many as the network above, beats it
+# after the same number of epochs (and, with the numpy backend, trains faster):
+
+cnn = Sequential([
+    Reshape(1, 28, 28),                     # (batch, 784) -> (batch, 1, 28, 28)
+    Conv2D(1, 8, kernel_size=3, padding=1),
+    Tanh(),
+    MaxPool2D(2),                           # -> (batch, 8, 14, 14)
+    Conv2D(8, 16, kernel_size=3, padding=1),
+    Tanh(),
+    MaxPool2D(2),                           # -> (batch, 16, 7, 7)
+    Flatten(),
+    Linear(16 * 7 * 7, 10)
+])
+
+# with use_backend("numpy"):
+#     loop(cnn, train_images, train_labels, loss, Momentum(0.05, 0.9), batch_size=32)
+#     loop(cnn, test_images, test_labels, loss, batch_size=32)
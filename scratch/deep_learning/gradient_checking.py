@@ -0,0 +1,230 @@
+from typing import Any, Dict, List, Sequence, Tuple
+from operator import mul
+import random
+import time
+
+from scratch.linear_algebra.backends import use_backend, np
+from scratch.probability.sampling import normal_samples
+from scratch.deep_learning.the_tensor import Tensor, as_tensor
+from scratch.deep_learning.the_layer_abstraction import Layer, Sigmoid
+from scratch.deep_learning.the_linear_layer import Linear
+from scratch.deep_learning.other_activation_functions import Tanh, Relu
+from scratch.deep_learning.neural_networks_as_a_sequence_of_layers import Sequential
+from scratch.deep_learning.convolutional_layers import Conv2D, MaxPool2D, Flatten, Reshape
+
+
+# Every time we make a layer's backward faster, we risk making it wrong, and a
+# wrong gradient doesn't crash anything: the network just trains worse. So
+# before trusting a new backward, we should compare it with the gradient we get
+# by nudging each input (and each parameter) a little and seeing how much the
+# output changes, like estimate_gradient did back in the gradient descent
+# chapter.
+
+# A layer's output is a whole tensor, not a number, so we'll check the gradient
+# of the dot product of the output with some fixed random output_gradient.
+# That's exactly what backward(output_gradient) is supposed to compute. And
+# we'll use central differences, (f(x + h) - f(x - h)) / 2h, whose error
+# shrinks like h² instead of h.
+
+# Checking one input at a time would take two forward passes per input. But
+# our layers treat the examples in a batch independently, so we can make a
+# single batch out of every nudged copy of every example and get all of the
+# input gradients from one forward pass. (This doesn't work for the
+# parameters, which every example shares, so those take two passes apiece.
+# It also doesn't work for layers that are random, like Dropout in training
+# mode.)
+
+def random_input(shape: Sequence[int], rng: random.Random) -> Tensor:
+    size = 1
+    for dim in shape:
+        size *= dim
+    return Tensor.from_buffer(normal_samples(size, rng=rng), shape)
+
+def _dot(xs, ys) -> float:
+    return sum(map(mul, xs, ys))
+
+def numerical_input_gradient(layer: Layer,
+                             input: Tensor,
+                             output_gradient: Tensor,
+                             h: float=1e-6) -> Tensor:
+    batch_size = input.shape[0]
+    features = input.size // batch_size
+    x = input.values()
+
+    # Rows 2k and 2k + 1 are example k // features with feature k % features
+    # nudged up and down, respectively.
+    nudged = []
+    for b in range(batch_size):
+        example = list(x[b * features:(b + 1) * features])
+        for f in range(features):
+            for delta in (h, -h):
+                row = example.copy()
+                row[f] += delta
+                nudged.extend(row)
+
+    outputs = as_tensor(layer.forward(Tensor(nudged, (2 * batch_size * features,)
+                                                   + input.shape[1:]))).values()
+    g = output_gradient.values()
+    out_features = output_gradient.size // batch_size
+
+    gradient = []
+    for row in range(0, 2 * batch_size * features, 2):
+        b = row // (2 * features)
+        g_b = g[b * out_features:(b + 1) * out_features]
+        up = _dot(outputs[row * out_features:(row + 1) * out_features], g_b)
+        down = _dot(outputs[(row + 1) * out_features:(row + 2) * out_features], g_b)
+        gradient.append((up - down) / (2 * h))
+    return Tensor(gradient, input.shape)
+
+def numerical_param_gradient(layer: Layer,
+                             input: Tensor,
+                             output_gradient: Tensor,
+                             param: Tensor,
+                             h: float=1e-6) -> Tensor:
+    def objective() -> float:
+        return _dot(as_tensor(layer.forward(input)).values(), output_gradient.values())
+
+    values = param.values()
+    gradient = []
+    for i in range(param.size):
+        original = values[i]
+        values[i] = original + h
+        up = objective()
+        values[i] = original - h
+        down = objective()
+        values[i] = original
+        gradient.append((up - down) / (2 * h))
+    return Tensor(gradient, param.shape)
+
+# To compare gradients that might be large or tiny, we use the relative error
+# (but measured against at least 1, so that two nearly-zero gradients count as
+# equal):
+
+def max_relative_error(t1: Tensor, t2: Tensor) -> float:
+    t1, t2 = as_tensor(t1), as_tensor(t2)
+    if t1.shape != t2.shape:
+        raise ValueError(f"shapes {list(t1.shape)} and {list(t2.shape)} don't match")
+    return max((abs(a - b) / max(1.0, abs(a), abs(b))
+                for a, b in zip(t1.values(), t2.values())),
+               default=0.0)
+
+def check_gradients(layer: Layer,
+                    input_shape: Sequence[int],
+                    h: float=1e-6,
+                    rng: random.Random=None) -> Dict[str, float]:
+    """
+    Runs the layer forward and backward on a random batch of the given shape
+    and returns the largest relative error of its input gradient ("input") and
+    each of its parameter gradients ("param 0", "param 1", ...) compared with
+    central differences.
+    """
+
+    rng = rng or random.Random(0)
+    input = random_input(input_shape, rng)
+    output = as_tensor(layer.forward(input))
+    output_gradient = random_input(output.shape, rng)
+
+    # Copy everything backward gives us before we run forward again.
+    input_gradient = Tensor(as_tensor(layer.backward(output_gradient)))
+    param_gradients = [Tensor(as_tensor(grad)) for grad in layer.grads()]
+
+    errors = {"input": max_relative_error(
+        input_gradient, numerical_input_gradient(layer, input, output_gradient, h))}
+    for i, (param, grad) in enumerate(zip(layer.params(), param_gradients)):
+        numerical = numerical_param_gradient(layer, input, output_gradient,
+                                             as_tensor(param), h)
+        errors[f"param {i}"] = max_relative_error(grad, numerical)
+    return errors
+
+# Here's a layer of each kind we have, with a small input shape for each:
+
+def layer_cases() -> List[Tuple[Layer, Tuple[int, ...]]]:
+    return [
+        (Linear(5, 4), (3, 5)),
+        (Sigmoid(), (3, 4)),
+        (Tanh(), (3, 4)),
+        (Relu(), (3, 4)),
+        (Conv2D(2, 3, kernel_size=3, stride=2, padding=1), (2, 2, 5, 5)),
+        (MaxPool2D(2), (2, 2, 4, 4)),
+        (Flatten(), (2, 2, 3, 3)),
+        (Reshape(3, 2), (2, 6)),
+        (Sequential([Linear(4, 3), Tanh(), Linear(3, 2), Sigmoid()]), (3, 4)),
+    ]
+
+def available_backends() -> Tuple[str, ...]:
+    return ("python", "numpy") if np is not None else ("python",)
+
+def check_all_layers(tolerance: float=1e-6) -> List[Dict[str, Any]]:
+    """
+    Checks every case on every backend and returns one row per check. Raises
+    an AssertionError if any gradient is off by more than tolerance.
+    """
+
+    rows = []
+    for backend in available_backends():
+        with use_backend(backend):
+            random.seed(0)
+            for layer, input_shape in layer_cases():
+                for gradient, error in check_gradients(layer, input_shape).items():
+                    rows.append({"layer": type(layer).__name__, "backend": backend,
+                                 "gradient": gradient, "error": error})
+                    assert error < tolerance, rows[-1]
+    return rows
+
+# The same machinery is handy for measuring how fast a layer is. benchmark
+# times forward and backward on the same random batch on each backend, so the
+# numbers are directly comparable:
+
+def benchmark(layer: Layer,
+              input_shape: Sequence[int],
+              repeat: int=5,
+              backends: Sequence[str]=None) -> List[Dict[str, Any]]:
+    """
+    The best of repeat timings (in milliseconds) of forward and backward on a
+    batch of the given shape, for each backend.
+    """
+
+    rng = random.Random(0)
+    input = random_input(input_shape, rng)
+    output_gradient = random_input(as_tensor(layer.forward(input)).shape, rng)
+
+    rows = []
+    for backend in backends or available_backends():
+        with use_backend(backend):
+            forward_times, backward_times = [], []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                layer.forward(input)
+                middle = time.perf_counter()
+                layer.backward(output_gradient)
+                end = time.perf_counter()
+                forward_times.append(middle - start)
+                backward_times.append(end - middle)
+
+        forward_ms, backward_ms = 1000 * min(forward_times), 1000 * min(backward_times)
+        rows.append({"layer": type(layer).__name__,
+                     "input_shape": list(input_shape),
+                     "backend": backend,
+                     "forward_ms": forward_ms,
+                     "backward_ms": backward_ms,
+                     "examples_per_second": 1000 * input_shape[0] / (forward_ms + backward_ms)})
+    return rows
+
+# Every layer passes:
+
+check_all_layers()
+
+# and (if you run this file) here's how they compare on MNIST-sized batches:
+
+if __name__ == "__main__":
+    cases = [(Linear(784, 30), (32, 784)),
+             (Tanh(), (32, 784)),
+             (Conv2D(1, 8, kernel_size=3, padding=1), (32, 1, 28, 28)),
+             (MaxPool2D(2), (32, 8, 28, 28))]
+
+    print(f"{'layer':<10}{'backend':<10}{'forward ms':>12}{'backward ms':>13}"
+          f"{'examples/s':>12}")
+    for layer, input_shape in cases:
+        for row in benchmark(layer, input_shape, repeat=3):
+            print(f"{row['layer']:<10}{row['backend']:<10}{row['forward_ms']:>12.2f}"
+                  f"{row['backward_ms']:>13.2f}{row['examples_per_second']:>12.0f}")
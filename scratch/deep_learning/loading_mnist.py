@@ -0,0 +1,219 @@
+from typing import Iterator, List, Tuple
+from array import array
+import gzip
+import mmap
+import os
+import struct
+import tempfile
+
+from scratch.deep_learning.the_tensor import Tensor
+
+
+# The MNIST files come in the "IDX" format: a few header bytes that say what
+# type the values are and how many dimensions there are, one big-endian 32-bit
+# integer per dimension, and then all of the values. Each pixel (and each label)
+# is a single unsigned byte, so the whole training set is only 47MB.
+
+# Turning that into nested lists of Python floats (as the mnist library's
+# .tolist() does) costs several GB before we even start training. Instead we'll
+# read the files ourselves, keep the pixels as bytes, and only turn a minibatch
+# into floats when someone asks for it.
+
+MNIST_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "mnist")
+
+def mnist_file(kind: str, what: str) -> str:
+    """
+    The path of the (gzipped) file with the "images" or "labels" for the
+    "train" or "t10k" (test) set.
+    """
+
+    rank = 3 if what == "images" else 1
+    return os.path.join(MNIST_DIR, f"{kind}-{what}-idx{rank}-ubyte.gz")
+
+def read_idx_header(f) -> Tuple[int, ...]:
+    """
+    Reads the header from the (open) file and returns the shape of the values.
+    """
+
+    zero1, zero2, dtype, rank = f.read(4)
+    if zero1 != 0 or zero2 != 0:
+        raise ValueError("not an IDX file")
+    if dtype != 0x08:
+        raise ValueError(f"only unsigned bytes are supported, not {dtype:#x}")
+    return struct.unpack(f">{rank}I", f.read(4 * rank))
+
+def read_idx(filename: str) -> Tuple[Tuple[int, ...], bytes]:
+    with gzip.open(filename) as f:
+        dims = read_idx_header(f)
+        return dims, f.read()
+
+def stream_idx(filename: str, records: int) -> Iterator[bytes]:
+    """
+    Reads the file a chunk of (up to) records records at a time, so that only
+    one chunk is ever in memory.
+    """
+
+    with gzip.open(filename) as f:
+        dims = read_idx_header(f)
+        record_size = 1
+        for dim in dims[1:]:
+            record_size *= dim
+
+        for _ in range(0, dims[0], records):
+            yield f.read(records * record_size)
+
+# To center and rescale a batch lazily, notice that a pixel can only take 256
+# different values, so we can compute what each of them turns into once and then
+# just look them up:
+
+def pixel_table(mean: float) -> List[float]:
+    return [(pixel - mean) / 256 for pixel in range(256)]
+
+def normalize(pixels: bytes, table: List[float]) -> array:
+    return array("d", map(table.__getitem__, pixels))
+
+class MnistImages:
+    """
+    The images from an IDX file, kept as raw bytes. Indexing (with an int or a
+    slice) gives back flattened, recentered and rescaled images as a Tensor.
+    """
+
+    def __init__(self, filename: str, mean: float=None) -> None:
+        (self.count, *dims), self.pixels = read_idx(filename)
+        self.image_shape = tuple(dims)
+        self.image_size = len(self.pixels) // self.count
+
+        # Test images get recentered by the mean of the *training* images.
+        self.mean = sum(self.pixels) / len(self.pixels) if mean is None else mean
+        self.table = pixel_table(self.mean)
+        self.cached = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def image(self, i: int) -> List[List[int]]:
+        """
+        The raw pixels of image i, as rows (for plotting).
+        """
+
+        pixels = self.pixels[i * self.image_size:(i + 1) * self.image_size]
+        width = self.image_shape[-1]
+        return [list(pixels[j:j + width]) for j in range(0, len(pixels), width)]
+
+    def __getitem__(self, index) -> Tensor:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.count)
+            if step != 1:
+                raise ValueError("only contiguous slices are supported")
+            shape = (max(0, stop - start), self.image_size)
+        else:
+            start = index + self.count if index < 0 else index
+            if not 0 <= start < self.count:
+                raise IndexError("image index out of range")
+            stop = start + 1
+            shape = (self.image_size,)
+
+        if self.cached is not None:
+            return Tensor.from_buffer(self.cached, shape, start * self.image_size)
+
+        pixels = self.pixels[start * self.image_size:stop * self.image_size]
+        return Tensor.from_buffer(normalize(pixels, self.table), shape)
+
+    # Normalizing a batch is quick, but it does happen on every pass over the
+    # data. If you'd rather do it once, cache() writes every normalized image to
+    # a file (the mean first, then the pixels as doubles) and memory-maps it, so
+    # that later batches are just views into the file. (Only do this if you have
+    # room for it: it's 8 bytes per pixel, or 376MB for the training set.)
+
+    def cache(self, filename: str) -> None:
+        size = 8 * (1 + len(self.pixels))
+
+        if not (os.path.exists(filename)
+                and os.path.getsize(filename) == size
+                and _cached_mean(filename) == self.mean):
+            with open(filename, "wb") as f:
+                f.write(struct.pack("d", self.mean))
+                chunk = 1000 * self.image_size
+                for start in range(0, len(self.pixels), chunk):
+                    normalize(self.pixels[start:start + chunk], self.table).tofile(f)
+
+        with open(filename, "rb") as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.cached = memoryview(mapping)[8:].cast("d")
+
+def _cached_mean(filename: str) -> float:
+    with open(filename, "rb") as f:
+        mean, = struct.unpack("d", f.read(8))
+    return mean
+
+# The labels are digits, which we'll one-hot encode (again lazily):
+
+def one_hot_encode(labels: bytes, num_labels: int=10) -> Tensor:
+    one_hot = array("d", [0.0]) * (len(labels) * num_labels)
+    for i, label in enumerate(labels):
+        one_hot[i * num_labels + label] = 1.0
+    return Tensor.from_buffer(one_hot, (len(labels), num_labels))
+
+class MnistLabels:
+    """
+    The labels from an IDX file. Indexing gives back one-hot encoded Tensors,
+    or (if one_hot is False) the labels themselves: an int, or bytes for a
+    slice, which is all that SoftmaxCrossEntropy needs.
+    """
+
+    def __init__(self, filename: str, num_labels: int=10, one_hot: bool=True) -> None:
+        (self.count,), self.labels = read_idx(filename)
+        self.num_labels = num_labels
+        self.one_hot = one_hot
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index):
+        if not self.one_hot:
+            return self.labels[index]
+        if isinstance(index, slice):
+            return one_hot_encode(self.labels[index], self.num_labels)
+        return one_hot_encode(bytes([self.labels[index]]), self.num_labels)[0]
+
+# Finally, if we don't even want the 47MB of raw pixels in memory, we can read
+# minibatches straight out of the gzipped files:
+
+def stream_minibatches(kind: str,
+                       batch_size: int,
+                       mean: float) -> Iterator[Tuple[Tensor, Tensor]]:
+    table = pixel_table(mean)
+
+    for pixels, labels in zip(stream_idx(mnist_file(kind, "images"), batch_size),
+                              stream_idx(mnist_file(kind, "labels"), batch_size)):
+        shape = (len(labels), len(pixels) // len(labels))
+        yield (Tensor.from_buffer(normalize(pixels, table), shape),
+               one_hot_encode(labels))
+
+# The repository only includes the test images, so that's what we check:
+
+if os.path.exists(mnist_file("t10k", "images")):
+    test_images = MnistImages(mnist_file("t10k", "images"), mean=33.0)
+    test_labels = MnistLabels(mnist_file("t10k", "labels"))
+
+    assert len(test_images) == len(test_labels) == 10000
+    assert test_images.image_shape == (28, 28)
+    assert test_images[:5].shape == (5, 784) and test_images[3].shape == (784,)
+    assert test_images[3] == test_images[3:4][0]
+    assert test_labels[:2].tolist() == [[0, 0, 0, 0, 0, 0, 0, 1, 0, 0],
+                                        [0, 0, 1, 0, 0, 0, 0, 0, 0, 0]]
+    assert MnistLabels(mnist_file("t10k", "labels"), one_hot=False)[:2] == bytes([7, 2])
+
+    images, labels = next(stream_minibatches("t10k", 5, mean=33.0))
+    assert images == test_images[:5] and labels == test_labels[:5]
+
+# Caching writes out all 10,000 normalized test images (63MB of doubles), which
+# is too much to do every time this module gets imported, so that check only
+# runs if you run this file:
+
+if __name__ == "__main__" and os.path.exists(mnist_file("t10k", "images")):
+    with tempfile.TemporaryDirectory() as directory:
+        test_images.cache(os.path.join(directory, "t10k.cache"))
+        assert images == test_images[:5]
+        assert test_images[9999] == MnistImages(mnist_file("t10k", "images"), mean=33.0)[9999]
+        test_images.cached = None          # (so the file can be deleted)
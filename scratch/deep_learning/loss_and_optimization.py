@@ -1,7 +1,8 @@
-from typing import List
+from typing import Any, Dict, List, Tuple
 
+from scratch.linear_algebra.backends import get_backend, use_backend, np
 from scratch.deep_learning.the_tensor import Tensor, tensor_combine, tensor_sum, \
-    zeros_like
+    zeros_like, as_tensor
 from scratch.deep_learning.the_layer_abstraction import Layer
 
 # Previously we wrote out individual loss functions and gradient functions for 
@@ -25,6 +26,14 @@ class Loss:
 
         raise NotImplementedError
 
+    def loss_and_gradient(self, predicted: Tensor, actual: Tensor) -> Tuple[float, Tensor]:
+        """
+        Both at once, since training needs both. Losses that can share work
+        between the two should override this.
+        """
+
+        return self.loss(predicted, actual), self.gradient(predicted, actual)
+
 # We’ve already worked many times with the loss that’s the sum of the squared 
 # errors, so we should have an easy time implementing that. The only trick is 
 # that we’ll need to use tensor_combine:
@@ -62,7 +71,10 @@ class SSE(Loss):
 # descent, and we don’t want to have to rewrite them each time.
 
 # Accordingly, we’ll introduce a (you guessed it) Optimizer abstraction, of which 
-# gradient descent will be a specific instance:
+# gradient descent will be a specific instance. Some optimizers keep running 
+# statistics about the gradients they’ve seen, and if we stop training and want 
+# to pick it back up later we’ll need those too, so every optimizer lists the 
+# attributes that make up its state:
 
 class Optimizer:
     """
@@ -70,39 +82,141 @@ class Optimizer:
     known by either the layer or the optimizer (or by both)
     """
 
+    # Names of the attributes to checkpoint: numbers, or lists of Tensors
+    # (one per parameter).
+    state_attributes: Tuple[str, ...] = ("lr",)
+
     def step(self, layer: Layer):
         raise NotImplementedError
 
-# After that it’s easy to implement gradient descent, again using tensor_combine:
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        The optimizer's state, as plain (JSON-friendly) numbers and lists.
+        """
+
+        return {name: [tensor.tolist() for tensor in value]
+                      if isinstance(value, list) else value
+                for name in self.state_attributes
+                for value in [getattr(self, name)]}
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        for name in self.state_attributes:
+            value = state[name]
+            if isinstance(value, list):
+                value = [Tensor(tensor) for tensor in value]
+            setattr(self, name, value)
+
+    def _slots(self, name: str, layer: Layer) -> List[Tensor]:
+        """
+        The per-parameter state tensors called name, starting at all zeros.
+        """
+
+        if not getattr(self, name):
+            setattr(self, name, [zeros_like(as_tensor(grad)) for grad in layer.grads()])
+        return getattr(self, name)
+
+# Our optimizers will update every parameter on every step, so it’s worth 
+# making that fast. Rather than building a brand new tensor (with a lambda call 
+# per element) and copying it back into the parameter, we’ll write each update 
+# as a single loop that modifies the parameter’s buffer in place.
+
+# And if the numpy backend is selected (see scratch.linear_algebra.backends), 
+# we can do even better: np.asarray gives us an ndarray that shares a tensor’s 
+# buffer, and numpy’s in-place operations update it in compiled code. To avoid 
+# allocating temporary arrays on every step, the optimizer keeps one scratch 
+# array per parameter around to hold intermediate results:
+
+def as_ndarray(tensor: Tensor):
+    """
+    A writable ndarray view of the tensor's values (no copying).
+    """
+
+    return np.asarray(as_tensor(tensor).values())
+
+class FusedOptimizer(Optimizer):
+    """
+    An optimizer whose update is a kernel applied to each parameter, its
+    gradient, and its per-parameter state, with an ndarray version for the
+    numpy backend.
+    """
+
+    # Names of the per-parameter state tensors each kernel receives.
+    slot_names: Tuple[str, ...] = ()
+
+    def step(self, layer: Layer) -> None:
+        numpy = get_backend() == "numpy"
+        slots = [self._slots(name, layer) for name in self.slot_names]
+
+        for i, (original, grad) in enumerate(zip(layer.params(), layer.grads())):
+            param, grad = as_tensor(original), as_tensor(grad)
+            states = [slot[i] for slot in slots]
+            if numpy:
+                self.ndarray_kernel(as_ndarray(param),
+                                    as_ndarray(grad),
+                                    *[as_ndarray(state) for state in states],
+                                    scratch=self._scratch(i, param.size))
+            else:
+                self.kernel(param.values(),
+                            grad.values(),
+                            *[state.values() for state in states])
+
+            # A parameter that's a plain (nested) list gets copied into a new
+            # Tensor by as_tensor, so we have to copy the update back.
+            if param is not original:
+                original[:] = param.tolist()
+
+    def _scratch(self, i: int, size: int):
+        arrays = self.__dict__.setdefault("_scratch_arrays", {})
+        if i not in arrays or arrays[i].size != size:
+            arrays[i] = np.empty(size)
+        return arrays[i]
+
+    def kernel(self, p, g, *states) -> None:
+        """
+        Updates the flat buffers p (and states) in place, given gradient g.
+        """
+
+        raise NotImplementedError
+
+    def ndarray_kernel(self, p, g, *states, scratch) -> None:
+        raise NotImplementedError
+
+# After that it’s easy to implement gradient descent:
 
-class GradientDescent(Optimizer):
+class GradientDescent(FusedOptimizer):
 
     def __init__(self, learning_rates: float=0.1) -> None:
         self.lr = learning_rates
 
-    def step(self, layer: Layer) -> None:
-        for param, grad in zip(layer.params(), layer.grads()):
-            # Update param using a gradient step
-            param[:] = tensor_combine(
-                lambda param, grad: param - self.lr * grad,
-                param,
-                grad
-            )
-
-# The only thing that’s maybe surprising is the “slice assignment,” which is a 
-# reflection of the fact that reassigning a list doesn’t change its original 
-# value. That is, if you just did param = tensor_combine(. . .), you would be 
-# redefining the local variable param, but you would not be affecting the 
-# original parameter tensor stored in the layer. If you assign to the slice [:], 
-# however, it actually changes the values inside the list.”
+    def kernel(self, p, g) -> None:
+        # Update param using a gradient step
+        lr = self.lr
+        for i, g_i in enumerate(g):
+            p[i] -= lr * g_i
+
+    def ndarray_kernel(self, p, g, scratch) -> None:
+        np.multiply(g, self.lr, out=scratch)
+        p -= scratch
+
+# The only thing that’s maybe surprising is that we assign into p[i] rather than 
+# building a new tensor. That’s a reflection of the fact that reassigning a 
+# variable doesn’t change its original value: if you just did 
+# param = tensor_combine(. . .), you would be redefining the local variable 
+# param, but you would not be affecting the original parameter tensor stored in 
+# the layer. Writing into its buffer, however, actually changes the values inside 
+# the layer’s parameter.
 
 # To demonstrate the value of this abstraction, let’s implement another optimizer 
 # that uses momentum. The idea is that we don’t want to overreact to each new 
 # gradient, and so we maintain a running average of the gradients we’ve seen, 
 # updating it with each new gradient and taking a step in the direction of the 
-# average:
+# average. Since the new average is all the step needs, we can do both in the 
+# same pass:
+
+class Momentum(FusedOptimizer):
 
-class Momentum(Optimizer):
+    state_attributes = ("lr", "mo", "updates")
+    slot_names = ("updates",)
 
     def __init__(self,
                  learning_rate: float,
@@ -111,25 +225,81 @@ class Momentum(Optimizer):
         self.mo = momentum
         self.updates: List[Tensor] = []
 
-    def step(self, layer: Layer) -> None:
-        # If we have no previous updates, start with all zeros:
-        if not len(self.updates):
-            self.updates = [zeros_like(grad) for grad in layer.grads()]
-
-        for update, param, grad in zip(self.updates, layer.params(), layer.grads()):
+    def kernel(self, p, g, u) -> None:
+        lr, mo = self.lr, self.mo
+        for i, g_i in enumerate(g):
             # Apply momentum
-            update[:] = tensor_combine(
-                lambda u, g: self.mo * u + (1 - self.mo) * g,
-                update,
-                grad
-            )
-
+            u_i = mo * u[i] + (1 - mo) * g_i
+            u[i] = u_i
             # Then take a gradient step
-            param[:] = tensor_combine(
-                lambda p, u: p - self.lr * u,
-                param,
-                update
-            )
+            p[i] -= lr * u_i
+
+    def ndarray_kernel(self, p, g, u, scratch) -> None:
+        # mo * u + (1 - mo) * g == mo * (u - g) + g, which needs no temporaries
+        u -= g
+        u *= self.mo
+        u += g
+        np.multiply(u, self.lr, out=scratch)
+        p -= scratch
 
 # Because we used an Optimizer abstraction, we can easily switch between our 
-# different optimizers.
+# different optimizers. And both kernels have to agree:
+
+def check_kernels(optimizer: FusedOptimizer) -> None:
+    """
+    Takes a few steps with each kernel (from the same starting state) and
+    checks that they end up with the same parameters.
+    """
+
+    class Params(Layer):
+        def __init__(self) -> None:
+            self.w = Tensor([[1.0, -2.0], [0.5, 3.0]])
+            self.g = Tensor([[0.1, 0.2], [-0.3, 0.4]])
+
+        def params(self):
+            return [self.w]
+
+        def grads(self):
+            return [self.g]
+
+    initial_state = optimizer.state_dict()
+    results = []
+    for backend in ["python", "numpy"]:
+        layer = Params()
+        optimizer.load_state_dict(initial_state)
+        with use_backend(backend):
+            for _ in range(3):
+                optimizer.step(layer)
+        results.append(layer.w.values().tolist())
+
+    python, ndarray = results
+    assert all(abs(x - y) < 1e-12 for x, y in zip(python, ndarray)), optimizer
+
+if np is not None:
+    check_kernels(GradientDescent(0.1))
+    check_kernels(Momentum(0.1, 0.9))
+
+# An optimizer’s state round-trips through state_dict:
+
+momentum = Momentum(0.1, 0.5)
+momentum.updates = [Tensor([1.0, 2.0])]
+restored = Momentum(0.0)
+restored.load_state_dict(momentum.state_dict())
+assert (restored.lr, restored.mo, restored.updates) == (0.1, 0.5, [Tensor([1.0, 2.0])])
+
+# Parameters that are plain lists get updated too:
+
+class ListParams(Layer):
+    def __init__(self) -> None:
+        self.w = [[1.0, -2.0], [0.5, 3.0]]
+        self.b = [1.0, 1.0]
+
+    def params(self):
+        return [self.w, self.b]
+
+    def grads(self):
+        return [[[1.0, 2.0], [3.0, 4.0]], [-1.0, 1.0]]
+
+list_params = ListParams()
+GradientDescent(0.5).step(list_params)
+assert list_params.w == [[0.5, -3.0], [-1.0, 1.0]] and list_params.b == [1.5, 0.5]
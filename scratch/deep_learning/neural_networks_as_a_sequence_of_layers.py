@@ -1,7 +1,7 @@
-from typing import List, Iterable
+from typing import Any, Dict, List, Iterable
 
 from scratch.deep_learning.the_tensor import Tensor
-from scratch.deep_learning.the_layer_abstraction import Layer
+from scratch.deep_learning.the_layer_abstraction import Layer, layer_to_dict, layer_from_dict
 from scratch.deep_learning.the_linear_layer import Linear
 from scratch.deep_learning.the_layer_abstraction import Sigmoid
 
@@ -30,6 +30,16 @@ class Sequential(Layer):
 
         return input
 
+    def predict(self, input):
+        """
+        Just predict through the layers in order.
+        """
+
+        for layer in self.layers:
+            input = layer.predict(input)
+
+        return input
+
     def backward(self, gradient):
         """
         Just backpropagate the gradient through the layers in reverse.
@@ -54,6 +64,17 @@ class Sequential(Layer):
 
         return (grad for layer in self.layers for grad in layer.grads())
 
+    def config(self) -> Dict[str, Any]:
+        """
+        Just describe each layer.
+        """
+
+        return {"layers": [layer_to_dict(layer) for layer in self.layers]}
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "Sequential":
+        return cls([layer_from_dict(layer) for layer in config["layers"]])
+
 # “o we could represent the neural network we used for XOR as:
 
 xor_net = Sequential([
@@ -61,4 +82,10 @@ xor_net = Sequential([
     Sigmoid(),
     Linear(input_dim=2, output_dim=1),
     Sigmoid()
-])
\ No newline at end of file
+])
+
+# and its description is enough to rebuild it:
+
+rebuilt = layer_from_dict(layer_to_dict(xor_net))
+assert [type(layer) for layer in rebuilt.layers] == [Linear, Sigmoid, Linear, Sigmoid]
+assert rebuilt.layers[2].config() == {"input_dim": 2, "output_dim": 1, "init": "xavier"}
@@ -3,7 +3,9 @@ import math
 import matplotlib.pyplot as plt
 import numpy as np
 
-from scratch.deep_learning.the_tensor import Tensor, tensor_apply, tensor_combine
+from scratch.deep_learning.the_tensor import Tensor, as_tensor
+from scratch.deep_learning.activation_kernels import tanh_kernel, tanh_gradient_kernel, \
+    relu_kernel, relu_gradient_kernel
 from scratch.deep_learning.the_layer_abstraction import Layer
 
 
@@ -27,27 +29,32 @@ def tanh(x: float) -> float:
     em2x = math.exp(-2 * x)
     return (1 - em2x) / (1 + em2x)
 
-xs = np.linspace(-200, 200, 1000)
-ys = [tanh(x) for x in xs]
+# (We only draw the plots when this file is run as a script, so that importing
+# the layers below doesn't pop up any windows.)
 
-plt.plot(xs, ys)
-plt.title("tanh")
-plt.show()
+if __name__ == "__main__":
+    xs = np.linspace(-200, 200, 1000)
+    ys = [tanh(x) for x in xs]
+
+    plt.plot(xs, ys)
+    plt.title("tanh")
+    plt.show()
 
 
 class Tanh(Layer):
 
     def forward(self, input: Tensor) -> Tensor:
         # Save tanh output to use in backward pass.
-        self.tanh = tensor_apply(tanh, input)
+        self.tanh = tanh_kernel(input)
         return self.tanh
 
     def backward(self, gradient):
-        return tensor_combine(
-            lambda tanh, grad: (1 - tanh ** 2) * grad,
-            self.tanh,
-            gradient
-        )
+        # (1 - tanh ** 2) * grad for each element
+        return tanh_gradient_kernel(self.tanh, gradient)
+
+    def predict(self, input: Tensor) -> Tensor:
+        input = as_tensor(input)
+        return tanh_kernel(input, out=self.output_buffer(input.shape))
 
 # In larger networks another popular replacement is Relu, which is 0 for 
 # negative inputs and the identity for positive inputs:
@@ -55,22 +62,29 @@ class Tanh(Layer):
 def relu(x: float) -> float:
     return max(x, 0)
 
-ys = [relu(x) for x in xs]
+if __name__ == "__main__":
+    ys = [relu(x) for x in xs]
 
-plt.plot(xs, ys)
-plt.title("relu")
-plt.show()
+    plt.plot(xs, ys)
+    plt.title("relu")
+    plt.show()
 
 
 class Relu(Layer):
 
     def forward(self, input: Tensor) -> Tensor:
         self.input = input
-        return tensor_apply(relu, input)
+        return relu_kernel(input)
 
     def backward(self, gradient: Tensor) -> Tensor:
-        return tensor_combine(
-            lambda x, grad: grad if x > 0 else 0,
-            self.input,
-            gradient
-        )
+        # grad where x > 0, and 0 elsewhere
+        return relu_gradient_kernel(self.input, gradient)
+
+    def predict(self, input: Tensor) -> Tensor:
+        input = as_tensor(input)
+        return relu_kernel(input, out=self.output_buffer(input.shape))
+
+# (As with Sigmoid, the layers use the whole-tensor kernels from
+# activation_kernels.py rather than applying tanh and relu one element at a
+# time. Those kernels use math.tanh, which computes the same thing as our tanh,
+# only in C.)
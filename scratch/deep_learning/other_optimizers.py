@@ -0,0 +1,156 @@
+import math
+from typing import List
+
+from scratch.linear_algebra.backends import np
+from scratch.deep_learning.the_tensor import Tensor
+from scratch.deep_learning.loss_and_optimization import FusedOptimizer, check_kernels
+
+
+# Gradient descent and momentum are only the beginning; people have come up
+# with lots of other ways to turn gradients into updates. Because each of ours
+# is just a kernel applied to a parameter, its gradient and some per-parameter
+# state, adding more of them is easy.
+
+# Nesterov momentum first updates the running average exactly like Momentum
+# does, but then steps as if it had already taken one more step in that
+# direction, which tends to correct course sooner when the gradient changes:
+
+class Nesterov(FusedOptimizer):
+
+    state_attributes = ("lr", "mo", "updates")
+    slot_names = ("updates",)
+
+    def __init__(self,
+                 learning_rate: float,
+                 momentum: float=0.9) -> None:
+        self.lr = learning_rate
+        self.mo = momentum
+        self.updates: List[Tensor] = []
+
+    def kernel(self, p, g, u) -> None:
+        lr, mo = self.lr, self.mo
+        for i, g_i in enumerate(g):
+            u_i = mo * u[i] + (1 - mo) * g_i
+            u[i] = u_i
+            # Look ahead: the step the next average would take for the same g.
+            p[i] -= lr * (mo * u_i + (1 - mo) * g_i)
+
+    def ndarray_kernel(self, p, g, u, scratch) -> None:
+        u -= g
+        u *= self.mo
+        u += g
+        # mo * u + (1 - mo) * g == (1 - mo) * (g - u) + u
+        np.subtract(g, u, out=scratch)
+        scratch *= 1 - self.mo
+        scratch += u
+        scratch *= self.lr
+        p -= scratch
+
+# RMSProp keeps a running average of the squared gradients instead, and divides
+# each step by its square root. That way parameters whose gradients are
+# consistently large take smaller steps, and parameters whose gradients are
+# consistently small take larger ones:
+
+class RMSProp(FusedOptimizer):
+
+    state_attributes = ("lr", "decay", "epsilon", "squares")
+    slot_names = ("squares",)
+
+    def __init__(self,
+                 learning_rate: float=0.001,
+                 decay: float=0.9,
+                 epsilon: float=1e-8) -> None:
+        self.lr = learning_rate
+        self.decay = decay
+        self.epsilon = epsilon
+        self.squares: List[Tensor] = []
+
+    def kernel(self, p, g, sq) -> None:
+        lr, decay, epsilon = self.lr, self.decay, self.epsilon
+        for i, g_i in enumerate(g):
+            sq_i = decay * sq[i] + (1 - decay) * g_i * g_i
+            sq[i] = sq_i
+            p[i] -= lr * g_i / (math.sqrt(sq_i) + epsilon)
+
+    def ndarray_kernel(self, p, g, sq, scratch) -> None:
+        np.multiply(g, g, out=scratch)
+        sq -= scratch
+        sq *= self.decay
+        sq += scratch
+        np.sqrt(sq, out=scratch)
+        scratch += self.epsilon
+        np.divide(g, scratch, out=scratch)
+        scratch *= self.lr
+        p -= scratch
+
+# Adam combines the two: a running average of the gradients (like momentum) and
+# of their squares (like RMSProp). Both averages start at zero, which biases
+# them toward zero for the first several steps, so Adam corrects for that. We
+# fold the correction into the learning rate, as the original paper suggests:
+
+class Adam(FusedOptimizer):
+
+    state_attributes = ("lr", "beta1", "beta2", "epsilon", "t", "means", "squares")
+    slot_names = ("means", "squares")
+
+    def __init__(self,
+                 learning_rate: float=0.001,
+                 beta1: float=0.9,
+                 beta2: float=0.999,
+                 epsilon: float=1e-8) -> None:
+        self.lr = learning_rate
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+        self.t = 0
+        self.means: List[Tensor] = []
+        self.squares: List[Tensor] = []
+
+    def step(self, layer) -> None:
+        self.t += 1
+        super().step(layer)
+
+    def corrected_lr(self) -> float:
+        return (self.lr * math.sqrt(1 - self.beta2 ** self.t)
+                / (1 - self.beta1 ** self.t))
+
+    def kernel(self, p, g, m, v) -> None:
+        beta1, beta2, epsilon = self.beta1, self.beta2, self.epsilon
+        lr = self.corrected_lr()
+        for i, g_i in enumerate(g):
+            m_i = beta1 * m[i] + (1 - beta1) * g_i
+            v_i = beta2 * v[i] + (1 - beta2) * g_i * g_i
+            m[i] = m_i
+            v[i] = v_i
+            p[i] -= lr * m_i / (math.sqrt(v_i) + epsilon)
+
+    def ndarray_kernel(self, p, g, m, v, scratch) -> None:
+        m -= g
+        m *= self.beta1
+        m += g
+        np.multiply(g, g, out=scratch)
+        v -= scratch
+        v *= self.beta2
+        v += scratch
+        np.sqrt(v, out=scratch)
+        scratch += self.epsilon
+        np.divide(m, scratch, out=scratch)
+        scratch *= self.corrected_lr()
+        p -= scratch
+
+# As before, the plain Python and the numpy kernels should agree:
+
+if np is not None:
+    check_kernels(Nesterov(0.1, 0.9))
+    check_kernels(RMSProp(0.01))
+    check_kernels(Adam(0.01))
+
+# and their state can be saved and restored:
+
+adam = Adam(0.01)
+adam.t = 3
+adam.means, adam.squares = [Tensor([0.5])], [Tensor([0.25])]
+restored = Adam()
+restored.load_state_dict(adam.state_dict())
+assert restored.t == 3 and restored.lr == 0.01
+assert restored.means == [Tensor([0.5])] and restored.squares == [Tensor([0.25])]
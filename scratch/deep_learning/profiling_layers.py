@@ -0,0 +1,244 @@
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple
+from contextlib import contextmanager
+import json
+import random
+import time
+import tracemalloc
+
+from scratch.deep_learning.the_layer_abstraction import Layer
+from scratch.deep_learning.loss_and_optimization import Loss, Optimizer, Momentum, SSE
+from scratch.deep_learning.neural_networks_as_a_sequence_of_layers import Sequential
+from scratch.deep_learning.the_linear_layer import Linear
+from scratch.deep_learning.other_activation_functions import Tanh
+from scratch.deep_learning.dropout import Dropout
+from scratch.deep_learning.the_tensor import Tensor, tensor_apply
+
+
+# When training is slow, the first question is where the time goes: is it the
+# Linear layers or the activations, forward or backward, or the optimizer? To
+# answer it we'd like to time every call to every layer's forward and backward
+# (and predict), without making those calls any slower when we're not asking.
+
+# The trick is that Python looks up a method on the instance before the class.
+# So for as long as we're profiling, we give each layer an instance attribute
+# that wraps the method (and calls some hooks before and after), and when we're
+# done we delete it again. Nothing about the classes changes, so once profiling
+# is off there's nothing left to cost anything.
+
+# Sequential layers contain other layers (possibly other Sequentials), so we'll
+# name each layer by its position in the model:
+
+def named_layers(model: Layer, name: str="model") -> Iterator[Tuple[str, Layer]]:
+    yield name, model
+    for i, layer in enumerate(getattr(model, "layers", [])):
+        yield from named_layers(layer, f"{name}.{i}")
+
+# A pre hook gets called with the layer's name, the method's name, and the
+# arguments; a post hook with the name, the method, and the result. The post
+# hook gets called even if the method raises an exception (with None for the
+# result), so that every pre has its post:
+
+PreHook = Callable[[str, str, Sequence[Any]], None]
+PostHook = Callable[[str, str, Any], None]
+
+LAYER_METHODS = ("forward", "backward", "predict")
+
+def _wrap(target: Any, method: str, name: str, pre: PreHook, post: PostHook) -> None:
+    original = getattr(target, method)
+
+    def wrapper(*args, **kwargs):
+        if pre is not None:
+            pre(name, method, args)
+        result = None
+        try:
+            result = original(*args, **kwargs)
+            return result
+        finally:
+            if post is not None:
+                post(name, method, result)
+
+    setattr(target, method, wrapper)
+
+@contextmanager
+def layer_hooks(model: Layer,
+                pre: PreHook=None,
+                post: PostHook=None,
+                optimizer: Optimizer=None,
+                loss: Loss=None) -> Iterator[None]:
+    """
+    Calls pre and post around forward, backward and predict on every layer in
+    model (and around optimizer.step and loss.loss_and_gradient / loss.loss,
+    if they're given), until the block exits.
+    """
+
+    targets = []
+    seen = set()
+    for name, layer in named_layers(model):
+        if id(layer) not in seen:            # (a layer can appear twice)
+            seen.add(id(layer))
+            targets.extend((layer, method, name) for method in LAYER_METHODS)
+    if optimizer is not None:
+        targets.append((optimizer, "step", "optimizer"))
+    if loss is not None:
+        targets.extend((loss, method, "loss") for method in ("loss_and_gradient", "loss"))
+
+    wrapped = []
+    try:
+        for target, method, name in targets:
+            if method in vars(target):
+                raise ValueError(f"{name}.{method} is already hooked")
+            _wrap(target, method, name, pre, post)
+            wrapped.append((target, method))
+        yield
+    finally:
+        for target, method in wrapped:
+            delattr(target, method)
+
+# (The wrappers are closures, which can't be pickled, so don't try to hand a
+# model to a DataParallelTrainer while it's being profiled.)
+
+# With hooks in place, a profiler just has to start a clock in the pre hook and
+# stop it in the post hook. Calls nest (a Sequential's forward calls each of its
+# layers' forwards), so the start times go on a stack.
+
+# If you ask for it, the profiler also uses tracemalloc to count how many bytes
+# each call allocated and didn't free (its output, plus whatever it saved for
+# backward, minus whatever it let go of). That's a lot slower, so it's off by
+# default.
+
+# Times are inclusive: a Sequential's forward includes all of its layers'.
+
+class CallStats:
+    def __init__(self, layer_type: str) -> None:
+        self.layer_type = layer_type
+        self.calls = 0
+        self.seconds = 0.0
+        self.allocated = 0
+
+class Profiler:
+    def __init__(self, memory: bool=False) -> None:
+        self.memory = memory
+        self.stats: Dict[Tuple[str, str], CallStats] = {}
+        self.types: Dict[str, str] = {}
+        self._started: List[Tuple[float, int]] = []
+
+    def _traced(self) -> int:
+        return tracemalloc.get_traced_memory()[0] if self.memory else 0
+
+    def _pre(self, name: str, method: str, args: Sequence[Any]) -> None:
+        self._started.append((time.perf_counter(), self._traced()))
+
+    def _post(self, name: str, method: str, result: Any) -> None:
+        end = time.perf_counter()
+        start, traced = self._started.pop()
+
+        key = (name, method)
+        if key not in self.stats:
+            self.stats[key] = CallStats(self.types[name])
+        stats = self.stats[key]
+        stats.calls += 1
+        stats.seconds += end - start
+        stats.allocated += self._traced() - traced
+
+    @contextmanager
+    def profile(self,
+                model: Layer,
+                optimizer: Optimizer=None,
+                loss: Loss=None) -> Iterator["Profiler"]:
+        """
+        Profiles every call made inside the block. Stats accumulate across
+        blocks until you reset().
+        """
+
+        self.types.update((name, type(layer).__name__)
+                          for name, layer in named_layers(model))
+        self.types.update(optimizer=type(optimizer).__name__,
+                          loss=type(loss).__name__)
+        self._started = []
+
+        started_tracing = self.memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        try:
+            with layer_hooks(model, self._pre, self._post, optimizer, loss):
+                yield self
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+
+    def reset(self) -> None:
+        self.stats.clear()
+
+    def report(self) -> List[Dict[str, Any]]:
+        """
+        One row per (layer, method), in the order they were first called.
+        """
+
+        return [{"layer": name,
+                 "type": stats.layer_type,
+                 "method": method,
+                 "calls": stats.calls,
+                 "seconds": stats.seconds,
+                 "ms_per_call": 1000 * stats.seconds / stats.calls,
+                 "allocated_bytes": stats.allocated if self.memory else None}
+                for (name, method), stats in self.stats.items()]
+
+    def save_report(self, filename: str) -> None:
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def print_report(self) -> None:
+        print(f"{'layer':<12}{'type':<20}{'method':<18}{'calls':>8}"
+              f"{'seconds':>10}{'ms/call':>10}{'MB':>10}")
+        for row in sorted(self.report(), key=lambda row: row["layer"]):
+            megabytes = ("" if row["allocated_bytes"] is None
+                         else f"{row['allocated_bytes'] / 2**20:.2f}")
+            print(f"{row['layer']:<12}{row['type']:<20}{row['method']:<18}"
+                  f"{row['calls']:>8}{row['seconds']:>10.3f}"
+                  f"{row['ms_per_call']:>10.3f}{megabytes:>10}")
+
+# For example, profiling a couple of training steps of a small network records
+# every call, and leaves the layers exactly as they were:
+
+random.seed(0)
+model = Sequential([Linear(20, 16), Dropout(0.1), Tanh(), Linear(16, 10)])
+model.layers[1].train = True
+optimizer = Momentum(0.01, 0.9)
+loss = SSE()
+xs = Tensor([[random.random() for _ in range(20)] for _ in range(32)])
+ys = Tensor([[float(j == random.randrange(10)) for j in range(10)] for _ in range(32)])
+
+profiler = Profiler(memory=True)
+with profiler.profile(model, optimizer, loss):
+    for _ in range(10):
+        batch_loss, gradient = loss.loss_and_gradient(model.forward(xs), ys)
+        model.backward(tensor_apply(lambda g: g / 32, gradient))
+        optimizer.step(model)
+    model.predict(xs)
+
+stats = {(row["layer"], row["method"]): row for row in profiler.report()}
+assert stats["model", "forward"]["calls"] == 10
+assert stats["model.3", "backward"]["type"] == "Linear"
+assert stats["optimizer", "step"]["calls"] == 10
+assert stats["model.2", "predict"]["calls"] == 1
+assert all(not set(LAYER_METHODS) & set(vars(layer))
+           for _, layer in named_layers(model))
+assert "step" not in vars(optimizer)
+
+# A call that fails still gets its clock stopped, so the calls after it are
+# timed correctly:
+
+profiler.reset()
+with profiler.profile(model):
+    failed = False
+    try:
+        model.forward(Tensor([[1.0, 2.0]]))          # (the wrong size)
+    except Exception:
+        failed = True
+    assert failed and profiler._started == []
+    model.forward(xs)
+stats = {(row["layer"], row["method"]): row for row in profiler.report()}
+assert stats["model", "forward"]["calls"] == 2 and stats["model.3", "forward"]["calls"] == 1
+
+if __name__ == "__main__":
+    profiler.print_report()
@@ -1,9 +1,12 @@
+from typing import List, Optional, Tuple
+from array import array
 import math
 import random
 
 import tqdm
 
-from scratch.deep_learning.the_tensor import Tensor, is_1d, \
+from scratch.linear_algebra.backends import get_backend, use_backend, np
+from scratch.deep_learning.the_tensor import Tensor, as_tensor, is_1d, \
     tensor_combine, tensor_sum
 from scratch.deep_learning.neural_networks_as_a_sequence_of_layers import Sequential
 from scratch.deep_learning.the_linear_layer import Linear
@@ -73,6 +76,37 @@ def softmax(tensor: Tensor) -> Tensor:
 # function but not part of the network itself, the gradients of the loss with 
 # respect to the network outputs are very easy to compute.
 
+# Computed naively, that means a softmax (with a math.log of every probability)
+# for the loss and then a second softmax for the gradient, and a log(p + 1e-30)
+# hack in case a probability underflows to 0. We can do better by working with
+# log probabilities directly. If largest is the largest input and
+# sum_of_exps = sum(exp(x - largest)), then
+
+#   log p_i = (x_i - largest) - log(sum_of_exps)
+
+# which never takes the log of anything smaller than 1. And once we have the
+# exps we get both the loss and the gradient (p - actual) out of the same pass.
+
+# The targets are usually one-hot vectors, in which case all the loss needs is
+# the index of the 1. So we'll also accept the class labels themselves (an int
+# per example), which saves building and storing all those one-hot vectors.
+
+def class_labels(actual, predicted: Tensor) -> Optional[List[int]]:
+    """
+    If actual is class labels (one int per row of predicted), returns them as a
+    list. If it's a tensor of targets (the same shape as predicted), returns None.
+    """
+
+    if isinstance(actual, int):
+        return [actual]
+    if isinstance(actual, Tensor):
+        if len(actual.shape) == len(predicted.shape):
+            return None
+        return [int(label) for label in actual.values()]
+    if len(predicted.shape) > 1 and not isinstance(actual[0], (list, Tensor)):
+        return list(actual)
+    return None
+
 class SoftmaxCrossEntropy(Loss):
     """
     This is the negative-log-likelihood of the observed values, given the neural 
@@ -81,24 +115,98 @@ class SoftmaxCrossEntropy(Loss):
     """
 
     def loss(self,  predicted: Tensor, actual: Tensor) -> float:
-        # Apply softmax to ge probabilities
-        probabilities = softmax(predicted)
-
-        # This will be log p_i for the actual class i and 0 for the other classes.
-        # We add a tiny amount to p to avoid taking log(0)
-        likelihoods = tensor_combine(lambda p, act: math.log(p + 1e-30) * act,
-                                     probabilities,
-                                     actual)
-
-        # And then we just sum up the negatives.
-        return -tensor_sum(likelihoods)
+        return self.loss_and_gradient(predicted, actual)[0]
 
     def gradient(self, predicted: Tensor, actual: Tensor) -> Tensor:
-        probabilities = softmax(predicted)
-
-        return tensor_combine(lambda p, actual: p - actual,
-                              probabilities,
-                              actual)
+        return self.loss_and_gradient(predicted, actual)[1]
+
+    def loss_and_gradient(self, predicted: Tensor, actual: Tensor) -> Tuple[float, Tensor]:
+        predicted = as_tensor(predicted)
+        labels = class_labels(actual, predicted)
+        if labels is None:
+            actual = as_tensor(actual).values()
+
+        if get_backend() == "numpy":
+            return self._ndarray_loss_and_gradient(predicted, labels, actual)
+
+        x = predicted.values()
+        k = predicted.shape[-1]
+        total_loss = 0.0
+        gradient = array("d")
+
+        for r in range(predicted.size // k):
+            row = x[r * k:(r + 1) * k]
+
+            # Subtract largest value for numerical stability
+            largest = max(row)
+            exps = [math.exp(x_i - largest) for x_i in row]
+            sum_of_exps = sum(exps)
+            log_sum = math.log(sum_of_exps)
+
+            start = len(gradient)
+            gradient.extend([exp_i / sum_of_exps for exp_i in exps])
+
+            if labels is not None:
+                # This is -log p_i for the actual class i.
+                label = labels[r]
+                total_loss -= row[label] - largest - log_sum
+                gradient[start + label] -= 1
+            else:
+                targets = actual[r * k:(r + 1) * k]
+                total_loss -= sum(t_i * (x_i - largest - log_sum)
+                                  for t_i, x_i in zip(targets, row) if t_i)
+                for i, t_i in enumerate(targets):
+                    gradient[start + i] -= t_i
+
+        return total_loss, Tensor.from_buffer(gradient, predicted.shape)
+
+    def _ndarray_loss_and_gradient(self, predicted: Tensor, labels, actual):
+        k = predicted.shape[-1]
+        x = np.asarray(predicted.values()).reshape(-1, k)
+
+        shifted = x - x.max(axis=1, keepdims=True)
+        exps = np.exp(shifted)
+        sums = exps.sum(axis=1, keepdims=True)
+        log_probabilities = shifted - np.log(sums)
+        exps /= sums
+
+        if labels is not None:
+            rows = np.arange(len(x))
+            total_loss = -log_probabilities[rows, labels].sum()
+            exps[rows, labels] -= 1
+        else:
+            targets = np.asarray(actual).reshape(-1, k)
+            total_loss = -(targets * log_probabilities).sum()
+            exps -= targets
+
+        return float(total_loss), Tensor(exps.ravel().tolist(), predicted.shape)
+
+# The new loss agrees with the naive computation (but doesn't mind when a
+# probability underflows), and labels give the same results as one-hot targets:
+
+def naive_cross_entropy(predicted, actual) -> float:
+    probabilities = softmax(predicted)
+    return -tensor_sum(tensor_combine(lambda p, act: math.log(p + 1e-30) * act,
+                                      probabilities,
+                                      actual))
+
+logits = Tensor([[1.0, 2.0, 3.0], [0.5, -1.0, 4.0]])
+one_hot = [[0, 0, 1], [1, 0, 0]]
+loss_, gradient_ = SoftmaxCrossEntropy().loss_and_gradient(logits, one_hot)
+assert abs(loss_ - naive_cross_entropy(logits.tolist(), one_hot)) < 1e-12
+assert SoftmaxCrossEntropy().loss_and_gradient(logits, [2, 0]) == (loss_, gradient_)
+assert all(abs(g - (p - a)) < 1e-12
+           for g, p, a in zip(gradient_.values(),
+                              Tensor(softmax(logits.tolist())).values(),
+                              Tensor(one_hot).values()))
+assert SoftmaxCrossEntropy().loss([0.0, 1000.0], 0) == 1000.0
+
+if np is not None:
+    with use_backend("numpy"):
+        ndarray_loss, ndarray_gradient = SoftmaxCrossEntropy().loss_and_gradient(logits, [2, 0])
+    assert abs(ndarray_loss - loss_) < 1e-12
+    assert all(abs(a - b) < 1e-12
+               for a, b in zip(ndarray_gradient.values(), gradient_.values()))
 
 # If I now train the same Fizz Buzz network using SoftmaxCrossEntropy loss, I 
 # find that it typically trains much faster (that is, in many fewer epochs).
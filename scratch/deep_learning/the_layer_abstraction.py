@@ -1,7 +1,9 @@
-from typing import Iterable, Tuple
+from typing import Any, Dict, Iterable, Set, Tuple
+import importlib
+import sys
 
-from scratch.neural_networks.feed_forward_neural_networks import sigmoid
-from scratch.deep_learning.the_tensor import Tensor, tensor_apply, tensor_combine
+from scratch.deep_learning.the_tensor import Tensor, as_tensor, zeros, get_default_dtype
+from scratch.deep_learning.activation_kernels import sigmoid_kernel, sigmoid_gradient_kernel
 
 
 # In the previous chapter we built a simple neural net that allowed us to stack 
@@ -44,6 +46,29 @@ class Layer:
 
         raise NotImplementedError
 
+    def predict(self, input):
+        """
+        Like forward, but for inference only: it doesn't save anything for
+        backward, and layers may write their output into a buffer that they
+        reuse on the next call (so copy it if you need to keep it around). The
+        default just calls forward.
+        """
+
+        return self.forward(input)
+
+    def output_buffer(self, shape: Tuple[int, ...], dtype: str=None) -> Tensor:
+        """
+        A Tensor of the given shape (and dtype, or the default) for predict to
+        write its output into, which we keep and hand out again as long as the
+        shape and dtype stay the same.
+        """
+
+        dtype = dtype or get_default_dtype()
+        buffer = self.__dict__.get("_output")
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = self._output = zeros(*shape, dtype=dtype)
+        return buffer
+
     def params(self) -> Iterable[Tensor]:
         """
         Returns the parameters fo this layer, The default implementation returns 
@@ -60,6 +85,69 @@ class Layer:
 
         return ()
 
+    # So that we can save a model and rebuild it later without the code that
+    # built it, every layer also knows how to describe itself: config() returns
+    # the arguments it was constructed with (as JSON-friendly values), and
+    # from_config() constructs a new layer from them. Layers whose constructor
+    # takes no arguments can use these defaults.
+
+    def config(self) -> Dict[str, Any]:
+        return {}
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "Layer":
+        return cls(**config)
+
+    # Every subclass gets registered under its module and (qualified) name, so
+    # that we can go from a saved description back to the class. Classes
+    # defined inside a function can't be found again from a description, so
+    # we leave those out.
+
+    registry: Dict[str, type] = {}
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        if "<locals>" not in cls.__qualname__:
+            Layer.registry[f"{cls.__module__}.{cls.__qualname__}"] = cls
+
+def layer_to_dict(layer: Layer) -> Dict[str, Any]:
+    return {"type": type(layer).__qualname__,
+            "module": type(layer).__module__,
+            "config": layer.config()}
+
+# A description can come from a file someone sent us, and importing a module
+# runs its code (and plenty of the modules in this repo download things, write
+# files, or train models when they're imported). So the only modules we'll
+# import are the ones that define our layers, plus any others you allow with
+# allow_layer_module.
+
+_layer_modules: Set[str] = {
+    "scratch.deep_learning.the_layer_abstraction",
+    "scratch.deep_learning.the_linear_layer",
+    "scratch.deep_learning.other_activation_functions",
+    "scratch.deep_learning.dropout",
+    "scratch.deep_learning.neural_networks_as_a_sequence_of_layers",
+    "scratch.deep_learning.convolutional_layers",
+}
+
+def allow_layer_module(module: str) -> None:
+    _layer_modules.add(module)
+
+def layer_from_dict(description: Dict[str, Any]) -> Layer:
+    """
+    Rebuilds a layer from layer_to_dict's description. If its class hasn't been
+    registered yet (because nothing has imported it), we import its module, as
+    long as it's one we trust.
+    """
+
+    module, name = description["module"], description["type"]
+    key = f"{module}.{name}"
+    if key not in Layer.registry and module in _layer_modules:
+        importlib.import_module(module)
+    if key not in Layer.registry:
+        raise ValueError(f"unknown layer type: {key}")
+    return Layer.registry[key].from_config(description["config"])
+
 # The forward and backward methods will have to be implemented in our concrete 
 # subclasses. Once we build a neural net, we’ll want to train it using gradient 
 # descent, which “means we’ll want to update each parameter in the network 
@@ -80,13 +168,16 @@ class Sigmoid(Layer):
         to use in backpropagation.
         """
 
-        self.sigmoids = tensor_apply(sigmoid, input)
+        self.sigmoids = sigmoid_kernel(input)
         return self.sigmoids
 
     def backward(self, gradient: Tensor):
-        return tensor_combine(lambda sig, grad: sig * (1 - sig) * grad,
-                              self.sigmoids,
-                              gradient)
+        # sig * (1 - sig) * grad for each element
+        return sigmoid_gradient_kernel(self.sigmoids, gradient)
+
+    def predict(self, input: Tensor) -> Tensor:
+        input = as_tensor(input)
+        return sigmoid_kernel(input, out=self.output_buffer(input.shape))
 
 # There are a couple of things to notice here. One is that during the forward 
 # pass we saved the computed sigmoids so that we could use them later in the 
@@ -97,4 +188,29 @@ class Sigmoid(Layer):
 # output * (1 - output) * (output - target) term in our previous neural networks.
 
 # Finally, you can see how we were able to make use of the tensor_apply and the 
-# tensor_combine functions. Most of our layers will use these functions similarly.
\ No newline at end of file
+# tensor_combine functions. Most of our layers will use these functions similarly.
+# (Or they would: since activations run on every hidden unit, Sigmoid actually
+# uses the faster, whole-tensor kernels from activation_kernels.py, which
+# compute the same thing.)
+
+# And, like every layer, Sigmoid can describe itself and be rebuilt from that
+# description:
+
+assert layer_to_dict(Sigmoid()) == {"type": "Sigmoid",
+                                    "module": "scratch.deep_learning.the_layer_abstraction",
+                                    "config": {}}
+assert isinstance(layer_from_dict(layer_to_dict(Sigmoid())), Sigmoid)
+
+# But a description can't make us import just any module:
+
+try:
+    layer_from_dict({"type": "Layer", "module": "this_module_should_not_be_imported", "config": {}})
+    assert False, "an untrusted module was imported"
+except ValueError:
+    pass
+
+try:
+    layer_from_dict({"type": "X", "module": "scratch.getting_data.reading_files", "config": {}})
+    assert False, "a module that isn't allowed was imported"
+except ValueError:
+    assert "scratch.getting_data.reading_files" not in sys.modules
@@ -1,10 +1,14 @@
-from typing import Iterable
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+from array import array
+from operator import mul
+import math
 import random
 
-from scratch.working_with_data.exploring_your_data import inverse_normal_cdf
-from scratch.linear_algebra.vectors import dot
+from scratch.linear_algebra.backends import get_backend, use_backend, np
+from scratch.probability.sampling import normal_samples, uniform_samples
 from scratch.deep_learning.the_layer_abstraction import Layer
-from scratch.deep_learning.the_tensor import Tensor, shape
+from scratch.deep_learning.the_tensor import Tensor, shape, as_tensor, zeros, peak_allocated, \
+    get_default_dtype, typecode, use_dtype
 
 
 # The other piece we’ll need to duplicate the neural networks from Chapter 18 is 
@@ -18,46 +22,145 @@ from scratch.deep_learning.the_tensor import Tensor, shape
 # has near-zero gradients. And parts of the network that have zero gradients 
 # necessarily can’t learn anything via gradient descent.
 
-# Accordingly, we’ll implement three different schemes for randomly generating 
-# our weight tensors. The first is to choose each value from the random uniform 
-# distribution on [0, 1]—that is, as a random.random(). The second (and default) 
-# is to choose each value randomly from a standard normal distribution. And the 
-# third is to use Xavier initialization, where each weight is initialized with 
-# a random draw from a normal distribution with mean 0 and 
-# variance 2 / (num_inputs + num_outputs). It turns out this often works nicely 
-# for neural network weights. We’ll implement these with a random_uniform 
-# function and a random_normal function:
-
-def random_uniform(*dims: int) -> Tensor:
-    if len(dims) == 1:
-        return [random.random() for _ in range(dims[0])]
-    else:
-        return [random_uniform(*dims[1:]) for _ in range(dims[0])]
+# Accordingly, we’ll implement several different schemes for randomly
+# generating our weight tensors. The first is to choose each value from the
+# random uniform distribution on [0, 1]—that is, as a random.random(). The
+# second is to choose each value randomly from a standard normal distribution.
+# The rest scale the weights to the size of the layer, which we’ll get to in a
+# moment. We’ll implement these with a random_uniform function and a
+# random_normal function. Both draw all of their values in one batch from
+# scratch.probability.sampling (rather than one inverse_normal_cdf call per
+# value), and both take an optional random.Random, if you want a model's
+# weights to be reproducible without reseeding the global random module:
 
-def random_normal(*dims: int, mean: float=0.0, variance: float=1.0) -> Tensor:
-    if len(dims) == 1:
-        return [mean + variance * inverse_normal_cdf(random.random())
-                for _ in range(dims[0])]
-    else:
-        return [random_normal(*dims[1:], mean=mean, variance=variance)
-                for _ in range(dims[0])]
+def _size(dims) -> int:
+    size = 1
+    for dim in dims:
+        size *= dim
+    return size
+
+def random_uniform(*dims: int,
+                   low: float=0.0,
+                   high: float=1.0,
+                   rng: random.Random=None) -> Tensor:
+    values = uniform_samples(_size(dims), low, high, rng=rng)
+    return Tensor.from_buffer(values, dims).tolist()
+
+def random_normal(*dims: int,
+                  mean: float=0.0,
+                  variance: float=1.0,
+                  rng: random.Random=None) -> Tensor:
+    values = normal_samples(_size(dims), mean, math.sqrt(variance), rng=rng)
+    return Tensor.from_buffer(values, dims).tolist()
 
 assert shape(random_uniform(2, 3, 4)) == [2, 3, 4]
 assert shape(random_normal(5, 6, mean=10)) == [5, 6]
+assert random_normal(3, rng=random.Random(0)) == random_normal(3, rng=random.Random(0))
 
-# And then wrap them all in a random_tensor function:
+# Why scale the weights? Each output of a layer is a sum of fan_in weighted
+# inputs, so if the weights have variance v, the outputs' variance is about
+# fan_in * v times the inputs'. Likewise the gradients flowing backward get
+# multiplied by fan_out * v. To keep both from blowing up (or dying out) as
+# they pass through layer after layer, we'd like fan_in * v and fan_out * v
+# both to be about 1.
+
+# Xavier (or Glorot) initialization compromises, with
+# v = 2 / (fan_in + fan_out). He initialization is meant for relu layers, which
+# zero out half of their inputs, and uses v = 2 / fan_in (or 2 / fan_out, if
+# you care more about the backward pass). Each comes in a normal and a uniform
+# flavor. (A uniform distribution on [-limit, limit] has variance limit² / 3,
+# so for variance v we need limit = sqrt(3 v).)
+
+# For our (output_dim, input_dim) weights, fan_out is the first dimension and
+# fan_in the second. Anything past that (like the height and width of a
+# convolution's filters) multiplies both, and a 1-d tensor (like a bias) gets
+# its length for both:
+
+def fans(dims) -> Tuple[int, int]:
+    """
+    The (fan_in, fan_out) of a weight tensor with the given dims.
+    """
+
+    if len(dims) == 1:
+        return dims[0], dims[0]
+    receptive_field = _size(dims[2:])
+    return dims[1] * receptive_field, dims[0] * receptive_field
 
-def random_tensor(*dims: int, init: str="normal") -> Tensor:
+# Each scheme is a scale, which fan to divide it by, and a distribution:
+
+INITIALIZERS: Dict[str, Tuple[float, str, str]] = {
+    "xavier": (2.0, "fan_avg", "normal"),
+    "xavier_uniform": (2.0, "fan_avg", "uniform"),
+    "he": (2.0, "fan_in", "normal"),
+    "he_uniform": (2.0, "fan_in", "uniform"),
+    "he_fan_out": (2.0, "fan_out", "normal"),
+    "he_uniform_fan_out": (2.0, "fan_out", "uniform"),
+}
+
+def scaled_variance(dims, scale: float, mode: str) -> float:
+    fan_in, fan_out = fans(dims)
+    if mode == "fan_in":
+        return scale / fan_in
+    elif mode == "fan_out":
+        return scale / fan_out
+    elif mode == "fan_avg":
+        return scale / (fan_in + fan_out)
+    else:
+        raise ValueError(f"unknown mode: {mode}")
+
+# And then wrap them all in a random_tensor function, which packs the values
+# into a Tensor. (It also accepts "zeros", which isn't random at all, but is
+# much quicker when the values are about to be overwritten anyway, say by
+# loading saved weights.) Since a Tensor is just a flat buffer plus a shape,
+# we can hand it the samples directly without building nested lists first
+# (only converting them if we want float32s):
+
+def random_tensor(*dims: int,
+                  init: str="normal",
+                  rng: random.Random=None,
+                  dtype: str=None) -> Tensor:
+    dtype = dtype or get_default_dtype()
+    size = _size(dims)
     if init == "normal":
-        return random_normal(*dims)
+        values = normal_samples(size, rng=rng)
     elif init == "uniform":
-        return random_uniform(*dims)
-    elif init == "xavier":
-        variance = len(dims) / sum(dims)
-        return random_normal(*dims, variance=variance)
+        values = uniform_samples(size, rng=rng)
+    elif init in INITIALIZERS:
+        scale, mode, distribution = INITIALIZERS[init]
+        variance = scaled_variance(dims, scale, mode)
+        if distribution == "normal":
+            values = normal_samples(size, 0.0, math.sqrt(variance), rng=rng)
+        else:
+            limit = math.sqrt(3 * variance)
+            values = uniform_samples(size, -limit, limit, rng=rng)
+    elif init == "zeros":
+        return zeros(*dims, dtype=dtype)
     else:
         raise ValueError(f"unknown init: {init}")
 
+    if dtype != "float64":
+        values = array(typecode(dtype), values)
+    return Tensor.from_buffer(values, dims)
+
+assert random_tensor(2, 3, rng=random.Random(5)) == random_tensor(2, 3, rng=random.Random(5))
+assert fans((30, 784)) == (784, 30) and fans((8, 3, 5, 5)) == (75, 200)
+
+# The samples have (about) the variance they're supposed to:
+
+def _variance(tensor: Tensor) -> float:
+    values = tensor.values()
+    mean = sum(values) / len(values)
+    return sum((x - mean) ** 2 for x in values) / (len(values) - 1)
+
+for init in INITIALIZERS:
+    scale, mode, _ = INITIALIZERS[init]
+    expected = scaled_variance((200, 300), scale, mode)
+    actual = _variance(random_tensor(200, 300, init=init, rng=random.Random(0)))
+    assert abs(actual / expected - 1) < 0.02, init
+
+limit = math.sqrt(6 / (200 + 300))
+assert max(map(abs, random_tensor(200, 300, init="xavier_uniform").values())) <= limit
+
 # Now we can define our linear layer. We need to initialize it with the dimension 
 # of the inputs (which tells us how many weights each neuron needs), the 
 # dimension of the outputs (which tells us how many neurons we should have), and 
@@ -68,51 +171,119 @@ class Linear(Layer):
     def __init__(self,
                  input_dim: int,
                  output_dim: int,
-                 init: str="xavier") -> None:
+                 init: str="xavier",
+                 rng: random.Random=None) -> None:
         """
-        A layer of output_dim neurons, each with input_dim weights (and a bias).
+        A layer of output_dim neurons, each with input_dim weights (and a bias),
+        drawn from rng if it's given, and stored with the default dtype.
         """
 
         self.input_dim = input_dim
         self.output_dim = output_dim
+        self.init = init
 
         # self.w[o] is the weights for the oth neuron
-        self.w = random_tensor(output_dim, input_dim, init=init)
+        self.w = random_tensor(output_dim, input_dim, init=init, rng=rng)
 
         # self.b[o] is the bias for the oth neuron.
-        self.b = random_tensor(output_dim, init=init)
+        self.b = random_tensor(output_dim, init=init, rng=rng)
 
 # The forward method is easy to implement. We’ll get one output per neuron, 
 # which we stick in a vector. And each neuron’s output is just the dot of its 
-# weights with the input, plus its bias:
+# weights with the input, plus its bias. Since self.w is stored row-major, the 
+# weights for neuron o are the o-th run of input_dim values in its flat buffer, 
+# which we can slice out without copying.
+
+# Running one example at a time through the network means one trip through all 
+# of this Python machinery per example, so we’ll also accept a minibatch: a 
+# tensor of shape (batch_size, input_dim), one example per row, for which we 
+# return a (batch_size, output_dim) tensor of outputs. That makes the forward 
+# pass a matrix-matrix product of the inputs with the transposed weights:
 
     def forward(self, input: Tensor) -> Tensor:
         # Save the input to use in the backward pass.
-        self.input = input
+        self.input = as_tensor(input)
+
+        return Tensor(self._outputs(self.input),
+                      self.input.shape[:-1] + (self.output_dim,),
+                      dtype=self.w.dtype)
+
+    def _outputs(self, input: Tensor) -> Iterator[float]:
+        x = input.values()
+        w = self.w.values()
+        b = self.b.values()
+        n, m = self.input_dim, self.output_dim
+        batch_size = input.size // n
+        rows = [w[o * n:(o + 1) * n] for o in range(m)]
+
+        # Generate the neuron outputs for each example in the batch.
+        return (sum(map(mul, x[r * n:(r + 1) * n], rows[o])) + b[o]
+                for r in range(batch_size)
+                for o in range(m))
+
+# (Its outputs, like its gradients below, have the same dtype as its weights.)
 
-        # Return the vector of neuron outputs.
-        return [dot(input, self.w[o]) + self.b[o]
-                for o in range(self.output_dim)]
+# When we only want predictions, we don't need to save the input, and we can
+# write the outputs into the same buffer every time. With the numpy backend the
+# matrix product goes straight into that buffer. (For float32 weights we ask
+# numpy to add up the products in float64, like the python backend does.)
+
+    def predict(self, input: Tensor) -> Tensor:
+        input = as_tensor(input)
+        n, m = self.input_dim, self.output_dim
+        out = self.output_buffer(input.shape[:-1] + (m,), self.w.dtype)
+
+        if get_backend() == "numpy":
+            x = np.asarray(input.values()).reshape(-1, n)
+            w = np.asarray(self.w.values()).reshape(m, n)
+            y = np.asarray(out.values()).reshape(-1, m)
+            np.matmul(x, w.T, out=y, dtype=np.float64)
+            y += np.asarray(self.b.values())
+        else:
+            # (one output at a time, so there's no temporary list of them)
+            out.write(self._outputs(input))
+
+        return out
 
 # The backward method is more involved, but if you know calculus it’s not 
-# difficult:
+# difficult. With a minibatch, each parameter’s gradient is the sum of its 
+# gradients for the individual examples:
 
     def backward(self, gradient: Tensor) -> Tensor:
+        gradient = as_tensor(gradient)
+        g = gradient.values()
+        x = self.input.values()
+        w = self.w.values()
+        n, m = self.input_dim, self.output_dim
+        batch_size = self.input.size // n
+
         # Each b[o] gets added to output[o], which means
         # the gradient of b is the same as the output gradient.
-        self.b_grad = gradient
+        dtype = self.w.dtype
+        self.b_grad = Tensor([sum(g[o::m]) for o in range(m)], (m,), dtype)
 
         # Each w[o][i] multiplies input[i] and gets added to output[o].
         # So its gradient is input[i] * gradient[o].
-        self.w_grad = [[self.input[i] * gradient[o]
-                        for i in range(self.input_dim)]
-                       for o in range(self.output_dim)]
+        if batch_size == 1:
+            w_grad = [x_i * g_o for g_o in g for x_i in x]
+        else:
+            # Summed over the batch, it's the product of the o-th column of
+            # the gradients and the i-th column of the inputs.
+            x_columns = [x[i::n] for i in range(n)]
+            w_grad = [sum(map(mul, g[o::m], x_columns[i]))
+                      for o in range(m)
+                      for i in range(n)]
+        self.w_grad = Tensor(w_grad, (m, n), dtype)
 
         # Each input[i] multiplies every w[o][i] and gets added to every
         # output[o]. So its gradient is the sum of w[o][i] * gradient[o]
-        # across all the outputs.
-        return [sum(self.w[o][i] * gradient[o] for o in range(self.output_dim))
-                for i in range(self.input_dim)]
+        # across all the outputs. (w[i::n] is the i-th column of w.)
+        w_columns = [w[i::n] for i in range(n)]
+        input_grad = [sum(map(mul, g[r * m:(r + 1) * m], w_columns[i]))
+                      for r in range(batch_size)
+                      for i in range(n)]
+
+        return Tensor(input_grad, self.input.shape, dtype)
 
 # Finally, here we do need to implement params and grads. We have two parameters 
 # and two corresponding gradients:
@@ -122,3 +293,62 @@ class Linear(Layer):
 
     def grads(self) -> Iterable[Tensor]:
         return [self.w_grad, self.b_grad]
+
+    def config(self) -> Dict[str, Any]:
+        return {"input_dim": self.input_dim,
+                "output_dim": self.output_dim,
+                "init": self.init}
+
+# A batch gives the same outputs as running its examples one at a time, and
+# parameter gradients that are the sums of the per-example gradients:
+
+linear = Linear(3, 2)
+batch = [[1, 2, 3], [4, 5, 6]]
+outputs = linear.forward(batch)
+assert shape(outputs) == [2, 2]
+assert outputs[1] == linear.forward(batch[1])
+
+linear.forward(batch)
+linear.backward([[1, 0], [0, 1]])
+batch_w_grad = linear.w_grad.tolist()
+linear.forward(batch[0])
+linear.backward([1, 0])
+first_w_grad = linear.w_grad.tolist()
+linear.forward(batch[1])
+linear.backward([0, 1])
+assert batch_w_grad == [[a + b for a, b in zip(row1, row2)]
+                        for row1, row2 in zip(first_w_grad, linear.w_grad.tolist())]
+
+# and predict gives the same outputs as forward (on either backend):
+
+assert linear.predict(batch) == outputs
+if np is not None:
+    with use_backend("numpy"):
+        assert all(abs(p - o) < 1e-12
+                   for p, o in zip(linear.predict(batch).values(), outputs.values()))
+
+# Once predict has its buffer, it doesn't allocate anything the size of its
+# output again (here 5,000 x 2 doubles, or 80KB):
+
+big_batch = Tensor([[1.0, 2.0, 3.0]] * 5000)
+linear.predict(big_batch)
+assert peak_allocated(lambda: linear.predict(big_batch)) < 10_000
+
+# A float32 layer takes half the memory, and (since its sums are still done in
+# float64) its outputs only differ from the float64 layer's by the rounding of
+# its weights and its outputs:
+
+with use_dtype("float32"):
+    linear32 = Linear(3, 2)
+linear32.w.assign(linear.w)
+linear32.b.assign(linear.b)
+assert linear32.w.dtype == "float32" and linear32.w.data.itemsize == 4
+for backend in (("python", "numpy") if np is not None else ("python",)):
+    with use_backend(backend):
+        outputs32 = linear32.predict(batch)
+        assert outputs32.dtype == "float32"
+        assert all(abs(p - o) < 1e-6 * max(1, abs(o))
+                   for p, o in zip(outputs32.values(), outputs.values()))
+linear32.forward(batch)
+assert linear32.backward([[1, 0], [0, 1]]).dtype == "float32"
+assert linear32.w_grad.dtype == "float32"
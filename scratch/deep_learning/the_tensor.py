@@ -1,5 +1,9 @@
 import operator
-from typing import List, Callable
+from array import array
+from contextlib import contextmanager
+from itertools import chain
+import tracemalloc
+from typing import List, Callable, Iterable, Iterator, Sequence, Tuple
 
 
 # Deep learning originally referred to the application of “deep” neural networks
@@ -10,16 +14,301 @@ from typing import List, Callable
 # and matrices (two-dimensional arrays). When we start working with more complicated
 # neural networks, we’ll need to use higher-dimensional arrays as well.
 
-# In many neural network libraries, n-dimensional arrays are referred to as 
+# In many neural network libraries, n-dimensional arrays are referred to as
 # tensors, which is what we’ll call them too.
 
-# So, like I said, we’ll just cheat:
+# The easiest thing would be to cheat and say that a Tensor is just a list (of
+# lists, of lists, ...). That works, but every number in it is a separate Python
+# object, and every helper function has to walk the nesting recursively, which
+# is where almost all of the time goes once our layers get big.
 
-Tensor = list
+# Instead we’ll store all of a tensor’s values in one flat, contiguous array of
+# doubles, and keep track of its shape separately. The strides tell us how far
+# apart (in the flat buffer) consecutive entries along each dimension are, so
+# that entry [i][j] of a 3 x 4 tensor lives at position 4 * i + j:
 
-# And we’ll write a helper function to find a tensor’s shape:
+def _strides(shape: Sequence[int]) -> Tuple[int, ...]:
+    strides = []
+    step = 1
+    for dim in reversed(shape):
+        strides.append(step)
+        step *= dim
+    return tuple(reversed(strides))
+
+def _nested_shape(values) -> List[int]:
+    sizes: List[int] = []
+    while isinstance(values, (list, tuple)):
+        sizes.append(len(values))
+        if not values:
+            break
+        values = values[0]
+    if isinstance(values, Tensor):
+        sizes.extend(values.shape)
+    return sizes
+
+# Doubles take 8 bytes apiece, which is more precision than a neural network
+# usually needs. Storing the values as 4-byte floats instead halves the memory
+# (and the memory traffic) for the same model. So a Tensor can also hold
+# float32 values. Every time we read one, Python turns it into an ordinary
+# (64-bit) float, which means that anything we add up (like tensor_sum, or the
+# dot products in a Linear layer) still adds in float64, and only the stored
+# results get rounded.
+
+# New tensors get the default dtype, which (like the backend) is a global
+# setting you can change temporarily:
+
+DTYPES = {"float64": "d", "float32": "f"}
+
+_default_dtype = "float64"
+
+def typecode(dtype: str) -> str:
+    if dtype not in DTYPES:
+        raise ValueError(f"unknown dtype: {dtype}")
+    return DTYPES[dtype]
+
+def get_default_dtype() -> str:
+    return _default_dtype
+
+def set_default_dtype(dtype: str) -> None:
+    global _default_dtype
+    typecode(dtype)
+    _default_dtype = dtype
+
+@contextmanager
+def use_dtype(dtype: str) -> Iterator[None]:
+    previous = get_default_dtype()
+    set_default_dtype(dtype)
+    try:
+        yield
+    finally:
+        set_default_dtype(previous)
+
+class Tensor:
+    """
+    An n-dimensional array of floats, stored row-major in one flat buffer.
+    Indexing with an integer gives back a float (for a 1-d tensor) or a view
+    that shares the buffer (otherwise), so tensor[i][j] works just like it did
+    with nested lists.
+    """
+
+    def __init__(self, values=(), shape: Sequence[int]=None, dtype: str=None) -> None:
+        """
+        Either copies a (possibly nested) list or another Tensor, or wraps a
+        flat iterable of values with the given shape. Copies of a Tensor keep
+        its dtype unless you give one; everything else gets the default dtype.
+        """
+
+        if isinstance(values, Tensor):
+            code = typecode(dtype) if dtype else values.typecode
+            data = array(code, values.values())
+            shape = values.shape if shape is None else shape
+        elif shape is None:
+            shape = _nested_shape(values)
+            for _ in range(len(shape) - 1):
+                values = chain.from_iterable(values)
+            data = array(typecode(dtype or _default_dtype), values if shape else [values])
+        else:
+            # (array() fills up faster from a list than from an iterator)
+            data = array(typecode(dtype or _default_dtype),
+                         values if isinstance(values, (list, array)) else list(values))
+
+        self._wrap(data, shape, 0)
+
+        if len(data) != self.size:
+            raise ValueError(f"{len(data)} values don't fit shape {list(shape)}")
+
+    def _wrap(self, data, shape: Sequence[int], offset: int) -> None:
+        self.data = data
+        self.offset = offset
+        self.shape = tuple(shape)
+        self.strides = _strides(self.shape)
+        self.size = self.strides[0] * self.shape[0] if self.shape else 1
+
+    @classmethod
+    def from_buffer(cls, data, shape: Sequence[int], offset: int=0) -> "Tensor":
+        """
+        A tensor that uses data (anything indexable that holds doubles, like an
+        array("d"), an array("f") or a memoryview) as its storage without
+        copying it.
+        """
+
+        tensor = cls.__new__(cls)
+        tensor._wrap(data, shape, offset)
+        return tensor
+
+    def rebind(self, data, offset: int=0) -> None:
+        """
+        From now on, use data[offset:offset + size] as this tensor's storage
+        (without copying anything into it). Every view we hand out afterward
+        shares the new buffer.
+        """
+
+        self._wrap(data, self.shape, offset)
+
+    @property
+    def typecode(self) -> str:
+        data = self.data
+        return data.typecode if isinstance(data, array) else memoryview(data).format
+
+    @property
+    def dtype(self) -> str:
+        return "float32" if self.typecode == "f" else "float64"
+
+    def astype(self, dtype: str) -> "Tensor":
+        """
+        This tensor if it already has the given dtype, otherwise a copy with it.
+        """
+
+        return self if self.dtype == dtype else Tensor(self, dtype=dtype)
+
+    def values(self) -> memoryview:
+        """
+        A (flat, zero-copy) view of this tensor's values.
+        """
+
+        return memoryview(self.data)[self.offset:self.offset + self.size]
+
+    def tolist(self):
+        values = self.values().tolist()
+        if not self.shape:
+            return values[0]
+        for dim in reversed(self.shape[1:]):
+            values = [values[i:i + dim] for i in range(0, len(values), dim)]
+        return values
+
+    def copy(self) -> "Tensor":
+        return Tensor(self)
+
+    def assign(self, values) -> None:
+        """
+        Overwrites (in place) this tensor's values with the given ones.
+        """
+
+        source = values if isinstance(values, Tensor) else Tensor(values)
+        if source.size != self.size:
+            raise ValueError(f"can't assign shape {list(source.shape)} "
+                             f"to shape {list(self.shape)}")
+        values = source.values()
+        if values.format != self.typecode:
+            values = array(self.typecode, values)
+        self.values()[:] = values
+
+    def write(self, values: Iterable[float]) -> None:
+        """
+        Overwrites (in place) this tensor's values with exactly self.size
+        values from an iterable, one at a time, so that (unlike assign) no
+        temporary buffer of all of them gets built.
+        """
+
+        target = self.values()
+        count = 0
+        for count, value in enumerate(values, 1):
+            target[count - 1] = value          # (raises IndexError if too many)
+        if count != self.size:
+            raise ValueError(f"{count} values don't fit shape {list(self.shape)}")
+
+    def _index(self, i: int) -> int:
+        if i < 0:
+            i += self.shape[0]
+        if not 0 <= i < self.shape[0]:
+            raise IndexError("tensor index out of range")
+        return i
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.shape[0])
+            if step != 1:
+                return Tensor([self[i] for i in range(start, stop, step)])
+            rows = max(0, stop - start)
+            return Tensor.from_buffer(self.data,
+                                      (rows,) + self.shape[1:],
+                                      self.offset + start * self.strides[0])
+
+        index = self._index(index)
+        if len(self.shape) == 1:
+            return self.data[self.offset + index]
+        return Tensor.from_buffer(self.data,
+                                  self.shape[1:],
+                                  self.offset + index * self.strides[0])
+
+    def __setitem__(self, index, value) -> None:
+        if isinstance(index, slice) and index.step not in (None, 1):
+            for i, v in zip(range(*index.indices(self.shape[0])), value):
+                self[i] = v
+        elif isinstance(index, slice) or len(self.shape) > 1:
+            self[index].assign(value)
+        else:
+            self.data[self.offset + self._index(index)] = value
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __iter__(self) -> Iterator:
+        if len(self.shape) == 1:
+            return iter(self.values())
+        return (self[i] for i in range(self.shape[0]))
+
+    def index(self, value: float) -> int:
+        return list(self).index(value)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Tensor):
+            return self.shape == other.shape and self.tolist() == other.tolist()
+        if isinstance(other, list):
+            return self.tolist() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"Tensor({self.tolist()})"
+
+    def __reduce__(self):
+        # Pickle (and copy) just the values this tensor can see.
+        return (Tensor, (array(self.typecode, self.values()), self.shape))
+
+# Most of the time we don’t care whether someone handed us a Tensor or a plain
+# (nested) list, so we’ll write a helper that gives us a Tensor either way,
+# without copying if it already is one:
+
+def as_tensor(values) -> Tensor:
+    return values if isinstance(values, Tensor) else Tensor(values)
+
+def zeros(*dims: int, dtype: str=None) -> Tensor:
+    size = 1
+    for dim in dims:
+        size *= dim
+    return Tensor.from_buffer(array(typecode(dtype or _default_dtype), [0.0]) * size, dims)
+
+t = Tensor([[1, 2, 3], [4, 5, 6]])
+assert t.shape == (2, 3) and t.strides == (3, 1)
+assert t[1][2] == 6 and t[-1][0] == 4
+assert t[1] == [4, 5, 6]
+t[0][1] = 10                                # views share the buffer
+assert t.tolist() == [[1, 10, 3], [4, 5, 6]]
+t[:] = [[0, 0, 0], [1, 1, 1]]               # slice assignment works in place
+assert t == [[0, 0, 0], [1, 1, 1]]
+assert zeros(2, 2) == [[0, 0], [0, 0]]
+
+# A float32 tensor holds the same values (rounded to float32) in half the space:
+
+t32 = Tensor([[0.1, 0.2], [0.3, 0.4]], dtype="float32")
+assert t32.dtype == "float32" and t32[0].dtype == "float32"
+assert t32.data.itemsize == 4 and abs(t32[1][1] - 0.4) < 1e-7
+assert Tensor(t32).dtype == "float32" and t32.astype("float64").dtype == "float64"
+with use_dtype("float32"):
+    assert zeros(2).dtype == "float32" and Tensor([1, 2]).dtype == "float32"
+assert zeros(2).dtype == "float64"
+t32[0] = Tensor([1.5, 2.5])                   # (assign converts as needed)
+assert t32[0] == [1.5, 2.5]
+
+# And we’ll write a helper function to find a tensor’s shape (which still works
+# on plain nested lists, too):
 
 def shape(tensor: Tensor) -> List[int]:
+    if isinstance(tensor, Tensor):
+        return list(tensor.shape)
+
     sizes: List[int] = []
     while isinstance(tensor, list):
         sizes.append(len(tensor))
@@ -28,57 +317,107 @@ def shape(tensor: Tensor) -> List[int]:
 
 assert shape([1, 2, 3]) == [3]
 assert shape([[1, 2], [3, 4], [5, 6]]) == [3, 2]
+assert shape(Tensor([[1, 2], [3, 4], [5, 6]])) == [3, 2]
 
-# Because tensors can have any number of dimensions, we’ll typically need to
-# work with them recursively. We’ll do one thing in the one-dimensional case
-# and recurse in the higher-dimensional case:
+# For plain lists we’ll typically need to work recursively. We’ll do one thing
+# in the one-dimensional case and recurse in the higher-dimensional case. For a
+# Tensor, on the other hand, we can just run over its flat buffer:
 
 def is_1d(tensor: Tensor) -> bool:
     """
     If tensor[0] is a list, it's a higher-order tensor.
     """
 
-    return not isinstance(tensor[0], list)
+    if isinstance(tensor, Tensor):
+        return len(tensor.shape) == 1
+    return not isinstance(tensor[0], (list, Tensor))
 
 assert is_1d([1, 2, 3])
 assert not is_1d([[1, 2], [3, 4]])
+assert not is_1d(Tensor([[1, 2], [3, 4]]))
 
-# which we can use to write a recursive tensor_sum function:
+# which we can use to write a tensor_sum function:
 
 def tensor_sum(tensor: Tensor) -> float:
     """
     Sums up all the values in the tensor.
     """
 
-    if is_1d(tensor):
+    if isinstance(tensor, Tensor):
+        return sum(tensor.values())
+    elif is_1d(tensor):
         return sum(tensor)
     else:
         return sum([tensor_sum(t) for t in tensor])
 
 assert tensor_sum([1, 2, 3]) == 6
 assert tensor_sum([[1, 2], [3, 4]]) == 10
+assert tensor_sum(Tensor([[1, 2], [3, 4]])) == 10
 
-def tensor_apply(f: Callable[[float], float], tensor: Tensor) -> Tensor:
+def tensor_apply(f: Callable[[float], float],
+                 tensor: Tensor,
+                 out: Tensor=None) -> Tensor:
     """
-    Applies f elementwise.
+    Applies f elementwise. If out (a Tensor the same size) is given, the
+    results are written into it instead of a new Tensor.
     """
 
-    if is_1d(tensor):
+    if out is not None:
+        tensor = as_tensor(tensor)
+        if tensor.size != out.size:
+            raise ValueError(f"can't write shape {list(tensor.shape)} "
+                             f"into shape {list(out.shape)}")
+        out.write(map(f, tensor.values()))
+        return out
+    if isinstance(tensor, Tensor):
+        return Tensor(map(f, tensor.values()), tensor.shape)
+    elif is_1d(tensor):
         return [f(t) for t in tensor]
     else:
         return [tensor_apply(f, t) for t in tensor]
 
 assert tensor_apply(lambda x: x + 1, [1, 2, 3]) == [2, 3, 4]
 assert tensor_apply(lambda x: 2 * x, [[1, 2], [3, 4]]) == [[2, 4], [6, 8]]
+assert tensor_apply(lambda x: 2 * x, Tensor([[1, 2], [3, 4]])) == [[2, 4], [6, 8]]
+out = zeros(3)
+assert tensor_apply(lambda x: x + 1, [1, 2, 3], out=out) is out and out == [2, 3, 4]
+
+# and writing into out doesn't allocate another tensor's worth of memory:
+
+def peak_allocated(f: Callable[[], None]) -> int:
+    """
+    The most memory (in bytes) allocated at once while calling f.
+    """
+
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        f()
+        return tracemalloc.get_traced_memory()[1] - before
+    finally:
+        if started:
+            tracemalloc.stop()
+
+big, big_out = Tensor([0.5] * 100_000), zeros(100_000)
+assert peak_allocated(lambda: tensor_apply(lambda x: 2 * x, big, out=big_out)) < 10_000
+assert big_out[99_999] == 1.0
 
 def zeros_like(tensor: Tensor) -> Tensor:
+    if isinstance(tensor, Tensor):
+        return zeros(*tensor.shape, dtype=tensor.dtype)
     return tensor_apply(lambda _: .0, tensor)
 
 assert zeros_like([1, 2, 3]) == [0, 0, 0]
 assert zeros_like([[1, 2], [3, 4]]) == [[0, 0], [0, 0]]
+assert zeros_like(Tensor([[1, 2], [3, 4]])) == [[0, 0], [0, 0]]
 
-# We’ll also need to apply a function to corresponding elements from two tensors
-# (which had better be the exact same shape, although we won’t check that):
+# We’ll also need to apply a function to corresponding elements from two tensors.
+# With nested lists we didn’t bother checking that they’re the same shape, but
+# with flat buffers a mismatch would silently pair up the wrong elements, so for
+# Tensors we do check:
 
 def tensor_combine(f: Callable[[float, float], float],
                    t1: Tensor,
@@ -87,10 +426,17 @@ def tensor_combine(f: Callable[[float, float], float],
     Apply f to corresponding elements of t1 and t2.
     """
 
-    if is_1d(t1):
+    if isinstance(t1, Tensor) or isinstance(t2, Tensor):
+        t1, t2 = as_tensor(t1), as_tensor(t2)
+        if t1.shape != t2.shape:
+            raise ValueError(f"shapes {list(t1.shape)} and {list(t2.shape)} "
+                             "don't match")
+        return Tensor(map(f, t1.values(), t2.values()), t1.shape)
+    elif is_1d(t1):
         return [f(t1_, t2_) for t1_, t2_ in zip(t1, t2)]
     else:
         return [tensor_combine(f, t1_, t2_) for t1_, t2_ in zip(t1, t2)]
 
 assert tensor_combine(operator.add, [1, 2, 3], [4, 5, 6]) == [5, 7, 9]
 assert tensor_combine(operator.mul, [1, 2, 3], [4, 5, 6]) == [4, 10, 18]
+assert tensor_combine(operator.mul, Tensor([1, 2, 3]), [4, 5, 6]) == [4, 10, 18]
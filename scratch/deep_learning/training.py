@@ -0,0 +1,392 @@
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+from array import array
+import math
+import random
+
+import tqdm
+
+from scratch.machine_learning.overfitting_and_underfitting import train_test_split
+from scratch.deep_learning.the_tensor import Tensor, as_tensor, tensor_apply
+from scratch.deep_learning.the_layer_abstraction import Layer
+from scratch.deep_learning.loss_and_optimization import Loss, Optimizer
+from scratch.deep_learning.saving_and_loading_models import save_checkpoint
+
+
+# Every training loop we've written so far (loop in example_mnist, the fizz
+# buzz scripts) runs for a fixed number of epochs with a fixed learning rate,
+# and the only way to see how it's going is to watch the progress bar. That
+# wastes a lot of work: usually the loss on data the model isn't trained on
+# stops improving long before the last epoch, and everything after that only
+# makes the model overfit.
+
+# So here's a reusable Trainer that does three things our loops don't. It
+# changes the learning rate as training goes (according to a schedule), it
+# evaluates the model on held-out validation data after every epoch, and it
+# hands the resulting metrics to callbacks, which can (for example) save a
+# checkpoint or stop training early.
+
+# A schedule is just a function from the number of steps (minibatches) taken so
+# far to the learning rate for the next one. The classic choices are to start
+# high and cut the rate by some factor every so many steps:
+
+Schedule = Callable[[int], float]
+
+def constant(lr: float) -> Schedule:
+    return lambda step: lr
+
+def step_decay(lr: float, every: int, gamma: float=0.1) -> Schedule:
+    return lambda step: lr * gamma ** (step // every)
+
+# or to glide smoothly from lr down to min_lr along half a cosine:
+
+def cosine(lr: float, total_steps: int, min_lr: float=0.0) -> Schedule:
+    def schedule(step: int) -> float:
+        progress = min(step, total_steps) / total_steps
+        return min_lr + (lr - min_lr) * (1 + math.cos(math.pi * progress)) / 2
+    return schedule
+
+# Big learning rates can throw a freshly initialized network somewhere it never
+# recovers from, so it also helps to warm up, by raising the rate linearly
+# over the first few steps before following some other schedule:
+
+def warmup(schedule: Schedule, warmup_steps: int) -> Schedule:
+    def warmed_up(step: int) -> float:
+        if step < warmup_steps:
+            return schedule(0) * (step + 1) / warmup_steps
+        return schedule(step - warmup_steps)
+    return warmed_up
+
+assert step_decay(1.0, every=10, gamma=0.5)(25) == 0.25
+assert cosine(1.0, 100)(0) == 1.0 and cosine(1.0, 100)(100) == 0.0
+assert abs(cosine(1.0, 100, min_lr=0.2)(50) - 0.6) < 1e-12
+assert [warmup(constant(1.0), 4)(step) for step in range(6)] == [0.25, 0.5, 0.75, 1, 1, 1]
+
+# After every epoch, the trainer calls each callback with itself and that
+# epoch's metrics, a dict like {"epoch": 3, "loss": 0.31, "accuracy": 0.9,
+# "lr": 0.01, "val_loss": 0.35, "val_accuracy": 0.88}. A callback can
+# end training by setting trainer.stop to True. (The val_ metrics are only
+# there if fit was given validation data.)
+
+class Callback:
+    def on_train_begin(self, trainer: "Trainer") -> None:
+        pass
+
+    def on_epoch_end(self, trainer: "Trainer", metrics: Dict[str, float]) -> None:
+        pass
+
+    def on_train_end(self, trainer: "Trainer") -> None:
+        pass
+
+def monitored(metrics: Dict[str, float], monitor: str) -> float:
+    if monitor not in metrics:
+        raise ValueError(f"can't monitor {monitor!r}, the metrics are only "
+                         f"{sorted(metrics)} (val_ metrics need validation data)")
+    return metrics[monitor]
+
+# The most useful one is early stopping: keep track of the best validation
+# loss so far, give up once it hasn't improved (by more than min_delta) for
+# patience epochs in a row, and put back the parameters from the best epoch.
+
+class EarlyStopping(Callback):
+    def __init__(self,
+                 monitor: str="val_loss",
+                 patience: int=3,
+                 min_delta: float=0.0,
+                 restore_best: bool=True) -> None:
+        self.monitor = monitor
+        self.patience = patience
+        self.min_delta = min_delta
+        self.restore_best = restore_best
+        self.on_train_begin(None)
+
+    def on_train_begin(self, trainer: "Trainer") -> None:
+        # (Every call to fit starts over.)
+        self.best = math.inf
+        self.best_epoch = None
+        self.best_params: List[Tensor] = []
+        self.bad_epochs = 0
+
+    def on_epoch_end(self, trainer: "Trainer", metrics: Dict[str, float]) -> None:
+        value = monitored(metrics, self.monitor)
+        if value < self.best - self.min_delta:
+            self.best = value
+            self.best_epoch = metrics["epoch"]
+            self.bad_epochs = 0
+            if self.restore_best:
+                self.best_params = [Tensor(as_tensor(param))
+                                    for param in trainer.model.params()]
+        else:
+            self.bad_epochs += 1
+            if self.bad_epochs >= self.patience:
+                trainer.stop = True
+
+    def on_train_end(self, trainer: "Trainer") -> None:
+        for param, best in zip(trainer.model.params(), self.best_params):
+            as_tensor(param).assign(best)
+
+# Another saves a checkpoint (see saving_and_loading_models.py) every so many
+# epochs, or, if it's given a metric to monitor, whenever that metric reaches
+# a new low:
+
+class Checkpoint(Callback):
+    def __init__(self,
+                 filename: str,
+                 every: int=1,
+                 monitor: str=None,
+                 dtype: str="float64") -> None:
+        self.filename = filename
+        self.every = every
+        self.monitor = monitor
+        self.dtype = dtype
+        self.best = math.inf
+        self.saved_epochs: List[int] = []
+
+    def on_epoch_end(self, trainer: "Trainer", metrics: Dict[str, float]) -> None:
+        if self.monitor is not None:
+            value = monitored(metrics, self.monitor)
+            if value >= self.best:
+                return
+            self.best = value
+        elif metrics["epoch"] % self.every != 0:
+            return
+
+        save_checkpoint(trainer.model, self.filename, trainer.optimizer, self.dtype)
+        self.saved_epochs.append(metrics["epoch"])
+
+# Layers like Dropout behave differently during training and evaluation, so
+# the trainer flips their train flags (wherever they are in the model) as it
+# goes back and forth:
+
+def set_train_mode(model: Layer, train: bool) -> None:
+    if hasattr(model, "train"):
+        model.train = train
+    for layer in getattr(model, "layers", []):
+        set_train_mode(layer, train)
+
+# train_test_split hands back lists of examples, and turning a slice of a list
+# of Tensors into a batch one number at a time is slow. So we stack each list
+# into one big Tensor up front (whose slices are views), copying the examples'
+# buffers wholesale:
+
+def stack(examples: List) -> Any:
+    if not examples or not isinstance(examples[0], Tensor):
+        return examples
+    data = array(examples[0].typecode)
+    for example in examples:
+        data.frombytes(example.values().cast("B"))
+    return Tensor.from_buffer(data, (len(examples),) + examples[0].shape)
+
+def _correct(predicted: Tensor, labels: Sequence) -> int:
+    return sum(1 for p, label in zip(predicted, labels)
+               if p.index(max(p)) == (label if isinstance(label, int)
+                                      else list(label).index(max(label))))
+
+# Otherwise an epoch is the same as in our old loop: forward, loss, backward
+# (with the gradient divided by the batch size) and an optimizer step, one
+# minibatch at a time. (Set accuracy=False when the model isn't a classifier.)
+
+class Trainer:
+    def __init__(self,
+                 model: Layer,
+                 loss: Loss,
+                 optimizer: Optimizer,
+                 schedule: Schedule=None,
+                 batch_size: int=32,
+                 callbacks: Sequence[Callback]=(),
+                 accuracy: bool=True,
+                 progress: bool=True) -> None:
+        self.model = model
+        self.loss = loss
+        self.optimizer = optimizer
+        self.schedule = schedule
+        self.batch_size = batch_size
+        self.callbacks = list(callbacks)
+        self.accuracy = accuracy
+        self.progress = progress
+        self.steps = 0
+        self.stop = False
+        self.history: List[Dict[str, float]] = []
+        self._split = None
+
+    def _batches(self, count: int, description: str):
+        starts = range(0, count, self.batch_size)
+        return tqdm.tqdm(starts, desc=description, leave=False) if self.progress else starts
+
+    def train_epoch(self, xs: List, ys: List) -> Dict[str, float]:
+        set_train_mode(self.model, True)
+        total_loss, correct = 0.0, 0
+
+        for start in self._batches(len(xs), "train"):
+            if self.schedule is not None:
+                self.optimizer.lr = self.schedule(self.steps)
+
+            batch_xs = as_tensor(xs[start:start + self.batch_size])
+            batch_ys = ys[start:start + self.batch_size]
+            n = len(batch_ys)
+
+            predicted = self.model.forward(batch_xs)
+            batch_loss, gradient = self.loss.loss_and_gradient(predicted, batch_ys)
+            self.model.backward(tensor_apply(lambda g: g / n, gradient))
+            self.optimizer.step(self.model)
+            self.steps += 1
+
+            total_loss += batch_loss
+            if self.accuracy:
+                correct += _correct(predicted, batch_ys)
+
+        metrics = {"loss": total_loss / len(xs)}
+        if self.accuracy:
+            metrics["accuracy"] = correct / len(xs)
+        return metrics
+
+    def evaluate(self, xs: List, ys: List) -> Dict[str, float]:
+        """
+        The average loss (and the accuracy) on the given data, without
+        training.
+        """
+
+        set_train_mode(self.model, False)
+        total_loss, correct = 0.0, 0
+
+        for start in self._batches(len(xs), "evaluate"):
+            batch_ys = ys[start:start + self.batch_size]
+            predicted = self.model.predict(as_tensor(xs[start:start + self.batch_size]))
+            total_loss += self.loss.loss(predicted, batch_ys)
+            if self.accuracy:
+                correct += _correct(predicted, batch_ys)
+
+        metrics = {"loss": total_loss / len(xs)}
+        if self.accuracy:
+            metrics["accuracy"] = correct / len(xs)
+        return metrics
+
+    def fit(self,
+            xs: List,
+            ys: List,
+            epochs: int,
+            validation: Tuple[List, List]=None,
+            validation_pct: float=None) -> List[Dict[str, float]]:
+        """
+        Trains for up to epochs epochs (fewer if a callback stops it) and
+        returns the metrics from every epoch. The validation data is either
+        given as (xs, ys) or split off from the training data.
+        """
+
+        if validation is None and validation_pct is not None:
+            # Split the same data the same way every time we're called, so
+            # that later calls don't train on earlier calls' validation data.
+            split = self._split
+            if split is None or split[0] is not xs or split[1] is not ys \
+                    or split[2] != validation_pct:
+                train_xs, val_xs, train_ys, val_ys = train_test_split(xs, ys, validation_pct)
+                self._split = (xs, ys, validation_pct,
+                               (stack(train_xs), stack(train_ys)),
+                               (stack(val_xs), stack(val_ys)))
+            (xs, ys), validation = self._split[3:]
+
+        if validation is None:
+            for callback in self.callbacks:
+                monitor = getattr(callback, "monitor", None)
+                if monitor is not None and monitor.startswith("val_"):
+                    raise ValueError(f"{type(callback).__name__} monitors {monitor!r}, "
+                                     "so fit needs validation data")
+
+        for callback in self.callbacks:
+            callback.on_train_begin(self)
+        self.stop = False
+        for epoch in range(len(self.history) + 1, len(self.history) + epochs + 1):
+            metrics: Dict[str, Any] = {"epoch": epoch}
+            metrics.update(self.train_epoch(xs, ys))
+            metrics["lr"] = self.optimizer.lr            # (as of the last step)
+            if validation is not None:
+                metrics.update((f"val_{name}", value)
+                               for name, value in self.evaluate(*validation).items())
+
+            self.history.append(metrics)
+            if self.progress:
+                tqdm.tqdm.write(" ".join(f"{name}: {value:.4g}"
+                                         for name, value in metrics.items()))
+
+            for callback in self.callbacks:
+                callback.on_epoch_end(self, metrics)
+            if self.stop:
+                break
+
+        for callback in self.callbacks:
+            callback.on_train_end(self)
+        return self.history
+
+assert stack([Tensor([1, 2]), Tensor([3, 4])]) == [[1, 2], [3, 4]]
+assert stack([0, 1]) == [0, 1]
+
+# Callbacks that watch a validation metric need validation data, and each call
+# to fit starts their bookkeeping over, but trains and validates on the same
+# split as the last call:
+
+from scratch.deep_learning.neural_networks_as_a_sequence_of_layers import Sequential
+from scratch.deep_learning.the_linear_layer import Linear
+from scratch.deep_learning.loss_and_optimization import SSE, GradientDescent
+
+random.seed(0)
+line_xs = [[random.random(), random.random()] for _ in range(20)]
+line_ys = [[x0 - 2 * x1] for x0, x1 in line_xs]
+stopping = EarlyStopping(patience=2)
+line_trainer = Trainer(Sequential([Linear(2, 1)]), SSE(), GradientDescent(0.05),
+                       batch_size=5, callbacks=[stopping], accuracy=False, progress=False)
+
+try:
+    line_trainer.fit(line_xs, line_ys, epochs=1)
+    assert False, "fit without validation data didn't complain"
+except ValueError:
+    pass
+
+first_epochs = len(line_trainer.fit(line_xs, line_ys, epochs=3, validation_pct=0.25))
+first_split = line_trainer._split
+stopping.best = -math.inf                      # (as if it couldn't be beaten)
+line_trainer.fit(line_xs, line_ys, epochs=3, validation_pct=0.25)
+assert line_trainer._split is first_split
+assert stopping.best_epoch > first_epochs
+
+# For example, a network with far more parameters than it has training
+# examples (only two of whose 20 features matter) starts to overfit well before
+# its 100 epochs are up, and ends up with the parameters from its best epoch.
+# (If you run this file. It takes a few seconds.)
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+
+    from scratch.deep_learning.other_activation_functions import Tanh
+    from scratch.deep_learning.loss_and_optimization import Momentum
+    from scratch.deep_learning.softmaxes_and_cross_entropy import SoftmaxCrossEntropy
+    from scratch.deep_learning.saving_and_loading_models import load_checkpoint
+
+    random.seed(0)
+    xs = [[random.uniform(-1, 1) for _ in range(20)] for _ in range(100)]
+    ys = [int(x[0] + x[1] + random.gauss(0, 0.3) > 0) for x in xs]
+    model = Sequential([Linear(20, 32), Tanh(), Linear(32, 2)])
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "best.ckpt")
+        early_stopping = EarlyStopping(patience=5)
+        checkpoint = Checkpoint(filename, monitor="val_loss")
+        trainer = Trainer(model, SoftmaxCrossEntropy(), Momentum(0.03, 0.9),
+                          schedule=warmup(step_decay(0.03, every=200, gamma=0.5), 10),
+                          batch_size=10,
+                          callbacks=[early_stopping, checkpoint],
+                          progress=False)
+        history = trainer.fit(xs, ys, epochs=100, validation_pct=0.3)
+
+        assert len(history) < 50
+        assert len(history) == early_stopping.best_epoch + early_stopping.patience
+        assert history[0]["lr"] < history[1]["lr"] == 0.03 > history[-1]["lr"]
+
+        # The best epoch's parameters are back in the model, and in the checkpoint:
+        best = history[early_stopping.best_epoch - 1]
+        assert best["val_loss"] == min(metrics["val_loss"] for metrics in history)
+        assert best["val_accuracy"] > 0.8
+        assert checkpoint.saved_epochs[-1] == early_stopping.best_epoch
+
+        restored = Sequential([Linear(20, 32), Tanh(), Linear(32, 2)])
+        load_checkpoint(restored, filename)
+        assert [as_tensor(p) for p in restored.params()] == [as_tensor(p) for p in model.params()]
@@ -34,7 +34,7 @@ def partial_difference_quotient(f: Callable[[List[float]], float],
     Return the i-th partial difference quotient of f at v.
     """
 
-    w = [v_j + h if j == 1 else v_j for j, v_j in enumerate(v)]
+    w = [v_j + h if j == i else v_j for j, v_j in enumerate(v)]
     return (f(w) - f(v)) / h
 
 # same as above
@@ -45,6 +45,11 @@ def estimate_gradient(f: Callable[[List[float]], float],
                       h: float=0.000_1):
     return [partial_difference_quotient(f, v, i, h) for i in range(len(v))]
 
+# For example, the gradient of the sum of squares is 2 * v:
+
+estimate = estimate_gradient(lambda v: sum(v_i ** 2 for v_i in v), [1, 2, 3])
+assert all(abs(e - 2 * v_i) < 0.001 for e, v_i in zip(estimate, [1, 2, 3]))
+
 plt.title("Actual Derivatives vs. Estimates using derivative")
 estimates = [derivative(square, x, 0.000_1) for x in xs]
 plt.plot(xs, actuals, "rx", label="actual")
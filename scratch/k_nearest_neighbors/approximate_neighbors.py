@@ -0,0 +1,283 @@
+from typing import Any, Dict, List, Tuple
+from collections import defaultdict
+import heapq
+import math
+import random
+import time
+
+from scratch.linear_algebra.backends import get_backend, np
+from scratch.linear_algebra.vectors import Vector, dot, squared_distance
+from scratch.probability.sampling import normal_samples, uniform_samples
+from scratch.k_nearest_neighbors.the_model import LabeledPoint, knn_classify
+
+
+# The spatial indexes in spatial_indexes.py find the exact k nearest neighbors,
+# but in hundreds of dimensions they end up looking at nearly every point
+# anyway. (That's the curse of dimensionality again: when every point is
+# almost as far away as every other one, no box or ball can rule many of them
+# out.) If we're willing to occasionally miss one of the true k nearest, we can
+# do much better.
+
+# Locality-sensitive hashing uses random projections. Pick a random direction
+# a (with normally distributed coordinates) and a random offset b between 0
+# and some width w, and hash a point v to the number of the "slab"
+#
+#   floor((a . v + b) / w)
+#
+# that it lands in. Two nearby points usually land in the same slab, and two
+# far-apart points usually don't. If we glue together the slab numbers from
+# num_projections different directions, then points that share all of them are
+# very likely to be close (more projections means fewer, closer candidates).
+# Any one such hash table can miss a close point that happened to fall across
+# a slab boundary, so we use num_tables independent tables and look at every
+# point that shares a bucket with the query in any of them (more tables means
+# better recall, but more candidates to check).
+
+# To find the k nearest, we compute the exact distances to the candidates only
+# (and if there are fewer than k of them, to every point).
+
+# The width should be a few times the distance between a typical point and
+# its nearest neighbor, which we can estimate from a small sample of points.
+# (Real data often has exact duplicates, like the iris dataset does, so we
+# measure the distance to the nearest point that isn't in the same place.)
+
+def nearest_neighbor_distance(points: List[Vector],
+                              rng: random.Random,
+                              num_samples: int=20) -> float:
+    """
+    0 if there aren't two different points to measure.
+    """
+
+    distances = []
+    if len(points) >= 2:
+        for _ in range(num_samples):
+            i = rng.randrange(len(points))
+            squared = [squared_distance(list(points[i]), list(point))
+                       for j, point in enumerate(points) if j != i]
+            squared = [d for d in squared if d > 0]
+            if squared:
+                distances.append(math.sqrt(min(squared)))
+    return sum(distances) / len(distances) if distances else 0.0
+
+class LSHIndex:
+    """
+    Finds (approximately) the k nearest of a fixed list of labeled points.
+    """
+
+    def __init__(self,
+                 labeled_points: List[LabeledPoint],
+                 num_tables: int=20,
+                 num_projections: int=6,
+                 bucket_width: float=None,
+                 rng: random.Random=None,
+                 backend: str=None) -> None:
+        if not labeled_points:
+            raise ValueError("an LSHIndex needs at least one labeled point")
+        rng = rng or random.Random(0)
+        self.backend = get_backend(backend)
+        self.labeled_points = labeled_points
+        self.num_tables = num_tables
+        self.num_projections = num_projections
+
+        if self.backend == "numpy":
+            self.points = np.array([lp.point for lp in labeled_points], dtype=float)
+        else:
+            self.points = [list(lp.point) for lp in labeled_points]
+
+        if bucket_width is None:
+            # (If all the points are in the same place, any width will do.)
+            bucket_width = 4 * nearest_neighbor_distance(self.points, rng) or 1.0
+        if not (bucket_width > 0 and math.isfinite(bucket_width)):
+            raise ValueError(f"bucket_width must be positive and finite, not {bucket_width}")
+        self.bucket_width = bucket_width
+
+        dim = len(labeled_points[0].point)
+        num_hashes = num_tables * num_projections
+        self.directions = [list(normal_samples(dim, rng=rng)) for _ in range(num_hashes)]
+        self.offsets = list(uniform_samples(num_hashes, 0, self.bucket_width, rng=rng))
+        if self.backend == "numpy":
+            self._directions = np.array(self.directions)
+            self._offsets = np.array(self.offsets)
+
+        self.tables: List[Dict[Tuple[int, ...], List[int]]] = \
+            [defaultdict(list) for _ in range(num_tables)]
+        for i, keys in enumerate(self._keys(self.points)):
+            for table, key in zip(self.tables, keys):
+                table[key].append(i)
+
+    def _keys(self, vectors) -> List[List[Tuple[int, ...]]]:
+        """
+        For each vector, its key in each table.
+        """
+
+        m, w = self.num_projections, self.bucket_width
+        if self.backend == "numpy":
+            slabs = np.floor((np.asarray(vectors, dtype=float) @ self._directions.T
+                              + self._offsets) / w).astype(int).tolist()
+        else:
+            slabs = [[math.floor((dot(a, v) + b) / w)
+                      for a, b in zip(self.directions, self.offsets)]
+                     for v in vectors]
+        return [[tuple(row[t * m:(t + 1) * m]) for t in range(self.num_tables)]
+                for row in slabs]
+
+    def candidates(self, query: Vector) -> List[int]:
+        """
+        The indices of the points that share a bucket with query in any table.
+        """
+
+        found = set()
+        for table, key in zip(self.tables, self._keys([query])[0]):
+            found.update(table.get(key, ()))
+        return sorted(found)
+
+    def nearest(self, k: int, query: Vector) -> List[Tuple[float, LabeledPoint]]:
+        """
+        (Probably) the k labeled points nearest to query, with their distances,
+        from nearest to farthest.
+        """
+
+        if k <= 0:
+            return []
+
+        candidates = self.candidates(query)
+        if len(candidates) < k:
+            candidates = list(range(len(self.labeled_points)))
+
+        if self.backend == "numpy":
+            candidates = np.array(candidates, dtype=int)
+            squared = ((self.points[candidates] - np.asarray(query, dtype=float)) ** 2).sum(axis=1)
+            if len(candidates) > k:
+                keep = np.argpartition(squared, k - 1)[:k]
+                candidates, squared = candidates[keep], squared[keep]
+            nearest = sorted(zip(squared.tolist(), candidates.tolist()))
+        else:
+            squared = [squared_distance(self.points[i], list(query)) for i in candidates]
+            nearest = heapq.nsmallest(k, zip(squared, candidates))
+
+        return [(math.sqrt(d), self.labeled_points[i]) for d, i in nearest]
+
+# Because LSHIndex has the same nearest method as the exact indexes, knn_classify
+# can use it too: knn_classify(k, labeled_points, new_point, index=lsh_index).
+
+# How good is "approximately"? The recall is the fraction of the true k nearest
+# neighbors that the index finds. exact_nearest gives us the true ones (by brute
+# force), and recall_and_latency compares the two on random queries:
+
+def exact_nearest(k: int, points: List[Vector], query: Vector) -> List[int]:
+    return heapq.nsmallest(k, range(len(points)),
+                           key=lambda i: squared_distance(points[i], query))
+
+def recall_and_latency(index: LSHIndex,
+                       queries: List[Vector],
+                       k: int=10) -> Dict[str, float]:
+    """
+    The average recall of index on the queries, and the average time per
+    query (in milliseconds) of the index and of brute force.
+    """
+
+    points = [lp.point for lp in index.labeled_points]
+    by_id = {id(lp): i for i, lp in enumerate(index.labeled_points)}
+
+    start = time.perf_counter()
+    approximate = [[by_id[id(lp)] for _, lp in index.nearest(k, query)] for query in queries]
+    middle = time.perf_counter()
+    if index.backend == "numpy":
+        exact = [np.argpartition(((index.points - np.asarray(query)) ** 2).sum(axis=1),
+                                 k - 1)[:k].tolist()
+                 for query in queries]
+    else:
+        exact = [exact_nearest(k, points, query) for query in queries]
+    end = time.perf_counter()
+
+    recall = sum(len(set(a) & set(e)) for a, e in zip(approximate, exact)) / (k * len(queries))
+    return {"recall": recall,
+            "candidates": sum(len(index.candidates(q)) for q in queries) / len(queries),
+            "lsh_ms": 1000 * (middle - start) / len(queries),
+            "exact_ms": 1000 * (end - middle) / len(queries)}
+
+# On points spread uniformly through the unit cube, as in
+# the_curse_of_dimensionality.py, the recall falls off as the dimension grows,
+# since nearest neighbors there are barely nearer than anything else. Real
+# high-dimensional data (like embeddings) usually has much more structure: it
+# sits in clusters, near some lower-dimensional surface. To mimic that we'll
+# also generate points scattered around a few random cluster centers:
+
+def random_point(dim: int, rng: random.Random) -> Vector:
+    return [rng.random() for _ in range(dim)]
+
+def clustered_points(num_points: int,
+                     dim: int,
+                     num_clusters: int,
+                     spread: float,
+                     rng: random.Random) -> List[Vector]:
+    centers = [random_point(dim, rng) for _ in range(num_clusters)]
+    return [[c + rng.gauss(0, spread) for c in rng.choice(centers)]
+            for _ in range(num_points)]
+
+# On a small clustered example the index finds almost all of the true nearest
+# neighbors while computing distances to only a few percent of the points, and
+# knn_classify gives the same answers with it as without it:
+
+points = clustered_points(2020, 64, num_clusters=20, spread=0.05, rng=random.Random(0))
+points, queries = points[:2000], points[2000:]
+labeled_points = [LabeledPoint(point, str(i % 20)) for i, point in enumerate(points)]
+
+backend = "numpy" if np is not None else "python"
+lsh = LSHIndex(labeled_points, backend=backend)
+stats = recall_and_latency(lsh, queries[:10], k=5)
+assert stats["recall"] >= 0.95
+assert stats["candidates"] < 0.1 * len(points)
+assert all(knn_classify(5, labeled_points, query, index=lsh)
+           == knn_classify(5, labeled_points, query)
+           for query in queries[:3])
+
+# And with a single projection per table and a huge width, every point shares
+# a bucket with every query, so the answers are exact:
+
+coarse = LSHIndex(labeled_points[:200], num_tables=1, num_projections=1, bucket_width=1e9)
+assert [lp for _, lp in coarse.nearest(5, queries[0])] == \
+    [labeled_points[i] for i in exact_nearest(5, points[:200], queries[0])]
+assert coarse.nearest(0, queries[0]) == []
+
+# Duplicate points don't shrink the width to 0, an index of a single point
+# works, and a width that isn't positive is an error:
+
+duplicated = labeled_points[:100] + labeled_points[:100]
+for points_backend in ["python", backend]:
+    index = LSHIndex(duplicated, backend=points_backend)
+    assert 0 < index.bucket_width < math.inf
+    assert index.candidates(queries[0]) != list(range(len(duplicated)))
+
+single = LSHIndex(labeled_points[:1])
+assert single.bucket_width == 1.0
+assert single.nearest(3, queries[0])[0][1] == labeled_points[0]
+
+for width in [0, -1.0, math.inf]:
+    try:
+        LSHIndex(labeled_points[:10], bucket_width=width)
+        assert False, f"bucket_width={width} was accepted"
+    except ValueError:
+        pass
+
+# If you run this file, it sweeps the dimension (like random_distance does) for
+# both kinds of data and prints the recall and how much faster than brute
+# force the index is:
+
+if __name__ == "__main__":
+    print(f"{'data':<10}{'dim':>5}{'recall':>8}{'candidates':>12}"
+          f"{'lsh ms':>9}{'exact ms':>10}{'speedup':>9}")
+    for data in ["uniform", "clustered"]:
+        for dim in [2, 10, 50, 100, 250, 500]:
+            rng = random.Random(dim)
+            if data == "uniform":
+                points = [random_point(dim, rng) for _ in range(20_050)]
+            else:
+                points = clustered_points(20_050, dim, 100, 0.05, rng)
+            points, queries = points[:20_000], points[20_000:]
+
+            index = LSHIndex([LabeledPoint(p, "") for p in points], backend=backend)
+            row = recall_and_latency(index, queries)
+            print(f"{data:<10}{dim:>5}{row['recall']:>8.3f}{row['candidates']:>12.0f}"
+                  f"{row['lsh_ms']:>9.2f}{row['exact_ms']:>10.2f}"
+                  f"{row['exact_ms'] / row['lsh_ms']:>9.1f}")
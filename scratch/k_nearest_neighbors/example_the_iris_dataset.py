@@ -6,7 +6,8 @@ import random
 
 import matplotlib.pyplot as plt
 
-from scratch.k_nearest_neighbors.the_model import LabeledPoint, knn_classify
+from scratch.k_nearest_neighbors.the_model import LabeledPoint, knn_classify, leave_one_out_accuracy
+from scratch.k_nearest_neighbors.spatial_indexes import build_index
 from scratch.linear_algebra.vectors import Vector
 from scratch.machine_learning.overfitting_and_underfitting import split_data
 
@@ -89,8 +90,15 @@ assert len(iris_test) == 0.3 * 150
 confusion_matrics: Dict[Tuple[str, str], int] = defaultdict(int)
 num_correct = 0
 
+# (We'll be classifying every test point against the same training points, so
+# we can build a spatial index over them once and let knn_classify use it. It
+# gives the same predictions as sorting all the training points every time.)
+
+iris_index = build_index(iris_train)
+
 for iris in iris_test:
-    predicted = knn_classify(5, iris_train, iris.point)
+    predicted = knn_classify(5, iris_train, iris.point, index=iris_index)
+    assert predicted == knn_classify(5, iris_train, iris.point)
     actual = iris.label
 
     if predicted == actual:
@@ -99,4 +107,10 @@ for iris in iris_test:
     confusion_matrics[(predicted, actual)] += 1
 
 pct_correct = num_correct / len(iris_test)
-print(pct_correct, confusion_matrics)
\ No newline at end of file
+print(pct_correct, confusion_matrics)
+# Rather than guessing k, we could pick the one with the best leave-one-out
+# accuracy on all 150 flowers (which finds every flower's neighbors a block at
+# a time, without sorting all of the flowers for each one):
+
+loo_accuracies = {k: leave_one_out_accuracy(k, iris_data) for k in [1, 3, 5, 7, 9]}
+print(loo_accuracies)
@@ -0,0 +1,219 @@
+from typing import List, NamedTuple, Tuple, Union
+import heapq
+import math
+import random
+
+from scratch.linear_algebra.vectors import Vector, vector_mean
+from scratch.k_nearest_neighbors.the_model import LabeledPoint, knn_classify
+
+
+# knn_classify computes the distance from the new point to every labeled point
+# and sorts them all, just to find the k closest. With a few hundred thousand
+# labeled points that's far too slow to do for every prediction.
+
+# If we're going to classify many points against the same labeled points, it
+# pays to organize them once into a tree, in which every node knows something
+# about where its points are (a box they're in, or a ball they're in). Then a
+# query can skip any node whose points can't possibly be closer than the k
+# nearest we've already found, and usually only looks at a tiny fraction of the
+# labeled points.
+
+# As we go, we keep the k nearest points found so far in a heap. heapq only
+# does min-heaps, so we store (-squared distance, -index) pairs, which puts the
+# farthest of them (the one to beat) at heap[0]. (The index breaks ties between
+# equally distant points in favor of the one that comes first, which is what
+# sorted does in knn_classify.) Comparing squared distances gives the same
+# answers as comparing distances, without taking a square root per point.
+
+def _squared_distance(v: Vector, w: Vector) -> float:
+    return sum([(v_i - w_i) * (v_i - w_i) for v_i, w_i in zip(v, w)])
+
+Heap = List[Tuple[float, int]]
+
+def _worst(heap: Heap, k: int) -> float:
+    """
+    The squared distance a point has to beat to be one of the k nearest.
+    """
+
+    return -heap[0][0] if len(heap) == k else math.inf
+
+class NeighborIndex:
+    """
+    Finds the k nearest of a fixed list of labeled points.
+    """
+
+    def __init__(self, labeled_points: List[LabeledPoint], leaf_size: int=16) -> None:
+        self.labeled_points = labeled_points
+        self.points = [list(lp.point) for lp in labeled_points]
+        self.leaf_size = leaf_size
+        self.root = self._build(list(range(len(labeled_points))))
+
+    def _build(self, indices: List[int]):
+        raise NotImplementedError
+
+    def _search(self, node, query: Vector, k: int, heap: Heap) -> None:
+        raise NotImplementedError
+
+    def _scan(self, indices: List[int], query: Vector, k: int, heap: Heap) -> None:
+        points = self.points
+        for i in indices:
+            candidate = (-_squared_distance(points[i], query), -i)
+            if len(heap) < k:
+                heapq.heappush(heap, candidate)
+            elif candidate > heap[0]:
+                heapq.heapreplace(heap, candidate)
+
+    def nearest(self, k: int, query: Vector) -> List[Tuple[float, LabeledPoint]]:
+        """
+        The k labeled points nearest to query (with their distances), from
+        nearest to farthest.
+        """
+
+        heap: Heap = []
+        if k > 0 and self.points:
+            self._search(self.root, list(query), k, heap)
+        return [(math.sqrt(-neg_squared), self.labeled_points[-neg_i])
+                for neg_squared, neg_i in sorted(heap, reverse=True)]
+
+# The first kind of tree is a k-d tree. Each node splits its points in half at
+# the median of one coordinate (whichever one they're most spread out in), so
+# every point on the left has that coordinate <= the split value and every
+# point on the right has it >= the split value. If the query is a distance d
+# from the split value in that coordinate, then every point on the far side is
+# at least d away from it, so we only need to look there if d is small enough.
+
+class Leaf(NamedTuple):
+    indices: List[int]
+
+class KDSplit(NamedTuple):
+    dim: int
+    value: float
+    left: Union[Leaf, "KDSplit"]
+    right: Union[Leaf, "KDSplit"]
+
+class KDTree(NeighborIndex):
+    def __init__(self, labeled_points: List[LabeledPoint], leaf_size: int=16) -> None:
+        # Building looks at one coordinate of many points at a time, so it's
+        # quicker to have the coordinates in columns.
+        self.columns = [list(column) for column in zip(*(lp.point for lp in labeled_points))]
+        super().__init__(labeled_points, leaf_size)
+        del self.columns
+
+    def _build(self, indices: List[int]) -> Union[Leaf, KDSplit]:
+        if len(indices) <= self.leaf_size:
+            return Leaf(indices)
+
+        spreads = []
+        for column in self.columns:
+            values = [column[i] for i in indices]
+            spreads.append(max(values) - min(values))
+        dim = spreads.index(max(spreads))
+        if spreads[dim] == 0:                       # all the same point
+            return Leaf(indices)
+
+        column = self.columns[dim]
+        indices = sorted(indices, key=column.__getitem__)
+        mid = len(indices) // 2
+        return KDSplit(dim, column[indices[mid]],
+                       self._build(indices[:mid]), self._build(indices[mid:]))
+
+    def _search(self, node: Union[Leaf, KDSplit], query: Vector, k: int, heap: Heap) -> None:
+        if isinstance(node, Leaf):
+            self._scan(node.indices, query, k, heap)
+            return
+
+        diff = query[node.dim] - node.value
+        near, far = (node.left, node.right) if diff < 0 else (node.right, node.left)
+        self._search(near, query, k, heap)
+        if diff * diff <= _worst(heap, k):
+            self._search(far, query, k, heap)
+
+# A k-d tree only ever cuts along one coordinate at a time, so in more than a
+# handful of dimensions its boxes stop telling us much. A ball tree instead
+# gives each node a center and a radius that contains all of its points. If the
+# query is a distance d from the center, every point in the ball is at least
+# d - radius away from it. We split a node's points between two "poles" that
+# are far apart: the point farthest from the center, and the point farthest
+# from that one.
+
+class Ball(NamedTuple):
+    center: Vector
+    radius: float
+    indices: List[int]                   # (only for leaves)
+    children: List["Ball"]
+
+class BallTree(NeighborIndex):
+    def _build(self, indices: List[int]) -> Ball:
+        points = self.points
+        center = vector_mean([points[i] for i in indices])
+        squared = [_squared_distance(points[i], center) for i in indices]
+        radius = math.sqrt(max(squared))
+        if len(indices) <= self.leaf_size or radius == 0:
+            return Ball(center, radius, indices, [])
+
+        pole1 = points[indices[squared.index(max(squared))]]
+        from_pole1 = [_squared_distance(points[i], pole1) for i in indices]
+        pole2 = points[indices[from_pole1.index(max(from_pole1))]]
+
+        from_pole2 = [_squared_distance(points[i], pole2) for i in indices]
+
+        left = [i for i, d1, d2 in zip(indices, from_pole1, from_pole2) if d1 <= d2]
+        right = [i for i, d1, d2 in zip(indices, from_pole1, from_pole2) if d1 > d2]
+        return Ball(center, radius, [], [self._build(left), self._build(right)])
+
+    def _search(self, node: Ball, query: Vector, k: int, heap: Heap) -> None:
+        if not node.children:
+            self._scan(node.indices, query, k, heap)
+            return
+
+        # Look in the nearer ball first, since that's where the k nearest
+        # probably are.
+        by_distance = sorted((math.sqrt(_squared_distance(query, child.center)), i)
+                             for i, child in enumerate(node.children))
+        for center_distance, i in by_distance:
+            child = node.children[i]
+            gap = max(0.0, center_distance - child.radius)
+            if gap * gap <= _worst(heap, k):
+                self._search(child, query, k, heap)
+
+# Which one to use? A rule of thumb is that k-d trees are the better choice as
+# long as there are many more points than 2 ** dim, and ball trees after that:
+
+def build_index(labeled_points: List[LabeledPoint], leaf_size: int=16) -> NeighborIndex:
+    dim = len(labeled_points[0].point) if labeled_points else 0
+    if 2 ** dim <= len(labeled_points):
+        return KDTree(labeled_points, leaf_size)
+    return BallTree(labeled_points, leaf_size)
+
+# With an index, knn_classify(k, labeled_points, new_point, index=index) asks
+# the index for the k nearest instead of sorting every labeled point, and gives
+# exactly the same answers:
+
+random.seed(0)
+labeled_points = [LabeledPoint([random.random() for _ in range(3)], random.choice("abc"))
+                  for _ in range(500)]
+labeled_points += labeled_points[:20]              # (with some exact ties)
+queries = [[random.random() for _ in range(3)] for _ in range(50)]
+
+for index in [KDTree(labeled_points), BallTree(labeled_points), build_index(labeled_points)]:
+    for query in queries + [labeled_points[0].point]:
+        by_distance = sorted(labeled_points,
+                             key=lambda lp: _squared_distance(lp.point, query))
+        assert [lp for _, lp in index.nearest(7, query)] == by_distance[:7]
+        assert (knn_classify(7, labeled_points, query, index=index)
+                == knn_classify(7, labeled_points, query))
+
+assert isinstance(build_index(labeled_points), KDTree)
+assert index.nearest(0, queries[0]) == []
+assert len(index.nearest(1000, queries[0])) == len(labeled_points)
+
+# In 20 dimensions (where we'd use a ball tree) the answers are the same too:
+
+points20 = [LabeledPoint([random.gauss(0, 1) for _ in range(20)], random.choice("ab"))
+            for _ in range(300)]
+ball_tree = build_index(points20)
+assert isinstance(ball_tree, BallTree)
+for _ in range(20):
+    query = [random.gauss(0, 1) for _ in range(20)]
+    assert ([lp for _, lp in ball_tree.nearest(5, query)]
+            == sorted(points20, key=lambda lp: _squared_distance(lp.point, query))[:5])
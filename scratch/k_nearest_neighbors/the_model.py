@@ -1,9 +1,14 @@
-from typing import List, NamedTuple
+from typing import Any, Dict, List, NamedTuple, Tuple
 from collections import Counter
+from multiprocessing import Pool
+import heapq
+import os
+import random
 
 from sklearn.neighbors import KNeighborsClassifier
 
-from scratch.linear_algebra.vectors import Vector, distance
+from scratch.linear_algebra.backends import get_backend, np
+from scratch.linear_algebra.vectors import Vector, distance, squared_distance
 
 
 # Nearest neighbors is one of the simplest predictive models there is. It makes 
@@ -31,19 +36,25 @@ def majority_vote(labels: List[str]) -> str:
     """
     
     vote_counts = Counter(labels)
-    winner, winner_count = vote_counts.most_common(1)[0]
-    num_winners = len([count
-                       for count in vote_counts.values()
-                       if count == winner_count])
-    if num_winners == 1:
-        return winner
-    else:
-        return majority_vote(labels[:-1])
+    num_labels = len(labels)
+    while True:
+        winner, winner_count = vote_counts.most_common(1)[0]
+        num_winners = len([count
+                           for count in vote_counts.values()
+                           if count == winner_count])
+        if num_winners == 1:
+            return winner
+        # Tie, so take away the farthest label's vote and try again. (Rather
+        # than counting labels[:-1] all over again.)
+        num_labels -= 1
+        vote_counts[labels[num_labels]] -= 1
 
 # Tie, so look at first 4, then 'b'
 assert majority_vote(["a", "b", "c", "b", "a"]) == "b"
+assert majority_vote(["a", "b", "b", "a", "c", "c"]) == "b"
+assert majority_vote(["a"] * 1000 + ["b"] * 1000) == "a"
 
-# This approach is sure to work eventually, since in the worst case we go all the 
+# This approach is sure to work eventually, since in the worst case we go all the
 # way down to just on label, at which point that one label wins.
 
 # With this funciton it's easy to create a classifier:
@@ -53,13 +64,242 @@ class LabeledPoint(NamedTuple):
     label: str
 
 
-def knn_classify(k: int, labeled_points: List[LabeledPoint], new_point: Vector) -> str:
-    # Order the labeled points from nearest to farthest.
-    by_distance = sorted(labeled_points, key=lambda lp: distance(lp.point, new_point))
-    # Find the labels for the k closest.
-    k_nearest_labels = [lp.label for lp in by_distance[:k]]
+Neighbor = Tuple[float, LabeledPoint]           # (distance, labeled point)
+
+def nearest_neighbors(k: int,
+                      labeled_points: List[LabeledPoint],
+                      new_point: Vector,
+                      index=None) -> List[Neighbor]:
+    """
+    The k labeled points closest to new_point, with their distances, from
+    nearest to farthest. If you give it an index (see spatial_indexes.py)
+    built over the labeled_points, it uses that instead of looking at them all.
+    """
+
+    if index is not None:
+        return index.nearest(k, new_point)
+
+    # heapq.nsmallest gives the same answer as sorting all the labeled points
+    # and keeping the first k, but only ever keeps k of them around. We
+    # compute each distance once, and keep it.
+    with_distances = ((distance(lp.point, new_point), lp) for lp in labeled_points)
+    return heapq.nsmallest(k, with_distances, key=lambda pair: pair[0])
+
+def knn_classify(k: int,
+                 labeled_points: List[LabeledPoint],
+                 new_point: Vector,
+                 index=None,
+                 weighted: bool=False) -> str:
+    """
+    If you give it an index (see spatial_indexes.py) built over the
+    labeled_points, it uses that to find the k nearest instead of sorting.
+    If weighted, closer neighbors get bigger votes (see weighted_vote).
+    """
+
+    # Find the k closest, from nearest to farthest,
+    neighbors = nearest_neighbors(k, labeled_points, new_point, index)
     # and let them vote.
-    return majority_vote(k_nearest_labels)
+    if weighted:
+        return weighted_vote(neighbors)
+    return majority_vote([lp.label for _, lp in neighbors])
+
+# Since nearest_neighbors hands back the distances, we get the second option
+# above (weighting the votes by distance) almost for free. Each neighbor votes
+# with weight 1 / distance, so a point right next to the new point outweighs
+# several that are barely in the top k. A neighbor at distance 0 would get an
+# infinite vote, so if there are any of those, only they vote. Ties go to
+# the label whose closest neighbor is nearest, which is the one we see first.
+
+def vote_weights(neighbors: List[Neighbor], weighted: bool=True) -> Dict[str, float]:
+    """
+    The total vote for each label, in order of each label's nearest neighbor.
+    """
+
+    if weighted and any(d == 0 for d, _ in neighbors):
+        neighbors = [(d, lp) for d, lp in neighbors if d == 0]
+        weighted = False
+
+    weights: Dict[str, float] = {}
+    for d, lp in neighbors:
+        weights[lp.label] = weights.get(lp.label, 0.0) + (1 / d if weighted else 1.0)
+    return weights
+
+def weighted_vote(neighbors: List[Neighbor]) -> str:
+    weights = vote_weights(neighbors)
+    return max(weights, key=weights.__getitem__)    # (max keeps the first of any ties)
+
+# Often we want more than the winner: how sure the neighbors are about it.
+# knn_probabilities gives each label's share of the vote, from the same
+# neighbors (and distances) that knn_classify would use:
+
+def knn_probabilities(k: int,
+                      labeled_points: List[LabeledPoint],
+                      new_point: Vector,
+                      index=None,
+                      weighted: bool=False) -> Dict[str, float]:
+    weights = vote_weights(nearest_neighbors(k, labeled_points, new_point, index), weighted)
+    total = sum(weights.values())
+    return {label: weight / total for label, weight in weights.items()}
+
+_neighbors = [LabeledPoint([0.0], "a"), LabeledPoint([1.0], "b"),
+              LabeledPoint([3.0], "a"), LabeledPoint([4.0], "b")]
+_nearest = nearest_neighbors(2, _neighbors, [0.9])
+assert [lp for _, lp in _nearest] == [_neighbors[1], _neighbors[0]]
+assert all(abs(d - expected) < 1e-9 for (d, _), expected in zip(_nearest, [0.1, 0.9]))
+assert knn_classify(3, _neighbors, [0.9]) == "a"                   # a, b, a
+assert knn_classify(3, _neighbors, [0.9], weighted=True) == "b"    # 1/0.1 beats 1/0.9 + 1/2.1
+assert knn_classify(4, _neighbors, [1.0], weighted=True) == "b"    # only the exact match votes
+assert knn_probabilities(4, _neighbors, [2.0]) == {"b": 0.5, "a": 0.5}
+assert knn_probabilities(4, _neighbors, [1.0], weighted=True) == {"b": 1.0}
+assert abs(sum(knn_probabilities(3, _neighbors, [0.9], weighted=True).values()) - 1) < 1e-12
+
+# When we have lots of points to classify (a test set, say), doing them one at
+# a time wastes a lot of work. knn_classify_batch splits them into blocks. With
+# the numpy backend, it computes a whole block's distances to all of the
+# labeled points at once, as a matrix, using
+#
+#   |q - p|^2 = |q|^2 + |p|^2 - 2 q.p
+#
+# (one matrix product for the whole block), and then only partially sorts each
+# row to find its k smallest entries. That formula can be off by a little
+# rounding, so to match knn_classify exactly we then recompute the distances
+# of the few candidates near the cutoff directly and break ties by position.
+
+# The blocks are independent of one another, so we can also hand them to a
+# pool of worker processes. Each worker gets the labeled points once, when it
+# starts:
+
+_worker: Dict[str, Any] = {}
+
+def _start_worker(labeled_points: List[LabeledPoint], backend: str) -> None:
+    _worker.update(labeled_points=labeled_points, backend=backend)
+    if backend == "numpy":
+        points = np.array([lp.point for lp in labeled_points], dtype=float)
+        _worker.update(points=points, squares=np.einsum("ij,ij->i", points, points))
+
+def _nearest_indices(k: int, queries: List[Vector]) -> List[List[int]]:
+    """
+    For each query, the indices of its k nearest labeled points, from nearest
+    to farthest (ties going to the earlier point).
+    """
+
+    labeled_points = _worker["labeled_points"]
+    k = min(k, len(labeled_points))
+    if k == 0:
+        return [[] for _ in queries]
+
+    if _worker["backend"] != "numpy":
+        return [heapq.nsmallest(k, range(len(labeled_points)),
+                                key=lambda i: squared_distance(labeled_points[i].point, query))
+                for query in queries]
+
+    points, squares = _worker["points"], _worker["squares"]
+    block = np.array(queries, dtype=float)
+    block_squares = np.einsum("ij,ij->i", block, block)
+    distances = block_squares[:, None] + squares[None, :] - 2 * (block @ points.T)
+
+    kth = np.partition(distances, k - 1, axis=1)[:, k - 1]
+    # Allow for the rounding in the formula above.
+    slack = 1e-9 * (block_squares + squares.max()) + 1e-12
+
+    nearest = []
+    for row, query in enumerate(block):
+        candidates = np.flatnonzero(distances[row] <= kth[row] + slack[row])
+        exact = ((points[candidates] - query) ** 2).sum(axis=1)
+        order = np.lexsort((candidates, exact))[:k]
+        nearest.append(candidates[order].tolist())
+    return nearest
+
+def _classify_block(task) -> List[str]:
+    k, queries = task
+    labeled_points = _worker["labeled_points"]
+    return [majority_vote([labeled_points[i].label for i in indices])
+            for indices in _nearest_indices(k, queries)]
+
+def knn_classify_batch(k: int,
+                       labeled_points: List[LabeledPoint],
+                       new_points: List[Vector],
+                       block_size: int=256,
+                       num_workers: int=1,
+                       backend: str=None) -> List[str]:
+    """
+    The same as [knn_classify(k, labeled_points, p) for p in new_points],
+    computed a block at a time (in num_workers processes, or as many as there
+    are CPUs if it's None).
+    """
+
+    backend = get_backend(backend)
+    tasks = [(k, new_points[start:start + block_size])
+             for start in range(0, len(new_points), block_size)]
+
+    if num_workers == 1:
+        _start_worker(labeled_points, backend)
+        try:
+            results = [_classify_block(task) for task in tasks]
+        finally:
+            _worker.clear()
+    else:
+        with Pool(num_workers or os.cpu_count(),
+                  initializer=_start_worker,
+                  initargs=(labeled_points, backend)) as pool:
+            results = pool.map(_classify_block, tasks)
+
+    return [label for block in results for label in block]
+
+# Leave-one-out accuracy (classify each labeled point using all of the others)
+# is a nice way to choose k without giving up a test set. It's just a batch in
+# which every labeled point is a query, except that each query has to skip
+# itself, so we ask for one extra neighbor and drop it:
+
+def _leave_one_out_block(task) -> int:
+    k, start, queries = task
+    labeled_points = _worker["labeled_points"]
+    correct = 0
+    for i, indices in enumerate(_nearest_indices(k + 1, queries), start):
+        others = [j for j in indices if j != i][:k]
+        if majority_vote([labeled_points[j].label for j in others]) == labeled_points[i].label:
+            correct += 1
+    return correct
+
+def leave_one_out_accuracy(k: int,
+                           labeled_points: List[LabeledPoint],
+                           block_size: int=256,
+                           num_workers: int=1,
+                           backend: str=None) -> float:
+    backend = get_backend(backend)
+    points = [lp.point for lp in labeled_points]
+    tasks = [(k, start, points[start:start + block_size])
+             for start in range(0, len(points), block_size)]
+
+    if num_workers == 1:
+        _start_worker(labeled_points, backend)
+        try:
+            correct = sum(_leave_one_out_block(task) for task in tasks)
+        finally:
+            _worker.clear()
+    else:
+        with Pool(num_workers or os.cpu_count(),
+                  initializer=_start_worker,
+                  initargs=(labeled_points, backend)) as pool:
+            correct = sum(pool.map(_leave_one_out_block, tasks))
+
+    return correct / len(labeled_points)
+
+random.seed(0)
+_points = [LabeledPoint([random.randrange(5) for _ in range(3)], random.choice("abc"))
+           for _ in range(200)]                    # (lots of ties)
+_queries = [[random.random() * 4 for _ in range(3)] for _ in range(40)] + [_points[0].point]
+_expected = [knn_classify(5, _points, query) for query in _queries]
+assert knn_classify_batch(5, _points, _queries, block_size=16) == _expected
+if np is not None:
+    assert knn_classify_batch(5, _points, _queries, block_size=16, backend="numpy") == _expected
+
+_loo = _points[:60]
+_loo_expected = sum(knn_classify(3, _loo[:i] + _loo[i + 1:], lp.point) == lp.label
+                    for i, lp in enumerate(_loo)) / len(_loo)
+assert leave_one_out_accuracy(3, _loo, block_size=16) == _loo_expected
+if np is not None:
+    assert leave_one_out_accuracy(3, _loo, block_size=16, backend="numpy") == _loo_expected
 
 # scikit-learn can do the same
 KNeighborsClassifier
\ No newline at end of file
@@ -0,0 +1,103 @@
+from contextlib import contextmanager
+from typing import Callable, Iterator, List
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# The functions in vectors.py and matrices.py are written with list
+# comprehensions so that you can see exactly what they compute. Unfortunately
+# almost every model we build calls them in its innermost loop, where
+# processing one Python float at a time is slow.
+
+# NumPy does the same computations over contiguous arrays in compiled code. So
+# we'll let the caller choose a backend: "python" (the default) runs the
+# reference implementations, and "numpy" runs the ndarray versions below. You
+# can pick one globally with set_backend, temporarily with use_backend, or for
+# a single call by passing backend="numpy".
+
+BACKENDS = ("python", "numpy")
+
+_backend = "python"
+
+def get_backend(backend: str=None) -> str:
+    """
+    The backend to use: the one asked for, or else the global one.
+    """
+
+    if backend is None:
+        return _backend
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend: {backend}")
+    if backend == "numpy" and np is None:
+        raise ImportError("the numpy backend requires numpy to be installed")
+    return backend
+
+def set_backend(backend: str) -> None:
+    global _backend
+    _backend = get_backend(backend)
+
+@contextmanager
+def use_backend(backend: str) -> Iterator[None]:
+    """
+    Temporarily switch the global backend.
+    """
+
+    previous = _backend
+    set_backend(backend)
+    try:
+        yield
+    finally:
+        set_backend(previous)
+
+# The ndarray implementations. Vector results come back as ndarrays (so that
+# chained calls never round-trip through lists), scalar results as floats.
+
+def add(v, w):
+    return np.add(v, w)
+
+def subtract(v, w):
+    return np.subtract(v, w)
+
+def vector_sum(vectors):
+    return np.sum(np.asarray(vectors, dtype=float), axis=0)
+
+def vector_mean(vectors):
+    return np.mean(np.asarray(vectors, dtype=float), axis=0)
+
+def dot(v, w) -> float:
+    return float(np.dot(v, w))
+
+def squared_distance(v, w) -> float:
+    difference = np.subtract(v, w)
+    return float(np.dot(difference, difference))
+
+def distance(v, w) -> float:
+    return float(np.linalg.norm(np.subtract(v, w)))
+
+def make_matric(num_rows: int,
+                num_cols: int,
+                entry_fn: Callable[[int, int], float]):
+    entries = (entry_fn(i, j) for i in range(num_rows) for j in range(num_cols))
+    return np.fromiter(entries, float, num_rows * num_cols).reshape(num_rows, num_cols)
+
+def get_column(A, j: int):
+    return np.asarray(A)[:, j]
+
+def transpose(A):
+    return np.transpose(A)
+
+def matvec(A, v):
+    return np.dot(A, v)
+
+def matmul(A, B):
+    return np.matmul(A, B)
+
+def to_list(result) -> List:
+    """
+    Converts a backend result back to plain Python lists (for comparisons).
+    """
+
+    return result.tolist() if hasattr(result, "tolist") else result
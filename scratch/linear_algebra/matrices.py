@@ -1,6 +1,9 @@
-from typing import List, Tuple, Callable
+from typing import List, Tuple, Callable, Union
 from itertools import chain
+from operator import add, sub, mul
 
+from scratch.linear_algebra import backends
+from scratch.linear_algebra.backends import get_backend
 from scratch.linear_algebra.vectors import Vector
 
 
@@ -33,18 +36,27 @@ def get_row(A: Matric, i: int) -> Vector:
 
     return A[i]
 
-def get_column(A: Matric, j: int) -> Vector:
+def get_column(A: Matric, j: int, backend: str=None) -> Vector:
     """
     Return the j-th column of A (as a Vector).
     """
 
+    if get_backend(backend) == "numpy":
+        return backends.get_column(A, j)
+
     return [row[j] for row in A]
 
-def make_matric(num_rows: int, num_cols: int, entry_fn: Callable[[int, int], float]) -> Matric:
+def make_matric(num_rows: int,
+                num_cols: int,
+                entry_fn: Callable[[int, int], float],
+                backend: str=None) -> Matric:
     """
     Returns a num_row x num_cols matrix, whose (i, j)-the entry is entry_fn(i, j)
     """
 
+    if get_backend(backend) == "numpy":
+        return backends.make_matric(num_rows, num_cols, entry_fn)
+
     return [
         [entry_fn(i, j) for j in range(num_cols)]
         for i in range(num_rows)
@@ -54,6 +66,10 @@ def identity_matrix(n: int) -> Matric:
     return make_matric(n, n, lambda i, j: 1 if i == j else 0)
 
 assert shape(A) == (2, 3)
+if backends.np is not None:
+    assert backends.to_list(get_column(A, 1, backend="numpy")) == get_column(A, 1)
+    assert (backends.to_list(make_matric(2, 3, lambda i, j: i - j, backend="numpy"))
+            == make_matric(2, 3, lambda i, j: i - j))
 assert identity_matrix(5) == [
     [1, 0, 0, 0, 0],
     [0, 1, 0, 0, 0],
@@ -72,4 +88,104 @@ assert friend_matric[0][0] == 0, "0 and 8 are not frinds"
 
 # only need to look at one row
 friends_of_five = [i for i, col in enumerate(friend_matric[5]) if col == 1]
-assert friends_of_five == [4, 6, 7]
\ No newline at end of file
+assert friends_of_five == [4, 6, 7]
+
+# Matrix Operations
+# Most of the models we'll build end up multiplying matrices, and computing
+# each entry of a product as dot(get_row(A, i), get_column(B, j)) rebuilds the
+# column (by walking every row of B) once for every entry. It's much cheaper to
+# transpose B once, so that its columns are themselves contiguous lists:
+
+def transpose(A: Matric, backend: str=None) -> Matric:
+    """
+    Returns the num_cols x num_rows matrix whose (j, i)-th entry is A[i][j].
+    """
+
+    if get_backend(backend) == "numpy":
+        return backends.transpose(A)
+
+    return [list(column) for column in zip(*A)]
+
+def matvec(A: Matric, v: Vector, backend: str=None) -> Vector:
+    """
+    Returns the vector whose i-th entry is dot(A[i], v).
+    """
+
+    assert shape(A)[1] == len(v)
+    if get_backend(backend) == "numpy":
+        return backends.matvec(A, v)
+
+    return [sum(map(mul, row, v)) for row in A]
+
+def matmul(A: Matric, B: Matric, backend: str=None) -> Matric:
+    """
+    Returns the num_rows(A) x num_cols(B) matrix product of A and B.
+    """
+
+    assert shape(A)[1] == shape(B)[0], "A must have as many columns as B has rows"
+    if get_backend(backend) == "numpy":
+        return backends.matmul(A, B)
+
+    B_columns = transpose(B)
+    return [[sum(map(mul, row, column)) for column in B_columns] for row in A]
+
+assert transpose(A) == [[1, 4], [2, 5], [3, 6]]
+assert matvec(A, [1, 0, -1]) == [-2, -2]
+assert matmul(A, B) == [[22, 28], [49, 64]]
+assert matmul(identity_matrix(2), A) == A
+
+# If you multiply big matrices, the order in which you visit the entries also
+# matters: a "blocked" multiply works through the matrices in tiles that fit
+# in the CPU cache. In pure Python that's a lost cause (every entry is a
+# separate boxed float, and interpreting the loop costs far more than any
+# cache miss), which is why matmul keeps its inner loop inside sum and map. The
+# numpy backend hands the product to BLAS, which does the blocking for us.
+
+# We'll also want to combine matrices elementwise. Like numpy, we'll
+# "broadcast" the second argument: it can be a number, a single row (which is
+# used for every row), a single column (a num_rows x 1 matrix, used for every
+# column), or a full matrix of the same shape:
+
+def elementwise(f: Callable[[float, float], float],
+                A: Matric,
+                B: Union[float, Vector, Matric]) -> Matric:
+    """
+    Applies f to corresponding entries of A and (broadcast) B.
+    """
+
+    num_rows, num_cols = shape(A)
+
+    if isinstance(B, (int, float)):
+        return [[f(a, B) for a in row] for row in A]
+
+    if B and not isinstance(B[0], list):    # a Vector is a single row
+        B = [B]
+
+    if len(B) == 1:
+        B = B * num_rows
+    assert len(B) == num_rows, f"can't broadcast {shape(B)} to {(num_rows, num_cols)}"
+
+    result = []
+    for a_row, b_row in zip(A, B):
+        if len(b_row) == 1:
+            b_row = b_row * num_cols
+        assert len(b_row) == num_cols, f"can't broadcast {shape(B)} to {(num_rows, num_cols)}"
+        result.append(list(map(f, a_row, b_row)))
+
+    return result
+
+def matrix_add(A: Matric, B: Union[float, Vector, Matric]) -> Matric:
+    return elementwise(add, A, B)
+
+def matrix_subtract(A: Matric, B: Union[float, Vector, Matric]) -> Matric:
+    return elementwise(sub, A, B)
+
+assert matrix_add(A, 1) == [[2, 3, 4], [5, 6, 7]]
+assert matrix_add(A, [10, 20, 30]) == [[11, 22, 33], [14, 25, 36]]
+assert matrix_subtract(A, [[1], [4]]) == [[0, 1, 2], [0, 1, 2]]
+assert elementwise(mul, A, A) == [[1, 4, 9], [16, 25, 36]]
+
+if backends.np is not None:
+    assert backends.to_list(transpose(A, backend="numpy")) == transpose(A)
+    assert backends.to_list(matvec(A, [1, 0, -1], backend="numpy")) == matvec(A, [1, 0, -1])
+    assert backends.to_list(matmul(A, B, backend="numpy")) == matmul(A, B)
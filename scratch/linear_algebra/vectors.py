@@ -1,9 +1,17 @@
 import math
 from typing import List
 
+from scratch.linear_algebra import backends
+from scratch.linear_algebra.backends import get_backend
+
 
 Vector = List[float]
 
+# (With the numpy backend, the functions below that return a Vector return an
+# ndarray instead of a list, so that chained calls never convert back and
+# forth. Comparing an ndarray with == gives an array of booleans, not True or
+# False, so use backends.to_list on results you want to compare.)
+
 height_weight_age = [
     70, # inches
     170, # pounds
@@ -17,23 +25,27 @@ grades = [
     62, # exam4
 ]
 
-def add(v: Vector, w: Vector) -> Vector:
+def add(v: Vector, w: Vector, backend: str=None) -> Vector:
     """
-    Adds corresponding elements.
+    Adds corresponding elements. (An ndarray with the numpy backend.)
     """
 
     assert len(v) == len(w)
+    if get_backend(backend) == "numpy":
+        return backends.add(v, w)
     return [v_ + w_ for v_, w_ in zip(v, w)]
 
-def subtract(v: Vector, w: Vector) -> Vector:
+def subtract(v: Vector, w: Vector, backend: str=None) -> Vector:
     """
-    Subtracts corresponding elements.
+    Subtracts corresponding elements. (An ndarray with the numpy backend.)
     """
 
     assert len(v) == len(w)
+    if get_backend(backend) == "numpy":
+        return backends.subtract(v, w)
     return [v_ - w_ for v_, w_ in zip(v, w)]
 
-def vector_sum(vectors: List[Vector]) -> Vector:
+def vector_sum(vectors: List[Vector], backend: str=None) -> Vector:
     """
     Sums all corresponding elements.
     """
@@ -45,8 +57,12 @@ def vector_sum(vectors: List[Vector]) -> Vector:
     for i in range(1, len(num_elements)):
         assert num_elements[i] == num_elements[0]
 
-    # the i-th element of the result is the sum of every vector[i]
-    return [sum(vector[i] for vector in vectors) for i in range(len(vectors[0]))]
+    if get_backend(backend) == "numpy":
+        return backends.vector_sum(vectors)
+
+    # the i-th element of the result is the sum of every vector[i]; zip(*vectors)
+    # hands us those columns in a single pass over the vectors
+    return [sum(column) for column in zip(*vectors)]
 
 def scaler_multiply(c: float, v: Vector) -> Vector:
     """
@@ -55,20 +71,28 @@ def scaler_multiply(c: float, v: Vector) -> Vector:
 
     return [c * v_ for v_ in v]
 
-def vector_mean(vectors: List[Vector]) -> Vector:
+def vector_mean(vectors: List[Vector], backend: str=None) -> Vector:
     """
     Compute the element-wise average.
     """
 
+    # (np.mean of nothing would be nan, with just a warning.)
+    if len(vectors) == 0:
+        raise ValueError("can't take the mean of no vectors")
+    if get_backend(backend) == "numpy":
+        return backends.vector_mean(vectors)
+
     n = len(vectors)
     return scaler_multiply(1 / n, vector_sum(vectors))
 
-def dot(v: Vector, w: Vector) -> float:
+def dot(v: Vector, w: Vector, backend: str=None) -> float:
     """
     Computes v_1 * w_1 + ... + v_n * w_n.
     """
 
     assert len(v) == len(w)
+    if get_backend(backend) == "numpy":
+        return backends.dot(v, w)
     return sum([v_ * w_ for v_, w_ in zip(v, w)])
 
 def sum_of_squares(v: Vector) -> float:
@@ -85,18 +109,24 @@ def magnitude(v: Vector) -> float:
 
     return math.sqrt(sum_of_squares(v))
 
-def squared_distance(v: Vector, w: Vector) -> float:
+def squared_distance(v: Vector, w: Vector, backend: str=None) -> float:
     """
     Computes (v_1 - w_1) ** 2 + ... + (v_n - w_n) ** 2.
     """
 
+    if get_backend(backend) == "numpy":
+        return backends.squared_distance(v, w)
+
     return sum_of_squares(subtract(v, w))
 
-def distance(v: Vector, w: Vector) -> float:
+def distance(v: Vector, w: Vector, backend: str=None) -> float:
     """
     Computes the distance between v and w.
     """
 
+    if get_backend(backend) == "numpy":
+        return backends.distance(v, w)
+
     return magnitude(subtract(v, w))
 
 assert add([1, 2, 3], [4, 5, 6]) == [5, 7, 9]
@@ -106,3 +136,21 @@ assert scaler_multiply(2, [1, 2, 3]) == [2, 4, 6]
 assert vector_mean([[1, 2], [3, 4], [5, 6]]) == [3, 4]
 assert dot([1, 2, 3], [4, 5, 6]) == 32
 assert magnitude([3, 4]) == 5
+
+# Every function that has an ndarray version has to agree with the reference
+# implementation:
+
+if backends.np is not None:
+    v, w = [1, 2, 3], [4, 6, 8]
+    vs = [[1, 2], [3, 4], [5, 6], [7, 8]]
+    for f, args in [(add, (v, w)), (subtract, (v, w)), (dot, (v, w)),
+                    (squared_distance, (v, w)), (distance, (v, w)),
+                    (vector_sum, (vs,)), (vector_mean, (vs,))]:
+        assert backends.to_list(f(*args, backend="numpy")) == f(*args), f.__name__
+
+    for backend in ["python", "numpy"]:
+        try:
+            vector_mean([], backend=backend)
+            assert False, f"vector_mean([]) worked with the {backend} backend"
+        except ValueError:
+            pass
@@ -3,7 +3,8 @@ import random
 
 import tqdm
 
-from scratch.linear_algebra.vectors import Vector, vector_mean
+from scratch.linear_algebra.vectors import Vector, subtract, scaler_multiply
+from scratch.linear_algebra.matrices import matvec, transpose
 from scratch.gradient_descent.using_gradient_descent_to_fix_models import gradient_step
 from scratch.simple_linear_regression.the_model import daily_minutes_good
 from scratch.multiple_regression.the_model import predict
@@ -41,12 +42,18 @@ def least_squares_fit(xs: List[Vector],
     # start with a random guess
     guess = [random.random() for _ in xs[0]]
 
+    # The mean of the sqerror_gradients over a batch is 2 / n * X^T (X beta - y),
+    # so we can compute it with two matrix-vector products instead of one
+    # gradient per example. The batches don't change, so transpose them once.
+    batches = [(xs[start: start + batch_size],
+                transpose(xs[start: start + batch_size]),
+                ys[start: start + batch_size])
+               for start in range(0, len(xs), batch_size)]
+
     for _ in tqdm.trange(num_steps, desc="least squares fit"):
-        for start in range(0, len(xs), batch_size):
-            batch_xs = xs[start: start + batch_size]
-            batch_ys = ys[start: start + batch_size]
-            gradient = vector_mean([sqerror_gradient(x, y, guess)
-                                    for x, y in zip(batch_xs, batch_ys)])
+        for batch_xs, batch_xs_t, batch_ys in batches:
+            errors = subtract(matvec(batch_xs, guess), batch_ys)
+            gradient = scaler_multiply(2 / len(batch_xs), matvec(batch_xs_t, errors))
             guess = gradient_step(guess, gradient, -learning_rate)
 
     return guess
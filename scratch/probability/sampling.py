@@ -0,0 +1,137 @@
+from typing import List
+from array import array
+import math
+import random
+
+
+# Whenever we've wanted a normally distributed random number, we've taken a
+# uniform one and pushed it through inverse_normal_cdf. That works, but our
+# inverse_normal_cdf finds its answer by binary search, which takes about 20
+# calls to math.erf per number. Initializing a single 784 x 30 Linear layer
+# that way means half a million erf calls.
+
+# There are two better options. If we really do need the inverse cdf, there's a
+# closed-form rational approximation (due to Peter Acklam) that's accurate to
+# about 1e-9 on its own. One step of Halley's method (which uses a single erfc)
+# takes that down to rounding error:
+
+_A = (-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+      1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00)
+_B = (-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+      6.680131188771972e+01, -1.328068155288572e+01)
+_C = (-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+      -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00)
+_D = (7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00,
+      3.754408661907416e+00)
+
+P_LOW = 0.02425
+P_EPSILON = 2 ** -53
+
+def _tail(q: float) -> float:
+    c, d = _C, _D
+    return ((((((c[0] * q + c[1]) * q + c[2]) * q + c[3]) * q + c[4]) * q + c[5])
+            / ((((d[0] * q + d[1]) * q + d[2]) * q + d[3]) * q + 1))
+
+def inverse_normal_cdf(p: float, mu: float=0, sigma: float=1) -> float:
+    """
+    The z with normal_cdf(z, mu, sigma) == p, from a rational approximation
+    plus one refinement step.
+    """
+
+    if not 0 <= p <= 1:
+        raise ValueError(f"p must be between 0 and 1, not {p}")
+    # random.random() can return exactly 0, and the true answer there is
+    # -infinity, which would poison any sum it ends up in. So we clamp p to
+    # the closest it can get to 0 or 1 (random.random() returns multiples of
+    # 2 ** -53), which keeps z within about 8.2 of the mean.
+    p = min(max(p, P_EPSILON), 1 - P_EPSILON)
+
+    if p < P_LOW:
+        z = _tail(math.sqrt(-2 * math.log(p)))
+    elif p <= 1 - P_LOW:
+        a, b = _A, _B
+        q = p - 0.5
+        r = q * q
+        z = ((((((a[0] * r + a[1]) * r + a[2]) * r + a[3]) * r + a[4]) * r + a[5]) * q
+             / (((((b[0] * r + b[1]) * r + b[2]) * r + b[3]) * r + b[4]) * r + 1))
+    else:
+        z = -_tail(math.sqrt(-2 * math.log(1 - p)))
+
+    # Halley's method: e is how far off normal_cdf(z) is.
+    e = 0.5 * math.erfc(-z / math.sqrt(2)) - p
+    u = e * math.sqrt(2 * math.pi) * math.exp(z * z / 2)
+    z -= u / (1 + z * u / 2)
+
+    return mu + sigma * z
+
+# But if we just want normal samples, we don't need the inverse cdf at all. The
+# Box-Muller transform turns two independent uniform numbers u1 and u2 into two
+# independent standard normal ones:
+
+#   r = sqrt(-2 log(u1)), theta = 2 pi u2  =>  r cos(theta), r sin(theta)
+
+# Each function below takes an optional rng (a random.Random) so that you can
+# give a model or a simulation its own reproducible stream of random numbers.
+# Without one they use the random module itself, so random.seed still works.
+
+def uniform_samples(n: int,
+                    low: float=0.0,
+                    high: float=1.0,
+                    rng: random.Random=None) -> array:
+    rand = (rng or random).random
+    width = high - low
+    return array("d", [low + width * rand() for _ in range(n)])
+
+def normal_samples(n: int,
+                   mu: float=0.0,
+                   sigma: float=1.0,
+                   rng: random.Random=None) -> array:
+    """
+    n draws from the normal distribution with mean mu and standard deviation
+    sigma, as an array of doubles.
+    """
+
+    rand = (rng or random).random
+    log, sqrt, cos, sin = math.log, math.sqrt, math.cos, math.sin
+    two_pi = 2 * math.pi
+
+    pairs = (n + 1) // 2
+    # (1 - random() is in (0, 1], so we never take log(0).)
+    radii = [sigma * sqrt(-2 * log(1.0 - rand())) for _ in range(pairs)]
+    angles = [two_pi * rand() for _ in range(pairs)]
+
+    samples = array("d", [mu + r * cos(theta) for r, theta in zip(radii, angles)])
+    samples.extend([mu + r * sin(theta) for r, theta in zip(radii, angles)])
+    del samples[n:]
+    return samples
+
+def random_normal(rng: random.Random=None) -> float:
+    """
+    A single draw from the standard normal distribution.
+    """
+
+    return normal_samples(1, rng=rng)[0]
+
+# The approximation agrees with scipy's (but without importing scipy):
+
+assert inverse_normal_cdf(0.5) == 0.0
+assert inverse_normal_cdf(0.0) == inverse_normal_cdf(2 ** -53)
+assert -8.3 < inverse_normal_cdf(0.0) < -8.1 and abs(inverse_normal_cdf(0.0) + inverse_normal_cdf(1.0)) < 1e-6
+assert abs(inverse_normal_cdf(0.975) - 1.959963984540054) < 1e-12
+assert abs(inverse_normal_cdf(0.001) + 3.090232306167813) < 1e-12
+assert abs(inverse_normal_cdf(0.9, mu=10, sigma=2) - (10 + 2 * 1.2815515655446004)) < 1e-12
+assert all(abs(inverse_normal_cdf(p) + inverse_normal_cdf(1 - p)) < 1e-9
+           for p in [0.01, 0.02425, 0.3, 0.49])
+
+# and the samples have the right mean and standard deviation, and the same
+# seed gives the same samples:
+
+def _mean_and_sd(xs: List[float]):
+    mean = sum(xs) / len(xs)
+    return mean, math.sqrt(sum((x - mean) ** 2 for x in xs) / (len(xs) - 1))
+
+mean, sd = _mean_and_sd(normal_samples(100_001, mu=3, sigma=2, rng=random.Random(0)))
+assert abs(mean - 3) < 0.03 and abs(sd - 2) < 0.03
+assert len(normal_samples(7)) == 7
+assert normal_samples(5, rng=random.Random(1)) == normal_samples(5, rng=random.Random(1))
+assert max(uniform_samples(1000, -1, 1)) <= 1 and min(uniform_samples(1000, -1, 1)) >= -1
@@ -5,6 +5,7 @@ import tqdm
 
 from scratch.linear_algebra.vectors import Vector, subtract, vector_mean, \
     magnitude, dot, scaler_multiply
+from scratch.linear_algebra.matrices import matvec, matmul, transpose
 from scratch.gradient_descent.using_the_gradient import gradient_step
 
 
@@ -157,7 +158,7 @@ def directional_variance(data: List[Vector], w: Vector) -> float:
     """
 
     w_dir = direction(w)
-    return sum(dot(v, w_dir) ** 2 for v in data)
+    return sum(projection ** 2 for projection in matvec(data, w_dir))
 
 # We'd like to find the direction that maximizes this variance. We can do this 
 # using gradient descent, as soon as we have the gradient function:
@@ -167,9 +168,11 @@ def directional_variance_gradient(data: List[Vector], w: Vector) -> Vector:
     The gradient of directional variance with respect to w.
     """
 
+    # The i-th entry is sum(2 * dot(v, w_dir) * v[i] for v in data), which
+    # is the transposed data times the vector of (doubled) projections.
     w_dir = direction(w)
-    return [sum(2 * dot(v, w_dir) * v[i] for v in data)
-            for i in range(len(w))]
+    projections = [2 * projection for projection in matvec(data, w_dir)]
+    return matvec(transpose(data), projections)
 
 # And now the first principal component that we have is just the direction that 
 # maximizes the directional_variance function:
@@ -253,10 +256,11 @@ print(pca_.explained_variance_ratio_)
 # components:
 
 def transform_vector(v: Vector, components: List[Vector]) -> Vector:
-    return [dot(v, component) for component in components]
+    return matvec(components, v)
 
 def transform(data: List[Vector], components: List[Vector]) -> List[Vector]:
-    return [transform_vector(v, components) for v in data]
+    # Transforming every vector at once is a single matrix product.
+    return matmul(data, transpose(components))
 
 # This technique is valueable for a couple of reasons. First, it can help us 
 # clean our data by eliminating noise dimensions and consolidating highly correlated 
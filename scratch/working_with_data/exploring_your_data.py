@@ -5,7 +5,7 @@ import random
 
 import matplotlib.pyplot as plt
 
-from scratch.probability.the_normal_distribution import inverse_normal_cdf
+from scratch.probability.sampling import inverse_normal_cdf
 from scratch.statistics.correlation import correlation
 from scratch.linear_algebra.matrices import Matric, Vector, make_matric
 